@@ -1,11 +1,26 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Dict, Iterable, List, Set, Tuple
 import cv2
 import numpy as np
 from tqdm import tqdm
-from ultralytics import YOLO
 
 import supervision as sv
-from arguments import source_video_path, source_weights_path, target_video_path, confidence_threshold, iou_threshold
+import metrics
+import startup
+from cadence import DetectionCadence, MotionPredictor
+from detection_cache import get_cache
+from detectors import load_detector
+from motion_gate import MotionGate, crop_to_region, region_covers
+from pipeline import Pipeline, Stage, format_report
+from tiling import TileGrid, merge_tiles
+from zones import ZoneIndex, ZoneOverlay
+from arguments import (source_video_path, source_weights_path, target_video_path, confidence_threshold, iou_threshold,
+                       metrics_dir, metrics_interval)
+
+logger = logging.getLogger(__name__)
 
 COLORS = sv.ColorPalette.from_hex(["#E6194B", "#3CB44B", "#FFE119", "#3C76D1"])
 
@@ -25,6 +40,18 @@ ZONE_OUT_POLYGONS = [
 
 
 
+def to_detections(class_ids, scores, boxes) -> sv.Detections:
+    """
+    Turns the (class_ids, scores, (x, y, w, h) boxes) returned by a detector into supervision Detections
+    """
+    if len(class_ids) == 0:
+        return sv.Detections.empty()
+    xyxy = np.array(boxes, dtype=np.float32).reshape(-1, 4)
+    xyxy[:, 2:] += xyxy[:, :2]
+    return sv.Detections(xyxy=xyxy, confidence=np.asarray(scores, dtype=np.float32),
+                         class_id=np.asarray(class_ids, dtype=int))
+
+
 def initiate_polygon_zones(
     polygons: List[np.ndarray],
     frame_resolution_wh: Tuple[int, int],
@@ -48,30 +75,120 @@ class VideoProcessor:
         target_video_path: str = None,
         confidence_threshold: float = 0.3,
         iou_threshold: float = 0.7,
+        pipelined: bool = False,
+        queue_size: int = 4,
+        detection_interval: int = 1,
+        max_detection_interval: int = 10,
+        target_frame_time: float = None,
+        motion_gating: bool = False,
+        motion_min_area: float = 0.002,
+        cache_dir: str = None,
+        cache_max_bytes: int = None,
+        tiled: bool = False,
+        tile_size: int = 640,
+        tile_overlap: float = 0.2,
+        detector_backend: str = "torch",
+        detector_threads: int = None,
+        detector_input_size: int = None,
+        headless: bool = False,
+        inference_server: str = None,
+        inference_authkey: str = None,
     ) -> None:
         self.conf_threshold = confidence_threshold
         self.iou_threshold = iou_threshold
         self.source_video_path = source_video_path
         self.target_video_path = target_video_path
+        self.pipelined = pipelined
+        self.queue_size = queue_size
+        # frames are only annotated when someone looks at them or they are recorded
+        self.preview = not headless
+        self.render = self.preview or bool(target_video_path)
 
-        self.model = YOLO(source_weights_path)
+        # the tiles go through the model at their own size
+        if detector_input_size is None and tiled:
+            detector_input_size = tile_size
+        # the model loads and warms up on its own thread while the video is opened and the zones are set up
+        # with an inference server the model runs there, shared with the other intersections
+        load = load_detector
+        if inference_server:
+            from inference_server import RemoteDetector
+
+            load = partial(RemoteDetector, inference_server, authkey=inference_authkey)
+        loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="detector-loader")
+        detector = loader.submit(load, detector_backend, source_weights_path, input_size=detector_input_size,
+                                 threads=detector_threads, conf_threshold=confidence_threshold,
+                                 nms_threshold=iou_threshold, calibration_video=source_video_path)
+        loader.shutdown(wait=False)
         self.tracker = sv.ByteTrack()
+        # YOLO runs every detection_interval frames, the tracks are moved along their velocity in between
+        self.cadence = DetectionCadence(
+            interval=detection_interval, max_interval=max_detection_interval, target_frame_time=target_frame_time
+        )
+        self.predictor = MotionPredictor()
+        self.frame_index = 0
+        # frames where nothing moved reuse the detections and counts of the last frame
+        self.motion_gate = MotionGate(min_motion=motion_min_area) if motion_gating else None
+        self.last_result = None
 
         self.video_info = sv.VideoInfo.from_video_path(source_video_path)
-        self.zones_in = initiate_polygon_zones(
-            ZONE_IN_POLYGONS, self.video_info.resolution_wh, [sv.Position.CENTER]
-        )
-        self.zones_out = initiate_polygon_zones(
-            ZONE_OUT_POLYGONS, self.video_info.resolution_wh, [sv.Position.CENTER]
+        # YOLO runs on overlapping tiles around the zones at full resolution instead of on the shrunk frame
+        self.tile_grid = None
+        if tiled:
+            self.tile_grid = TileGrid(self.video_info.resolution_wh, tile_size, tile_overlap,
+                                      ZONE_IN_POLYGONS + ZONE_OUT_POLYGONS)
+            logger.info("Tiled inference on %d tiles of %dpx", len(self.tile_grid), tile_size)
+        # the zone outlines never change, they are rasterised once and written into every frame
+        self.zone_overlay = ZoneOverlay(
+            [polygon for pair in zip(ZONE_IN_POLYGONS, ZONE_OUT_POLYGONS) for polygon in pair],
+            [COLORS.colors[i].as_bgr() for i in range(len(ZONE_IN_POLYGONS)) for _ in range(2)],
+            self.video_info.resolution_wh,
         )
+        self.zone_index = ZoneIndex(ZONE_IN_POLYGONS, self.video_info.resolution_wh, sv.Position.CENTER)
+
+        self.stage_seconds = {stage: metrics.histogram("stage_seconds", pipeline="aerial", stage=stage)
+                              for stage in ("detect", "track", "count", "annotate")}
+        self.frames_counter = {path: metrics.counter("aerial_frames", path=path)
+                               for path in ("static", "predicted", "detected")}
+        self.lane_vehicles = [metrics.gauge("lane_vehicles", lane=f"lane{i}") for i in range(len(ZONE_IN_POLYGONS))]
 
         self.bounding_box_annotator = sv.BoundingBoxAnnotator(color=COLORS)
         self.label_annotator = sv.LabelAnnotator(
             color=COLORS, text_color=sv.Color.BLACK
         )
+
+        self.detector = detector.result()
+        startup.mark("detector_ready")
+        # YOLO output of every detected frame, reused when the same video runs through the same model again
+        extra = {"model": "ultralytics", "runtime": self.detector.runtime, "image_size": self.detector.image_size}
+        if tiled:
+            extra["tiles"] = f"{tile_size}/{tile_overlap}"
+        self.cache = get_cache(cache_dir, source_video_path, [self.detector.model_path], confidence_threshold,
+                               iou_threshold, extra=extra, max_bytes=cache_max_bytes)
       
 
+    @classmethod
+    def run(cls, settings, no_of_vehicles_per_lane, green_lane):
+        """
+        Builds the processor from settings (the keyword arguments of __init__) and processes the video.
+        It is the target of the vision process, so the model is only ever loaded in that process
+        """
+        return cls(**settings).process_video(no_of_vehicles_per_lane, green_lane)
+
     def process_video(self, no_of_vehicles_per_lane, green_lane):
+        writer = metrics.start_metrics("aerial", metrics_dir, metrics_interval)
+        try:
+            if self.pipelined:
+                return self.process_video_pipelined(no_of_vehicles_per_lane, green_lane)
+            return self.process_video_sequential(no_of_vehicles_per_lane, green_lane)
+        finally:
+            if writer is not None:
+                writer.stop()
+
+    def process_video_sequential(self, no_of_vehicles_per_lane, green_lane):
+        """
+        Runs decoding, inference, annotation and display/encoding one after the other on this thread.
+        Headless without a target video only the counts are worked out, nothing is drawn
+        """
         frame_generator = sv.get_video_frames_generator(
             source_path=self.source_video_path
         )
@@ -81,32 +198,111 @@ class VideoProcessor:
                 for frame in tqdm(frame_generator, total=self.video_info.total_frames):
                     annotated_frame, vehicle_per_zone = self.process_frame(frame)
                     no_of_vehicles_per_lane.update(vehicle_per_zone)
-                    cv2.imshow("Processed Video", annotated_frame)
-                    if cv2.waitKey(1) == 27:
-                        green_lane.value = "Error"
+                    if not self.show(annotated_frame, green_lane):
                         break
                     sink.write_frame(annotated_frame)
-        else:
+        elif self.preview:
             for frame in tqdm(frame_generator, total=self.video_info.total_frames):
                 annotated_frame, vehicle_per_zone = self.process_frame(frame)
                 no_of_vehicles_per_lane.update(vehicle_per_zone)
-                cv2.imshow("Processed Video", annotated_frame)
-                if cv2.waitKey(1) == 27:
-                    green_lane.value = "Error"
+                if not self.show(annotated_frame, green_lane):
                     break
+        else:
+            for frame in tqdm(frame_generator, total=self.video_info.total_frames):
+                _, vehicle_per_zone = self.detect_frame(frame)
+                no_of_vehicles_per_lane.update(vehicle_per_zone)
+        if self.preview:
             cv2.destroyAllWindows()
+        logger.info("Detection stats: %s", self.stats())
+        if self.cache is not None:
+            self.cache.flush()
+
+    def process_video_pipelined(self, no_of_vehicles_per_lane, green_lane):
+        """
+        Same as process_video, but decoding, inference, annotation and display/encoding run
+        as concurrent stages, see pipeline.Pipeline. Decoding and encoding mostly release the GIL,
+        so they overlap with inference instead of adding to it.
+        Args:
+            no_of_vehicles_per_lane: A shared dictionary containing the number of vehicles in each lane
+            green_lane: A shared variable containing the lane that has the green light
+        Returns:
+            The busy/idle time of every stage
+        """
+        frame_generator = sv.get_video_frames_generator(
+            source_path=self.source_video_path
+        )
+        progress = tqdm(total=self.video_info.total_frames)
+
+        def infer(frame):
+            detections, vehicles_per_zone = self.detect_frame(frame)
+            # counts go out as soon as they are known, not once the frame is displayed
+            no_of_vehicles_per_lane.update(vehicles_per_zone)
+            return frame, detections, vehicles_per_zone
+
+        def annotate(item):
+            frame, detections, vehicles_per_zone = item
+            return self.annotate_frame(frame, detections, vehicles_per_zone)
+
+        def show(item, sink=None):
+            progress.update(1)
+            if not self.render:
+                return True
+            annotated_frame, vehicle_per_zone = item
+            if not self.show(annotated_frame, green_lane):
+                return False
+            if sink is not None:
+                sink.write_frame(annotated_frame)
+            return True
+
+        # headless without a target video there is nothing to annotate, the frames stop after inference
+        stages = [Stage("infer", infer)]
+        if self.render:
+            stages.append(Stage("annotate", annotate))
+        try:
+            if self.target_video_path:
+                with sv.VideoSink(self.target_video_path, self.video_info) as sink:
+                    pipeline = Pipeline(frame_generator, stages, lambda item: show(item, sink), self.queue_size,
+                                        name="aerial_pipeline")
+                    report = pipeline.run()
+            else:
+                pipeline = Pipeline(frame_generator, stages, show, self.queue_size, name="aerial_pipeline")
+                report = pipeline.run()
+        finally:
+            progress.close()
+            if self.preview:
+                cv2.destroyAllWindows()
+        logger.info("Pipeline stages:\n%s", format_report(report))
+        logger.info("Detection stats: %s", self.stats())
+        if self.cache is not None:
+            self.cache.flush()
+        return report
+
+    def show(self, annotated_frame: np.ndarray, green_lane) -> bool:
+        """
+        Shows the frame in the preview window, returns False once Esc is pressed
+        """
+        if not self.preview:
+            return True
+        cv2.imshow("Processed Video", annotated_frame)
+        if cv2.waitKey(1) == 27:
+            green_lane.value = "Error"
+            return False
+        return True
 
     def annotate_frame(
         self, frame: np.ndarray, detections: sv.Detections, vehicles_per_zone: Dict[str, int]
     ) ->Tuple[np.ndarray, Dict[str, int]]:
-        annotated_frame = frame.copy()
-        for i, (zone_in, zone_out) in enumerate(zip(self.zones_in, self.zones_out)):
-            annotated_frame = sv.draw_polygon(
-                annotated_frame, zone_in.polygon, COLORS.colors[i]
-            )
-            annotated_frame = sv.draw_polygon(
-                annotated_frame, zone_out.polygon, COLORS.colors[i]
-            )
+        """
+        Draws the zones, lane counts and tracks into the frame itself, the frame is not copied
+        """
+        with self.stage_seconds["annotate"].time():
+            return self._annotate_frame(frame, detections, vehicles_per_zone)
+
+    def _annotate_frame(
+        self, frame: np.ndarray, detections: sv.Detections, vehicles_per_zone: Dict[str, int]
+    ) ->Tuple[np.ndarray, Dict[str, int]]:
+        annotated_frame = self.zone_overlay.draw(frame)
+        for i in range(len(ZONE_IN_POLYGONS)):
             cv2.putText(annotated_frame,
                         f"lane{i} vehicles: {vehicles_per_zone[f'lane{i}']}",
                         (10, 30 + i * 30),
@@ -124,28 +320,107 @@ class VideoProcessor:
         return annotated_frame, vehicles_per_zone
 
     def process_frame(self, frame: np.ndarray) -> np.ndarray:
-        results = self.model(
-            frame, verbose=False, conf=self.conf_threshold, iou=self.iou_threshold
-        )[0]
-        detections = sv.Detections.from_ultralytics(results)
-        detections.class_id = np.zeros(len(detections))
-        detections = self.tracker.update_with_detections(detections)
-
-        detections_in_zones = []
-        detections_out_zones = []
-        y = 0
+        detections, vehicles_per_zone = self.detect_frame(frame)
+        return self.annotate_frame(frame, detections, vehicles_per_zone)
+
+    def detect_frame(self, frame: np.ndarray) -> Tuple[sv.Detections, Dict[str, int]]:
+        start = time.perf_counter()
+        frame_index = self.frame_index
+        self.frame_index += 1
+        region = None
+        if self.motion_gate is not None:
+            region = self.motion_gate.check(frame)
+            if region is None and self.last_result is not None:
+                self.frames_counter["static"].inc()
+                return self.last_result
+        detected = self.cadence.should_detect()
+        if detected:
+            tracked = self.predictor.last_detections
+            if region is not None and not region_covers(region, tracked.get_anchors_coordinates(sv.Position.CENTER)):
+                # vehicles waiting outside the region that moved would be lost, detect the whole frame
+                region = None
+            with self.stage_seconds["detect"].time():
+                detections = self.detect_yolo(frame, frame_index, region)
+            track_start = time.perf_counter()
+            detections.class_id = np.zeros(len(detections), dtype=int)
+            detection_count = len(detections)
+            detections = self.tracker.update_with_detections(detections)
+            # ByteTrack only returns the detections it matched to a track
+            matched_count = len(detections)
+            self.predictor.update(detections, frame_index)
+        else:
+            track_start = time.perf_counter()
+            detections = self.predictor.predict(frame_index)
+        count_start = time.perf_counter()
+        self.stage_seconds["track"].observe(count_start - track_start)
+        self.frames_counter["detected" if detected else "predicted"].inc()
+
+        # every detection is put in its lane with one lookup in the precomputed zone raster
+        assignment = self.zone_index.assign(detections)
         vehicles_per_zone = {}
+        for y, count in enumerate(assignment.counts.tolist()):
+            vehicles_per_zone[f"lane{y}"] = count
+            self.lane_vehicles[y].set(count)
+        logger.debug("Vehicles per zone: %s", vehicles_per_zone)
+        self.stage_seconds["count"].observe(time.perf_counter() - count_start)
+
+        detections = detections[assignment.in_zone]
 
-        for zone_in in self.zones_in:
-            detections_in_zone = detections[zone_in.trigger(detections=detections)]
-            detections_in_zones.append(detections_in_zone)
-            print(f"Zone {y} in: {len(detections_in_zone)}")
-            vehicles_per_zone[f"lane{y}"] = len(detections_in_zone)
-            y += 1
+        if detected:
+            self.cadence.record_detection(time.perf_counter() - start, detection_count, matched_count)
+            if self.motion_gate is not None:
+                self.motion_gate.record_detection(time.perf_counter() - start)
+        else:
+            self.cadence.record_prediction(time.perf_counter() - start)
+        self.last_result = (detections, vehicles_per_zone)
+        startup.mark("first_counts")
+        return detections, vehicles_per_zone
+
+    def detect_yolo(self, frame: np.ndarray, frame_index: int, region=None) -> sv.Detections:
+        """
+        Runs YOLO on the frame, or on the region of it where the motion gate saw something move,
+        and returns the detections in frame coordinates. Frames already in the cache are not detected again.
+        With tiled inference the tiles in the region go through YOLO as one batch
+        """
+        if self.cache is not None:
+            cached = self.cache.get(frame_index)
+            if cached is not None:
+                class_ids, scores, boxes = cached
+                return sv.Detections(xyxy=boxes.astype(np.float32), confidence=scores, class_id=class_ids)
+        if self.tile_grid is not None:
+            detections = self.detect_tiles(frame, region)
+            whole_frame = region is None or len(self.tile_grid.tiles_in(region)) == len(self.tile_grid.tiles)
+        else:
+            crop, offset = (frame, (0, 0)) if region is None else crop_to_region(frame, region)
+            detections = to_detections(*self.detector.detect(crop))
+            detections.xyxy = detections.xyxy + np.array([offset[0], offset[1], offset[0], offset[1]])
+            whole_frame = crop is frame
+        # only whole frames are cached, the detections of a crop miss everything outside of it
+        if self.cache is not None and whole_frame:
+            self.cache.put(frame_index, detections.class_id, detections.confidence, detections.xyxy)
+        return detections
 
-        detections = sv.Detections.merge(detections_in_zones)
+    def detect_tiles(self, frame: np.ndarray, region=None) -> sv.Detections:
+        """
+        Runs YOLO on the tiles of the frame that overlap region and merges the vehicles found
+        in more than one tile
+        """
+        tiles = self.tile_grid.tiles_in(region)
+        if len(tiles) == 0:
+            return sv.Detections.empty()
+        results = self.detector.detect_batch(self.tile_grid.slice(frame, tiles))
+        return merge_tiles([to_detections(*result) for result in results], tiles)
 
-        return self.annotate_frame(frame, detections, vehicles_per_zone)
+    def stats(self) -> Dict[str, dict]:
+        """
+        Returns the detection cadence, detector, motion gating and detection cache counters
+        """
+        stats = {"cadence": self.cadence.stats(), "detector": self.detector.stats()}
+        if self.motion_gate is not None:
+            stats["motion_gate"] = self.motion_gate.stats()
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
 
 
 
@@ -4,11 +4,55 @@ target_video_path="data/traffic_analysis_result1.mov" # make this into this targ
 
 confidence_threshold=0.5 # do not touch
 iou_threshold=0.7 # do not touch
+headless=False # no preview windows and no drawing, the drone frames are only annotated when target_video_path records them
+pipelined=True # run decode, inference, annotation and display/encoding of the drone version as concurrent stages
+pipeline_queue_size=4 # frames held between two stages
+aerial_tiling=False # run YOLO on overlapping full resolution tiles around the zones, finds smaller vehicles at more cost
+aerial_tile_size=640 # side of a tile in pixels
+aerial_tile_overlap=0.2 # fraction of a tile shared with its neighbours
+detection_interval_aerial=1 # run YOLO every N frames of the drone video, the tracks are predicted in between (1 = every frame). Check the count error with benchmarks/detection_cadence.py before raising it
 weights_path="dnn_model/yolov4.weights" # do not touch
 cfg_path="dnn_model/yolov4.cfg" # do not touch
+dnn_backend="cpu" # "cpu", "opencl", "cuda" or "cuda_fp16". cuda falls back to cpu if no GPU is found
+detector_backend="opencv" # detector of the 4 camera mode: "opencv", "torch", "onnx" or "onnx_int8", see detectors.py
+detector_model_path=None # None runs YOLOv4 (weights_path, cfg_path) on opencv, an ultralytics model such as "yolov8n.pt" runs on every backend
+aerial_detector_backend="torch" # detector of the drone version: "torch", "opencv", "onnx" or "onnx_int8" (exported next to source_weights_path)
+detector_threads=None # CPU threads of the detector, None leaves it to the backend
+detector_input_size=None # side of the model input, None keeps 608 for YOLOv4 and 640 for ultralytics models
+batched_inference=True # run the four lanes through YOLOv4 in one forward pass instead of one after the other
 
 camera0="los_angeles.mp4" # this represent the paths to the cameras you want to use, for the code that uses 4 camera or 
 # or you can provide a video path to test it just as i have done.
 camera1="traffic_stop.mp4"
 camera2="traffic_stop.mp4"
 camera3="traffic_stop.mp4"
+capture_policy="latest" # "latest" only keeps the newest frame of each camera, "queue" keeps up to capture_buffer_size frames
+capture_buffer_size=4
+detection_interval_4c=1 # run YOLOv4 every N frames of each camera, the tracker predicts the frames in between. Same check as detection_interval_aerial
+tracker_backend="deepsort" # tracker of the 4 camera version, "bytetrack" only matches on motion and skips the appearance CNN DeepSort runs on every box, see trackers.py
+max_detection_interval=6 # upper bound for N when it is adjusted at runtime
+target_frame_time=None # seconds per frame to aim for, e.g. 1/15. When set N is adjusted from the measured latency
+motion_gating=True # skip the detector on lanes where nothing moves and only detect inside the region that moved
+motion_min_area=0.002 # fraction of the (downscaled) frame that has to change for a lane to count as moving
+green_time_per_vehicle=100 # seconds of green light for every vehicle waiting in the lane
+default_green_time=100 # seconds of green light for a lane with no vehicles
+count_trace_path=None # e.g. "data/counts.jsonl" records the lane counts so the timing can be replayed, see benchmarks/timing_simulation.py
+count_trace_interval=1.0 # seconds between two samples of the recorded counts
+detection_cache_dir="data/detection_cache" # detections of video files are kept here and reused on the next run, None turns it off
+detection_cache_max_bytes=2 * 1024 ** 3 # the least recently used videos are evicted once the cache is bigger than this
+log_level="INFO" # "DEBUG" also logs the per frame counts and tracks, which costs time under load
+metrics_port=9108 # metrics of every process on http://127.0.0.1:9108/metrics, None turns the endpoint off
+metrics_dir="data/metrics" # every process writes a metrics snapshot here, None turns metrics snapshots off
+metrics_interval=5.0 # seconds between two snapshots
+max_lane_count_error=1.0 # mean lane count error allowed against detecting every frame, see benchmarks/detection_cadence.py
+lane_groups=None # None runs all lanes in one process, [["lane0"], ["lane1"], ["lane2"], ["lane3"]] gives every lane its own
+# worker process and [["lane0", "lane1"], ["lane2", "lane3"]] shares a worker between two lanes
+inference_server_address=None # e.g. "127.0.0.1:9200" runs the detectors on the inference server started with "python main.py --mode server"
+inference_server_authkey=None # shared secret of the inference server and the pipelines using it, None reads it from the TRAFFIC_INFERENCE_AUTHKEY environment variable. There is no default, the server does not start without one
+inference_max_batch=8 # most frames the inference server runs through a model in one call
+inference_max_delay=0.01 # seconds a frame waits on the inference server for others to join its batch
+compute_fps_budget=None # most frames per second the 4 camera version runs through the detector over all lanes, None only weights them by signal state
+green_lane_weight=0.25 # fraction of its frames the green lane is detected on, see compute_budget.py
+served_lane_weight=0.25 # same for the red lanes that were already green in the current cycle
+waiting_lane_weight=0.5 # same for the red lanes still waiting for green, they get every frame once the next decision is decision_lookahead seconds away
+decision_lookahead=10.0
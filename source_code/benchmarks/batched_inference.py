@@ -0,0 +1,67 @@
+"""
+Compares batched and sequential YOLOv4 inference for the 4 camera mode.
+
+The same four frames (one per lane, read from los_angeles.mp4) are pushed through
+ObjectDetection.detect one after the other and through ObjectDetection.detect_batch
+in one forward pass, and the lane frames per second of both are printed.
+
+Run it from the source_code folder:
+    python -m benchmarks.batched_inference --cycles 20
+"""
+import argparse
+import time
+import cv2
+from arguments import camera0, weights_path, cfg_path, dnn_backend
+from object_detection import get_detector
+
+
+def read_lane_frames(video_path, lanes=4):
+    """
+    Reads one frame per lane from the video, every lane gets a different frame
+    """
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < lanes:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if len(frames) < lanes:
+        raise RuntimeError(f"Could not read {lanes} frames from {video_path}")
+    return frames
+
+
+def benchmark(detector, frames, cycles):
+    """
+    Returns the lane frames per second of the sequential and of the batched path
+    """
+    start = time.perf_counter()
+    for _ in range(cycles):
+        for frame in frames:
+            detector.detect(frame)
+    sequential = cycles * len(frames) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(cycles):
+        detector.detect_batch(frames)
+    batched = cycles * len(frames) / (time.perf_counter() - start)
+    return sequential, batched
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batched vs sequential YOLOv4 inference")
+    parser.add_argument("--video", default=camera0, help="Video used for the lane frames", type=str)
+    parser.add_argument("--cycles", default=20, help="Number of 4 lane cycles to time", type=int)
+    parser.add_argument("--backend", default=dnn_backend, help="OpenCV DNN backend", type=str)
+    args = parser.parse_args()
+
+    detector = get_detector(weights_path=weights_path, cfg_path=cfg_path, backend=args.backend)
+    frames = read_lane_frames(args.video)
+    # One untimed round of the batched path so its buffers are allocated too
+    detector.detect_batch(frames)
+
+    sequential, batched = benchmark(detector, frames, args.cycles)
+    print(f"sequential: {sequential:.2f} lane frames/s ({sequential / len(frames):.2f} cycles/s)")
+    print(f"batched:    {batched:.2f} lane frames/s ({batched / len(frames):.2f} cycles/s)")
+    print(f"speedup:    {batched / sequential:.2f}x")
@@ -0,0 +1,87 @@
+"""
+Replays lane counts through the traffic light scheduler with the vision side simulated at a fixed frame
+rate, to see how many detector frames the signal aware compute budget saves and how fresh the counts
+still are when the timing process decides.
+
+Every capture cycle the lanes picked by compute_budget.ComputeBudget publish their true count from the
+trace (a synthetic day, see benchmarks/timing_simulation.py), the others keep their last one. At every
+decision the counts of the lanes competing for green are compared with the true ones. Setups:
+    every frame: every lane on every frame
+    skip green:  every lane but the green one, what four_c meant to do
+    budget:      the weights from arguments.py, without and with --fps-budget
+
+Run it from the source_code folder:
+    python -m benchmarks.compute_budget --hours 2 --fps 15 --fps-budget 20
+"""
+import argparse
+import numpy as np
+from benchmarks.timing_simulation import synthetic_trace
+from compute_budget import ComputeBudget
+from scheduler import LANES, GreenValue, TrafficLightScheduler, VirtualClock
+from arguments import green_lane_weight, served_lane_weight, waiting_lane_weight, decision_lookahead
+
+
+def replay(truth, fps, budget=None, skip_green=False, green_time_per_vehicle=2, default_green_time=10):
+    """
+    Returns the detector frames per second, the mean age of the counts the decisions were made on
+    and their mean absolute error against the true counts
+    """
+    clock = VirtualClock()
+    counts = {}
+    green = GreenValue()
+    scheduler = TrafficLightScheduler(counts, green, clock=clock, green_time_per_vehicle=green_time_per_vehicle,
+                                      default_green_time=default_green_time, verbose=False, publish_metrics=False)
+    last_seen = dict.fromkeys(LANES, 0.0)
+    next_decision = 0.0
+    processed = 0
+    ages, errors = [], []
+    cycles = int(len(truth) * fps)
+    for cycle in range(cycles):
+        now = cycle / fps
+        true_counts = truth[int(now)]
+        if now >= next_decision:
+            # the lanes that have not been green in the cycle are the ones the decision is made between
+            competing = [lane for lane in LANES if lane not in scheduler.served] or list(LANES)
+            for lane in competing:
+                if lane in counts:
+                    ages.append(now - last_seen[lane])
+                    errors.append(abs(counts[lane] - true_counts[lane]))
+            clock.time = now
+            scheduler.step()
+            next_decision = clock.time
+        if budget is not None:
+            budget.clock = lambda: now
+            lanes = budget.select(list(LANES), green.phase())
+        elif skip_green:
+            lanes = [lane for lane in LANES if lane != green.value]
+        else:
+            lanes = LANES
+        for lane in lanes:
+            counts[lane] = true_counts[lane]
+            last_seen[lane] = now
+        processed += len(lanes)
+    return processed / (cycles / fps), float(np.mean(ages)), float(np.mean(errors))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detector frames against count freshness of the compute budget")
+    parser.add_argument("--hours", default=2.0, type=float, help="Hours of synthetic traffic")
+    parser.add_argument("--fps", default=15.0, type=float, help="Frame rate of every camera")
+    parser.add_argument("--fps-budget", default=20.0, type=float, help="Budget of the last setup")
+    args = parser.parse_args()
+
+    trace = synthetic_trace(args.hours * 3600, 1.0, [0.05, 0.1, 0.02, 0.08], np.random.default_rng(0))
+    truth = [counts for _, counts in trace]
+    weights = {"green_weight": green_lane_weight, "served_weight": served_lane_weight,
+               "waiting_weight": waiting_lane_weight, "lookahead": decision_lookahead}
+    setups = {
+        "every frame": {},
+        "skip green": {"skip_green": True},
+        "budget": {"budget": ComputeBudget(LANES, **weights)},
+        f"budget {args.fps_budget:g} fps": {"budget": ComputeBudget(LANES, fps_budget=args.fps_budget, **weights)},
+    }
+    print(f"{args.hours:g} h at {args.fps:g} fps per camera")
+    print(f"{'setup':<18}{'frames/s':>10}{'count age s':>13}{'count error':>13}")
+    for name, setup in setups.items():
+        fps, age, error = replay(truth, args.fps, **setup)
+        print(f"{name:<18}{fps:>10.1f}{age:>13.2f}{error:>13.3f}")
@@ -0,0 +1,96 @@
+"""
+Checks how far the lane counts drift when the detector only runs every N frames.
+
+Both pipelines are run twice over the start of their bundled video, once detecting every
+frame and once with the detection interval of arguments.py (or --interval, 2 while that is 1),
+and the per frame lane counts are compared. The run fails when the mean absolute lane count error is above
+arguments.max_lane_count_error.
+
+Run it from the source_code folder:
+    python -m benchmarks.detection_cadence --frames 300
+"""
+import argparse
+import sys
+import time
+import cv2
+import numpy as np
+from deep_sort_realtime.deepsort_tracker import DeepSort
+from arguments import (source_video_path, source_weights_path, confidence_threshold, iou_threshold, camera0,
+                       weights_path, cfg_path, dnn_backend, detection_interval_aerial, detection_interval_4c,
+                       max_lane_count_error)
+from cadence import DetectionCadence
+
+
+def aerial_counts(interval, frames):
+    """
+    Returns the lane counts of every frame of the drone video and the time it took
+    """
+    import supervision as sv
+    from aerial import VideoProcessor
+
+    processor = VideoProcessor(
+        source_weights_path=source_weights_path,
+        source_video_path=source_video_path,
+        confidence_threshold=confidence_threshold,
+        iou_threshold=iou_threshold,
+        detection_interval=interval,
+    )
+    counts = []
+    start = time.perf_counter()
+    for frame in sv.get_video_frames_generator(source_path=source_video_path, end=frames):
+        _, vehicles_per_zone = processor.detect_frame(frame)
+        counts.append([vehicles_per_zone[lane] for lane in sorted(vehicles_per_zone)])
+    return np.array(counts), time.perf_counter() - start
+
+
+def four_camera_counts(interval, frames):
+    """
+    Returns the count of vehicles entering the intersection on every frame of camera0 and the time it took
+    """
+    from helper_func import ObjectTracking
+    from object_detection import get_detector
+
+    detector = get_detector(weights_path=weights_path, cfg_path=cfg_path, backend=dnn_backend)
+    ob = ObjectTracking(detector=detector)
+    trackers = {"lane0": DeepSort()}
+    cadences = {"lane0": DetectionCadence(interval=interval)}
+    cap = cv2.VideoCapture(camera0)
+    counts = []
+    start = time.perf_counter()
+    while len(counts) < frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        outputs = ob.process_lanes(frames={"lane0": frame}, trackers=trackers, list=detector.classes,
+                                   cadences=cadences)
+        counts.append([len(outputs["lane0"][1])])
+    cap.release()
+    return np.array(counts), time.perf_counter() - start
+
+
+def compare(name, run, interval, frames):
+    full, full_time = run(1, frames)
+    sparse, sparse_time = run(interval, frames)
+    length = min(len(full), len(sparse))
+    error = np.abs(full[:length] - sparse[:length])
+    mean_error = float(error.mean()) if length else 0.0
+    print(f"{name}: every frame {length / full_time:.2f} fps, every {interval} frames {length / sparse_time:.2f} fps")
+    print(f"{name}: mean lane count error {mean_error:.3f}, max {int(error.max()) if length else 0}, "
+          f"allowed {max_lane_count_error}")
+    return mean_error <= max_lane_count_error
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lane count error of the detect every N frames mode")
+    parser.add_argument("--frames", default=300, help="Frames of each video to compare", type=int)
+    parser.add_argument("--mode", default="both", choices=["aerial", "4C", "both"], type=str)
+    parser.add_argument("--interval", default=None, help="Detection interval to check, see above", type=int)
+    args = parser.parse_args()
+
+    passed = True
+    if args.mode in ("aerial", "both"):
+        passed &= compare("aerial", aerial_counts, args.interval or max(detection_interval_aerial, 2), args.frames)
+    if args.mode in ("4C", "both"):
+        passed &= compare("4C", four_camera_counts, args.interval or max(detection_interval_4c, 2), args.frames)
+    print("PASS" if passed else "FAIL")
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,127 @@
+"""
+Compares the accuracy and latency of the detector backends on the bundled videos, on the CPU.
+
+Every backend runs the same model on the same frames: the drone model (source_weights_path) on
+the drone video and, when detector_model_path or --camera-model is set, that model on the first
+camera video. The first backend of each case is the reference, the others are scored against it:
+precision and recall of their boxes at IoU 0.5 and the mean difference in vehicles per frame.
+YOLOv4 on OpenCV DNN is timed on the camera video as well, as the baseline of the 4 camera mode.
+A backend that cannot run here (e.g. onnxruntime not installed) is reported and skipped.
+
+Run it from the source_code folder:
+    python -m benchmarks.detectors --frames 50 --threads 4
+    python -m benchmarks.detectors --camera-model yolov8n.pt --backends torch onnx onnx_int8
+"""
+import os
+
+# CPU only, this has to happen before torch or ultralytics get imported
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import argparse
+import time
+import cv2
+import numpy as np
+from detectors import DETECTOR_BACKENDS, load_detector
+from object_detection import VEHICLE_CLASSES
+from arguments import (source_video_path, source_weights_path, confidence_threshold, iou_threshold, camera0,
+                       weights_path, cfg_path, detector_model_path, detector_input_size)
+
+
+def read_frames(video_path, count):
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        raise RuntimeError(f"Could not read {video_path}")
+    return frames
+
+
+def box_iou(boxes, others):
+    """
+    IoU of every pair of (x, y, w, h) boxes
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 1, 4)
+    others = np.asarray(others, dtype=np.float64).reshape(1, -1, 4)
+    width = (np.minimum(boxes[..., 0] + boxes[..., 2], others[..., 0] + others[..., 2])
+             - np.maximum(boxes[..., 0], others[..., 0])).clip(0)
+    height = (np.minimum(boxes[..., 1] + boxes[..., 3], others[..., 1] + others[..., 3])
+              - np.maximum(boxes[..., 1], others[..., 1])).clip(0)
+    intersection = width * height
+    union = boxes[..., 2] * boxes[..., 3] + others[..., 2] * others[..., 3] - intersection
+    return intersection / np.maximum(union, 1e-9)
+
+
+def run_backend(detector, frames, classes):
+    """
+    Returns the output and the latency of every frame
+    """
+    outputs, latencies = [], []
+    for frame in frames:
+        start = time.perf_counter()
+        outputs.append(detector.detect(frame, classes=classes))
+        latencies.append(time.perf_counter() - start)
+    return outputs, np.asarray(latencies)
+
+
+def agreement(reference, outputs, threshold=0.5):
+    """
+    Returns precision and recall of outputs against reference and the mean difference in boxes per frame
+    """
+    matched = found = expected = 0
+    count_error = []
+    for (_, _, reference_boxes), (_, _, boxes) in zip(reference, outputs):
+        expected += len(reference_boxes)
+        found += len(boxes)
+        count_error.append(abs(len(boxes) - len(reference_boxes)))
+        if len(reference_boxes) and len(boxes):
+            matched += int((box_iou(reference_boxes, boxes).max(axis=1) >= threshold).sum())
+    return matched / max(found, 1), matched / max(expected, 1), float(np.mean(count_error))
+
+
+def run_case(name, model_path, video_path, backends, args, classes=None, cfg=None):
+    frames = read_frames(video_path, args.frames)
+    print(f"{name}: {model_path} on {video_path}, {len(frames)} frames")
+    print(f"  {'backend':<11}{'load s':>8}{'p50 ms':>9}{'p95 ms':>9}{'fps':>8}{'precision':>11}{'recall':>8}"
+          f"{'count err':>11}")
+    reference = None
+    for backend in backends:
+        try:
+            detector = load_detector(backend, model_path, cfg, input_size=args.input_size, threads=args.threads,
+                                     conf_threshold=confidence_threshold, nms_threshold=iou_threshold,
+                                     calibration_video=video_path)
+            outputs, latencies = run_backend(detector, frames, classes)
+        except Exception as error:
+            print(f"  {backend:<11}skipped, {type(error).__name__}: {error}")
+            continue
+        p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+        line = f"  {backend:<11}{detector.load_time:>8.2f}{p50:>9.1f}{p95:>9.1f}{len(latencies) / latencies.sum():>8.1f}"
+        if reference is None:
+            reference = outputs
+            line += f"{'reference':>11}"
+        else:
+            precision, recall, count_error = agreement(reference, outputs)
+            line += f"{precision:>11.1%}{recall:>8.1%}{count_error:>11.2f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy and latency of the detector backends")
+    parser.add_argument("--frames", default=50, help="Frames per case", type=int)
+    parser.add_argument("--backends", default=list(DETECTOR_BACKENDS), nargs="+", help="The first one is the reference")
+    parser.add_argument("--threads", default=None, help="CPU threads of every backend", type=int)
+    parser.add_argument("--input-size", default=detector_input_size, type=int)
+    parser.add_argument("--aerial-video", default=source_video_path, type=str)
+    parser.add_argument("--aerial-model", default=source_weights_path, type=str)
+    parser.add_argument("--camera-video", default=camera0, type=str)
+    parser.add_argument("--camera-model", default=detector_model_path, help="Ultralytics model of the 4 camera mode")
+    args = parser.parse_args()
+
+    run_case("aerial", args.aerial_model, args.aerial_video, args.backends, args)
+    run_case("4c YOLOv4", weights_path, args.camera_video, ["opencv"], args, VEHICLE_CLASSES, cfg_path)
+    if args.camera_model:
+        run_case("4c", args.camera_model, args.camera_video, args.backends, args, VEHICLE_CLASSES)
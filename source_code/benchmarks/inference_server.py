@@ -0,0 +1,129 @@
+"""
+Compares running many intersections on one host with a detector per pipeline against sharing one
+inference server between them.
+
+Every simulated intersection is its own process reading frames of the same video and detecting them
+one at a time, the way a pipeline does. With "local" every process loads its own copy of the model,
+with "server" they all use one InferenceServer, once per --max-batch. For every setup the aggregate
+frames per second, the per call latency and the memory (RSS) of all the processes together are printed.
+
+Run it from the source_code folder:
+    python -m benchmarks.inference_server --intersections 8 --frames 30
+    python -m benchmarks.inference_server --weights dnn_model/yolov4-tiny.weights --cfg dnn_model/yolov4-tiny.cfg
+"""
+import argparse
+import multiprocessing as mp
+import os
+import secrets
+import tempfile
+import time
+import cv2
+import numpy as np
+from detectors import load_detector
+from inference_server import RemoteDetector, serve
+from object_detection import VEHICLE_CLASSES
+from arguments import camera0, weights_path, cfg_path, dnn_backend
+
+# the servers of the benchmark only live as long as it, they get a throwaway secret
+AUTHKEY = secrets.token_hex(16)
+
+
+def rss_mb(pid="self"):
+    """
+    Resident memory of a process in MB, read from /proc so Linux only
+    """
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+
+def intersection(spec, address, authkey, video_path, frames, barrier, results):
+    """
+    One simulated intersection, detects its frames with a local detector or through the server
+    """
+    cap = cv2.VideoCapture(video_path)
+    images = []
+    while len(images) < frames:
+        ret, frame = cap.read()
+        if not ret:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            continue
+        images.append(frame)
+    cap.release()
+    if address is None:
+        detector = load_detector(**spec)
+    else:
+        detector = RemoteDetector(address, authkey=authkey, **spec)
+    barrier.wait()
+    latencies = []
+    for image in images:
+        start = time.perf_counter()
+        detector.detect(image, classes=VEHICLE_CLASSES)
+        latencies.append(time.perf_counter() - start)
+    results.put((latencies, rss_mb()))
+    # keep the process (and its memory) around until everyone is done
+    barrier.wait()
+    if address is not None:
+        detector.close()
+
+
+def run(spec, address, args, context):
+    barrier = context.Barrier(args.intersections + 1)
+    results = context.Queue()
+    processes = [context.Process(target=intersection,
+                                 args=(spec, address, AUTHKEY, args.video, args.frames, barrier, results))
+                 for _ in range(args.intersections)]
+    for process in processes:
+        process.start()
+    barrier.wait()
+    start = time.perf_counter()
+    outputs = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - start
+    barrier.wait()
+    for process in processes:
+        process.join()
+    latencies = np.concatenate([latency for latency, _ in outputs])
+    return len(latencies) / elapsed, np.percentile(latencies, 50) * 1000, sum(rss for _, rss in outputs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detector per intersection against a shared inference server")
+    parser.add_argument("--intersections", default=4, type=int)
+    parser.add_argument("--frames", default=30, help="Frames per intersection", type=int)
+    parser.add_argument("--video", default=camera0, type=str)
+    parser.add_argument("--weights", default=weights_path, type=str)
+    parser.add_argument("--cfg", default=cfg_path, type=str)
+    parser.add_argument("--backend", default="opencv", help="See detectors.DETECTOR_BACKENDS", type=str)
+    parser.add_argument("--max-batch", default=[1, 8], nargs="+", type=int, help="Server batch sizes to try")
+    parser.add_argument("--max-delay", default=0.01, type=float)
+    args = parser.parse_args()
+
+    spec = {"backend": args.backend, "model_path": os.path.abspath(args.weights), "dnn_target": dnn_backend,
+            "cfg_path": os.path.abspath(args.cfg) if args.weights.endswith(".weights") else None,
+            "calibration_video": os.path.abspath(args.video)}
+    context = mp.get_context("spawn")
+    print(f"{args.intersections} intersections, {args.frames} frames each, {os.path.basename(args.weights)}")
+    print(f"{'setup':<18}{'fps':>8}{'p50 ms':>9}{'RSS MB':>9}")
+    fps, p50, rss = run(spec, None, args, context)
+    print(f"{'local':<18}{fps:>8.1f}{p50:>9.1f}{rss:>9.0f}")
+
+    with tempfile.TemporaryDirectory() as folder:
+        for max_batch in args.max_batch:
+            address = os.path.join(folder, f"server-{max_batch}.sock")
+            server = context.Process(target=serve, args=(address, AUTHKEY, max_batch, args.max_delay,
+                                                         [spec]))
+            server.start()
+            while not os.path.exists(address):
+                if not server.is_alive():
+                    raise RuntimeError("The inference server did not start")
+                time.sleep(0.05)
+            fps, p50, rss = run(spec, address, args, context)
+            server_rss = rss_mb(server.pid)
+            server.terminate()
+            server.join()
+            print(f"{f'server batch {max_batch}':<18}{fps:>8.1f}{p50:>9.1f}{rss + server_rss:>9.0f}")
@@ -0,0 +1,99 @@
+"""
+Compares the old and the vehicle only post-processing of the YOLOv4 DNN path.
+
+The old path lets cv2.dnn_DetectionModel decode and NMS all 80 classes and then keeps the
+vehicles one box at a time in Python. The new one decodes the raw output layers itself, drops every
+non vehicle box before decoding and NMS and builds the DeepSort input from arrays.
+The output layers of every frame are computed once and both paths are timed from there, so the
+numbers are the post-processing only, then the full detect calls are timed as well.
+Both paths have to give the same DeepSort input.
+
+Run it from the source_code folder, a lower --conf gives more boxes per frame:
+    python -m benchmarks.postprocess --frames 50 --conf 0.3
+"""
+import argparse
+import time
+import cv2
+from arguments import camera0, weights_path, cfg_path, dnn_backend
+from object_detection import VEHICLE_CLASSES, decode_yolo_outputs, deepsort_detections, get_detector
+
+
+def old_vehicle_detections(class_ids, scores, boxes, names):
+    """
+    The per box loop ObjectTracking.vehicle_detections used before
+    """
+    detections = []
+    for box, class_id, score in zip(boxes, class_ids, scores):
+        if class_id in [1, 2, 3, 5]:
+            (x, y, w, h) = box
+            detections.append((([x, y, w, h]), score, names[class_id]))
+    return detections
+
+
+def same(old, new):
+    return len(old) == len(new) and all(
+        [int(v) for v in old_box] == new_box and abs(float(old_score) - new_score) < 1e-6 and old_name == new_name
+        for (old_box, old_score, old_name), (new_box, new_score, new_name) in zip(old, new))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vehicle only against all class YOLOv4 post-processing")
+    parser.add_argument("--video", default=camera0, type=str)
+    parser.add_argument("--frames", default=50, help="Frames to time", type=int)
+    parser.add_argument("--weights", default=weights_path, type=str)
+    parser.add_argument("--cfg", default=cfg_path, type=str)
+    parser.add_argument("--backend", default=dnn_backend, type=str)
+    parser.add_argument("--conf", default=None, help="Confidence threshold, the detector's own by default", type=float)
+    args = parser.parse_args()
+
+    detector = get_detector(weights_path=args.weights, cfg_path=args.cfg, backend=args.backend)
+    if args.conf is not None:
+        detector.confThreshold = args.conf
+    names = detector.classes
+    cap = cv2.VideoCapture(args.video)
+    frames = []
+    while len(frames) < args.frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+
+    outputs = []
+    for frame in frames:
+        blob = cv2.dnn.blobFromImage(frame, 1/255, (detector.image_size, detector.image_size), swapRB=False, crop=False)
+        detector.net.setInput(blob)
+        outputs.append(detector.net.forward(detector.output_layers))
+
+    old_time = new_time = 0.0
+    boxes = vehicles = agree = 0
+    for frame, output in zip(frames, outputs):
+        start = time.perf_counter()
+        result = decode_yolo_outputs(output, frame.shape, detector.confThreshold, detector.nmsThreshold)
+        old = old_vehicle_detections(*result, names)
+        old_time += time.perf_counter() - start
+        start = time.perf_counter()
+        new = deepsort_detections(*decode_yolo_outputs(output, frame.shape, detector.confThreshold,
+                                                       detector.nmsThreshold, VEHICLE_CLASSES), names)
+        new_time += time.perf_counter() - start
+        boxes += len(result[0])
+        vehicles += len(new)
+        agree += same(old, new)
+
+    start = time.perf_counter()
+    for frame in frames:
+        class_ids, scores, frame_boxes = detector.model.detect(frame, nmsThreshold=detector.nmsThreshold,
+                                                               confThreshold=detector.confThreshold)
+        old_vehicle_detections(class_ids, scores, frame_boxes, names)
+    old_full = time.perf_counter() - start
+    start = time.perf_counter()
+    for frame in frames:
+        deepsort_detections(*detector.detect(frame, classes=VEHICLE_CLASSES), names)
+    new_full = time.perf_counter() - start
+
+    count = max(len(frames), 1)
+    print(f"{len(frames)} frames, {boxes / count:.1f} boxes and {vehicles / count:.1f} vehicles per frame")
+    print(f"post-processing: all classes {old_time / count * 1000:.3f} ms, vehicles only {new_time / count * 1000:.3f} ms "
+          f"({old_time / max(new_time, 1e-9):.1f}x), same output on {agree}/{len(frames)} frames")
+    print(f"detect + DeepSort input: DetectionModel {old_full / count * 1000:.2f} ms, "
+          f"vehicles only {new_full / count * 1000:.2f} ms")
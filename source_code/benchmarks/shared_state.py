@@ -0,0 +1,55 @@
+"""
+Compares the per update latency of the Manager proxies main.py used to share the lane
+counts and the green lane with the shared memory IntersectionState that replaced them.
+
+Run it from the source_code folder:
+    python -m benchmarks.shared_state --iterations 10000
+"""
+import argparse
+import time
+from multiprocessing import Manager
+from shared_state import IntersectionState, LaneCounts, GreenLane, LANES
+
+
+def time_per_call(fn, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    return (time.perf_counter() - start) / iterations
+
+
+def benchmark(no_of_vehicles_per_lane, green_lane, iterations):
+    """
+    Times the operations the producers and timing do on every frame.
+    Returns a dictionary mapping each operation to its latency in microseconds
+    """
+    zone_counts = {lane: 0 for lane in LANES}
+    results = {
+        "set one lane": time_per_call(lambda i: no_of_vehicles_per_lane.__setitem__("lane0", i), iterations),
+        "update four lanes": time_per_call(lambda i: no_of_vehicles_per_lane.update(zone_counts), iterations),
+        "read one lane": time_per_call(lambda i: no_of_vehicles_per_lane["lane0"], iterations),
+        "copy all lanes": time_per_call(lambda i: no_of_vehicles_per_lane.copy(), iterations),
+        "read green lane": time_per_call(lambda i: green_lane.value, iterations),
+        "set green lane": time_per_call(lambda i: setattr(green_lane, "value", LANES[i % len(LANES)]), iterations),
+    }
+    return {operation: seconds * 1e6 for operation, seconds in results.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manager proxies vs shared memory intersection state")
+    parser.add_argument("--iterations", default=10000, help="Calls timed per operation", type=int)
+    args = parser.parse_args()
+
+    with Manager() as manager:
+        manager_results = benchmark(manager.dict(), manager.Value(str, "None"), args.iterations)
+
+    state = IntersectionState()
+    try:
+        state_results = benchmark(LaneCounts(state), GreenLane(state), args.iterations)
+    finally:
+        state.close()
+
+    print(f"{'operation':<20}{'manager (us)':>15}{'shared (us)':>15}{'speedup':>10}")
+    for operation in manager_results:
+        manager_us, state_us = manager_results[operation], state_results[operation]
+        print(f"{operation:<20}{manager_us:>15.2f}{state_us:>15.2f}{manager_us / state_us:>9.1f}x")
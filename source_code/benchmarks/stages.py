@@ -0,0 +1,232 @@
+"""
+Times every stage of both pipelines, headless and on the CPU only.
+
+The aerial pipeline (VideoProcessor) is split in decode, detect, track, count (zone counting)
+and annotate, the 4 camera pipeline (ObjectDetection + DeepSort) in decode, detect, track,
+count (direction of every track) and annotate. Each is run on its bundled video and on a
+synthetic video of boxes moving over a grey road, and the FPS and p50/p95/p99 latency of
+every stage are written to a JSON file, named after the current commit by default.
+The detector runs on every frame, cadence, motion gating and the detection cache are left
+out so the numbers are the cost of the stages themselves.
+
+Run it from the source_code folder:
+    python -m benchmarks.stages --frames 200
+    python -m benchmarks.stages --compare benchmarks/results/stages-<old commit>.json
+"""
+import os
+
+# CPU only, this has to happen before torch or ultralytics get imported
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import tempfile
+import time
+import cv2
+import numpy as np
+from arguments import (source_video_path, source_weights_path, confidence_threshold, iou_threshold, camera0,
+                       weights_path, cfg_path)
+
+STAGES = ("decode", "detect", "track", "count", "annotate")
+
+
+def synthetic_video(path, frames, resolution_wh, vehicles=20, seed=0):
+    """
+    Writes a video of vehicle sized boxes driving over a grey road and returns its path
+    """
+    width, height = resolution_wh
+    rng = np.random.default_rng(seed)
+    position = rng.uniform([0, 0], [width, height], size=(vehicles, 2))
+    velocity = rng.uniform(-8, 8, size=(vehicles, 2))
+    size = rng.uniform(0.03, 0.08, size=(vehicles, 1)) * [width, height]
+    colors = rng.integers(0, 255, size=(vehicles, 3)).tolist()
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (width, height))
+    for _ in range(frames):
+        frame = np.full((height, width, 3), 90, dtype=np.uint8)
+        cv2.line(frame, (0, height // 2), (width, height // 2), (255, 255, 255), 4)
+        cv2.line(frame, (width // 2, 0), (width // 2, height), (255, 255, 255), 4)
+        for (x, y), (w, h), color in zip(position, size, colors):
+            cv2.rectangle(frame, (int(x), int(y)), (int(x + w), int(y + h)), color, -1)
+        writer.write(frame)
+        position = (position + velocity) % [width, height]
+    writer.release()
+    return path
+
+
+def summarise(samples, frames):
+    """
+    Returns count, mean, p50/p95/p99 in milliseconds and the FPS of one stage
+    """
+    samples = np.asarray(samples)
+    if len(samples) == 0:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000
+    return {
+        "count": int(len(samples)),
+        "mean_ms": float(samples.mean() * 1000),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "fps": float(frames / samples.sum()) if samples.sum() else 0.0,
+    }
+
+
+def timed(samples, stage, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    samples[stage].append(time.perf_counter() - start)
+    return result
+
+
+def aerial_stages(video_path, frames, weights):
+    """
+    Runs the drone pipeline stage by stage and returns the latency samples of every stage
+    """
+    import supervision as sv
+    from aerial import VideoProcessor
+
+    processor = VideoProcessor(source_weights_path=weights, source_video_path=video_path,
+                               confidence_threshold=confidence_threshold, iou_threshold=iou_threshold)
+    generator = iter(sv.get_video_frames_generator(source_path=video_path, end=frames + 1))
+    samples = {stage: [] for stage in STAGES}
+    # one untimed frame so the model is warm
+    processor.detect_yolo(next(generator), 0)
+    for frame_index in range(1, frames + 1):
+        frame = timed(samples, "decode", next, generator, None)
+        if frame is None:
+            samples["decode"].pop()
+            break
+        detections = timed(samples, "detect", processor.detect_yolo, frame, frame_index)
+        detections.class_id = np.zeros(len(detections), dtype=int)
+        detections = timed(samples, "track", processor.tracker.update_with_detections, detections)
+        assignment = timed(samples, "count", processor.zone_index.assign, detections)
+        vehicles_per_zone = {f"lane{zone}": count for zone, count in enumerate(assignment.counts.tolist())}
+        timed(samples, "annotate", processor.annotate_frame, frame, detections[assignment.in_zone], vehicles_per_zone)
+    return samples
+
+
+def four_camera_stages(video_path, frames, weights, cfg):
+    """
+    Runs the 4 camera pipeline of one lane stage by stage and returns the latency samples of every stage
+    """
+    from deep_sort_realtime.deepsort_tracker import DeepSort
+    from helper_func import ObjectTracking
+    from object_detection import get_detector
+
+    detector = get_detector(weights_path=weights, cfg_path=cfg, backend="cpu")
+    ob = ObjectTracking(detector=detector)
+    tracker = DeepSort(embedder_gpu=False)
+    cap = cv2.VideoCapture(video_path)
+    samples = {stage: [] for stage in STAGES}
+    for _ in range(frames):
+        ret, frame = timed(samples, "decode", cap.read)
+        if not ret:
+            samples["decode"].pop()
+            break
+        detections, _ = timed(samples, "detect", ob.plot_box, frame, detector.classes)
+        tracks = timed(samples, "track", tracker.update_tracks, detections, None, frame)
+        timed(samples, "count", ob.track_directions, tracks)
+        timed(samples, "annotate", ob.draw_tracks, frame, tracks)
+    cap.release()
+    return samples
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_case(fn, *args):
+    """
+    Runs one pipeline on one video with its prints swallowed, a failure is recorded instead of raised
+    so one missing model does not stop the other cases
+    """
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            samples = fn(*args)
+    except Exception as error:
+        return {"error": f"{type(error).__name__}: {error}"}
+    frames = len(samples["decode"])
+    stages = {stage: summarise(samples[stage], frames) for stage in STAGES}
+    total = np.sum([samples[stage][:frames] for stage in STAGES if len(samples[stage]) >= frames], axis=0)
+    return {"frames": frames, "fps": float(frames / total.sum()) if frames else 0.0,
+            "total": summarise(total, frames), "stages": stages}
+
+
+def print_results(results, baseline=None):
+    print(f"{'case':<28}{'stage':<10}{'fps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          + (f"{'vs base':>9}" if baseline else ""))
+    for case, result in results.items():
+        if "error" in result:
+            print(f"{case:<28}skipped, {result['error']}")
+            continue
+        base = (baseline or {}).get(case, {}).get("stages", {})
+        for stage, stats in list(result["stages"].items()) + [("total", result["total"])]:
+            if not stats.get("count"):
+                continue
+            line = (f"{case:<28}{stage:<10}{stats['fps']:>9.1f}{stats['p50_ms']:>9.2f}"
+                    f"{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}")
+            old = (baseline or {}).get(case, {}).get("total") if stage == "total" else base.get(stage)
+            if baseline and old and old.get("p50_ms"):
+                line += f"{old['p50_ms'] / stats['p50_ms']:>8.2f}x"
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per stage latency of the aerial and 4 camera pipelines")
+    parser.add_argument("--frames", default=200, help="Frames per case", type=int)
+    parser.add_argument("--aerial-video", default=source_video_path, type=str)
+    parser.add_argument("--aerial-weights", default=source_weights_path, type=str)
+    parser.add_argument("--camera-video", default=camera0, type=str)
+    parser.add_argument("--weights", default=weights_path, help="YOLOv4 weights of the 4 camera mode", type=str)
+    parser.add_argument("--cfg", default=cfg_path, help="YOLOv4 config of the 4 camera mode", type=str)
+    parser.add_argument("--no-synthetic", action="store_true", help="Only run the bundled videos")
+    parser.add_argument("--output", default=None, help="JSON file, defaults to benchmarks/results/stages-<commit>.json")
+    parser.add_argument("--compare", default=None, help="JSON file of an earlier run to compare the p50s with")
+    args = parser.parse_args()
+
+    cv2.setNumThreads(os.cpu_count() or 1)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        cases = [
+            ("aerial/bundled", aerial_stages, args.aerial_video, args.frames, args.aerial_weights),
+            ("4c/bundled", four_camera_stages, args.camera_video, args.frames, args.weights, args.cfg),
+        ]
+        if not args.no_synthetic:
+            aerial_video = synthetic_video(os.path.join(tmp, "aerial.avi"), args.frames + 1, (1920, 1080))
+            camera_video = synthetic_video(os.path.join(tmp, "camera.avi"), args.frames, (1280, 720))
+            cases += [
+                ("aerial/synthetic", aerial_stages, aerial_video, args.frames, args.aerial_weights),
+                ("4c/synthetic", four_camera_stages, camera_video, args.frames, args.weights, args.cfg),
+            ]
+        for case, fn, *case_args in cases:
+            print(f"Running {case}")
+            results[case] = run_case(fn, *case_args)
+
+    commit = current_commit()
+    report = {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                    "opencv": cv2.__version__, "cpus": os.cpu_count()},
+        "frames": args.frames,
+        "results": results,
+    }
+    output = args.output or os.path.join("benchmarks", "results", f"stages-{commit}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+    print_results(results, baseline)
+    print(f"Saved to {output}")
@@ -0,0 +1,105 @@
+"""
+Compares tiled inference with running YOLO on the whole drone frame, at the default input size
+and upscaled.
+
+There is no ground truth for the bundled video, so the detections of the whole frame at the
+largest input size (--reference-size) stand in for it. For every mode the CPU time per frame and the
+recall against the reference are printed, for all vehicles in the zones and for the small ones only,
+along with the small vehicles found per CPU second.
+
+Run it from the source_code folder:
+    python -m benchmarks.tiling --frames 50
+"""
+import os
+
+# CPU only, this has to happen before torch or ultralytics get imported
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import argparse
+import time
+from functools import partial
+import numpy as np
+import supervision as sv
+from aerial import ZONE_IN_POLYGONS, ZONE_OUT_POLYGONS, to_detections
+from detectors import load_detector
+from tiling import TileGrid, merge_tiles
+from zones import ZoneIndex
+from arguments import (source_video_path, source_weights_path, confidence_threshold, iou_threshold,
+                       aerial_detector_backend)
+
+
+def get_model(backend, weights, size):
+    return load_detector(backend, weights, input_size=size, conf_threshold=confidence_threshold,
+                         nms_threshold=iou_threshold, calibration_video=source_video_path)
+
+
+def detect_full(model, frame):
+    return to_detections(*model.detect(frame))
+
+
+def detect_tiled(model, frame, grid):
+    results = model.detect_batch(grid.slice(frame, grid.tiles))
+    return merge_tiles([to_detections(*result) for result in results], grid.tiles)
+
+
+def matched(reference, detections, threshold=0.5):
+    """
+    Returns which reference boxes have a detection overlapping them by at least threshold IoU
+    """
+    if len(reference) == 0 or len(detections) == 0:
+        return np.zeros(len(reference), dtype=bool)
+    return sv.box_iou_batch(reference.xyxy, detections.xyxy).max(axis=1) >= threshold
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tiled against whole frame YOLO inference on the drone video")
+    parser.add_argument("--frames", default=50, help="Frames to run", type=int)
+    parser.add_argument("--video", default=source_video_path, type=str)
+    parser.add_argument("--weights", default=source_weights_path, type=str)
+    parser.add_argument("--backend", default=aerial_detector_backend, help="See detectors.DETECTOR_BACKENDS", type=str)
+    parser.add_argument("--sizes", default=[640, 1280], nargs="+", type=int, help="Input sizes of the whole frame runs")
+    parser.add_argument("--tile-size", default=640, type=int)
+    parser.add_argument("--tile-overlap", default=0.2, type=float)
+    parser.add_argument("--reference-size", default=1920, type=int, help="Input size of the reference run")
+    parser.add_argument("--small", default=32 * 32, type=int, help="Boxes under this many pixels count as small")
+    args = parser.parse_args()
+
+    video_info = sv.VideoInfo.from_video_path(args.video)
+    zone_index = ZoneIndex(ZONE_IN_POLYGONS, video_info.resolution_wh)
+    grid = TileGrid(video_info.resolution_wh, args.tile_size, args.tile_overlap, ZONE_IN_POLYGONS + ZONE_OUT_POLYGONS)
+    reference_model = get_model(args.backend, args.weights, args.reference_size)
+    modes = {f"full {size}": partial(detect_full, get_model(args.backend, args.weights, size)) for size in args.sizes}
+    modes[f"tiled {args.tile_size} x{len(grid)}"] = partial(detect_tiled, get_model(args.backend, args.weights,
+                                                                                   args.tile_size), grid=grid)
+
+    seconds = dict.fromkeys(modes, 0.0)
+    found = {mode: [0, 0] for mode in modes}  # all, small
+    total = [0, 0]
+    frames = 0
+    # the first frame only warms the model up
+    generator = sv.get_video_frames_generator(source_path=args.video, end=args.frames + 1)
+    for frame_index, frame in enumerate(generator):
+        reference = detect_full(reference_model, frame)
+        reference = reference[zone_index.assign(reference).in_zone]
+        small = reference.area < args.small
+        for mode, detect in modes.items():
+            start = time.process_time()
+            detections = detect(frame)
+            if frame_index == 0:
+                continue
+            seconds[mode] += time.process_time() - start
+            hits = matched(reference, detections)
+            found[mode][0] += int(hits.sum())
+            found[mode][1] += int(hits[small].sum())
+        if frame_index > 0:
+            total[0] += len(reference)
+            total[1] += int(small.sum())
+            frames += 1
+
+    print(f"{frames} frames, {total[0]} reference vehicles in the zones, {total[1]} of them small")
+    print(f"{'mode':<18}{'cpu ms':>9}{'recall':>9}{'small':>9}{'small/cpu s':>13}")
+    for mode in modes:
+        recall = found[mode][0] / max(total[0], 1)
+        small_recall = found[mode][1] / max(total[1], 1)
+        print(f"{mode:<18}{seconds[mode] / max(frames, 1) * 1000:>9.1f}{recall:>9.1%}{small_recall:>9.1%}"
+              f"{found[mode][1] / max(seconds[mode], 1e-9):>13.1f}")
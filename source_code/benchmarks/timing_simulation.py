@@ -0,0 +1,54 @@
+"""
+Replays lane counts through the traffic light scheduler on a virtual clock.
+
+The counts come from a trace recorded with arguments.count_trace_path, or when no trace is
+given from a synthetic day where vehicles arrive on every lane at random. A trace is replayed
+as recorded, the counts do not react to the lights. Every green time per vehicle in --green-times is simulated and the cycle
+length, wait times and throughput are printed, with how much faster than real time it ran.
+
+Run it from the source_code folder:
+    python -m benchmarks.timing_simulation --trace data/counts.jsonl --green-times 2 5 10 100
+"""
+import argparse
+import time
+import numpy as np
+from scheduler import LANES, load_trace, simulate
+
+
+def synthetic_trace(duration, step, rates, rng):
+    """
+    Returns a trace of queue lengths sampled every step seconds, vehicles arrive at the given
+    rates (vehicles per second) and the counts are what the cameras would see waiting
+    """
+    trace = []
+    counts = np.zeros(len(LANES), dtype=np.int64)
+    for t in np.arange(0.0, duration, step):
+        counts += rng.poisson(np.asarray(rates) * step)
+        # some vehicles turn right on red or leave the view of the camera
+        counts -= rng.binomial(counts, 0.02)
+        trace.append((float(t), {lane: int(count) for lane, count in zip(LANES, counts)}))
+    return trace
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline simulation of the traffic light timing")
+    parser.add_argument("--trace", default=None, help="Trace recorded with count_trace_path", type=str)
+    parser.add_argument("--duration", default=24 * 3600, help="Seconds of synthetic traffic", type=float)
+    parser.add_argument("--green-times", default=[2, 5, 10, 100], nargs="+", type=float,
+                        help="Green seconds per vehicle to compare")
+    args = parser.parse_args()
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = synthetic_trace(args.duration, 1.0, [0.05, 0.1, 0.02, 0.08], np.random.default_rng(0))
+    print(f"{len(trace)} samples over {trace[-1][0] / 3600:.1f} h")
+
+    print(f"{'s/vehicle':>10}{'cycles':>8}{'cycle (s)':>11}{'max wait (s)':>14}{'veh/h':>9}{'speedup':>12}")
+    for green_time in args.green_times:
+        start = time.perf_counter()
+        report = simulate(trace, green_time_per_vehicle=green_time, default_green_time=min(green_time * 5, 100))
+        took = time.perf_counter() - start
+        max_wait = max(lane["max_wait"] for lane in report["lanes"].values())
+        print(f"{green_time:>10g}{report['cycles']:>8}{report['mean_cycle']:>11.1f}{max_wait:>14.1f}"
+              f"{report['throughput_per_hour']:>9.1f}{report['elapsed'] / took:>11.0f}x")
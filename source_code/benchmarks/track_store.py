@@ -0,0 +1,104 @@
+"""
+Compares the TrackStore direction step with the per track dictionary version ObjectTracking
+used before, and checks that the store stays the same size on a long run.
+
+Fake DeepSort tracks (a Kalman mean each) drive through the frame, new ones appear and old
+ones disappear without ever being seen in the deleted state, like on a real camera.
+The time per frame of both versions and whether they agree is printed for every number of
+live tracks, then the store is run for --hours of frames at 15 FPS (a day by default) and its row count printed.
+
+Run it from the source_code folder:
+    python -m benchmarks.track_store --tracks 10 50 200
+"""
+import argparse
+import time
+import numpy as np
+from track_store import TrackStore
+
+
+def dict_directions(previous_positions, track_ids, means):
+    """
+    The old get_direction loop, previous_positions only ever grows
+    """
+    north, south = [], []
+    for track_id, current_position in zip(track_ids, means):
+        if track_id in previous_positions:
+            if current_position[1] < previous_positions[track_id][1] and current_position[5] > current_position[4]:
+                north.append(track_id)
+            elif current_position[1] > previous_positions[track_id][1] and current_position[5] > current_position[4]:
+                south.append(track_id)
+        previous_positions[track_id] = current_position
+    return north, south
+
+
+class FakeTracks:
+    """
+    Live tracks with a Kalman like mean, a few leave and are replaced every frame
+    """
+    def __init__(self, count, rng, turnover=0.02):
+        self.rng = rng
+        self.turnover = turnover
+        self.next_id = 0
+        self.ids = []
+        self.means = np.zeros((0, 8))
+        self.add(count)
+
+    def add(self, count):
+        means = np.zeros((count, 8))
+        means[:, :2] = self.rng.uniform(0, 1000, size=(count, 2))
+        means[:, 4:6] = self.rng.normal(0, 3, size=(count, 2))
+        self.ids.extend(str(track_id) for track_id in range(self.next_id, self.next_id + count))
+        self.next_id += count
+        self.means = np.concatenate([self.means, means])
+
+    def step(self):
+        self.means[:, :2] += self.means[:, 4:6]
+        self.means[:, 4:6] += self.rng.normal(0, 0.5, size=(len(self.ids), 2))
+        keep = self.rng.random(len(self.ids)) > self.turnover
+        self.ids = [track_id for track_id, kept in zip(self.ids, keep) if kept]
+        self.means = self.means[keep]
+        self.add(int((~keep).sum()))
+        return self.ids, [mean.copy() for mean in self.means]
+
+
+def benchmark(tracks, frames, rng):
+    fake = FakeTracks(tracks, rng)
+    store = TrackStore()
+    previous_positions = {}
+    dict_time = store_time = 0.0
+    agree = 0
+    for _ in range(frames):
+        ids, means = fake.step()
+        start = time.perf_counter()
+        expected = dict_directions(previous_positions, ids, means)
+        dict_time += time.perf_counter() - start
+        start = time.perf_counter()
+        result = store.update(ids, means)
+        store_time += time.perf_counter() - start
+        agree += expected == result
+    return dict_time / frames, store_time / frames, agree / frames, len(previous_positions), len(store)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TrackStore vs the per track dictionary")
+    parser.add_argument("--tracks", default=[10, 50, 200], nargs="+", type=int, help="Live tracks per frame")
+    parser.add_argument("--frames", default=2000, help="Frames per case", type=int)
+    parser.add_argument("--hours", default=24, help="Length of the long run at 15 FPS", type=float)
+    parser.add_argument("--day-tracks", default=30, help="Live tracks during the long run", type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'tracks':>7}{'dict (us)':>11}{'store (us)':>12}{'speedup':>9}{'agree':>7}{'dict size':>11}{'store size':>12}")
+    for tracks in args.tracks:
+        dict_time, store_time, agree, dict_size, store_size = benchmark(tracks, args.frames, rng)
+        print(f"{tracks:>7}{dict_time * 1e6:>11.1f}{store_time * 1e6:>12.1f}{dict_time / store_time:>8.1f}x"
+              f"{agree:>7.0%}{dict_size:>11}{store_size:>12}")
+
+    frames = int(args.hours * 3600 * 15)
+    fake = FakeTracks(args.day_tracks, rng)
+    store = TrackStore()
+    start = time.perf_counter()
+    for frame in range(frames):
+        store.update(*fake.step())
+    print(f"{args.hours:g} h at 15 FPS: {fake.next_id} tracks seen, {len(store)} kept, "
+          f"took {time.perf_counter() - start:.0f}s")
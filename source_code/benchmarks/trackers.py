@@ -0,0 +1,126 @@
+"""
+Compares the trackers of the 4 camera pipeline (tracker_backend in arguments.py) on the first camera
+video, on the CPU.
+
+The frames are detected once with YOLOv4 and every tracker runs on the same detections, detecting
+every frame and every --intervals frames, the frames in between only predicted like the pipeline does
+with detection_interval_4c. For every setup the time ObjectTracking.track_detect takes per frame
+(tracking and directions) is printed, and the vehicles it counts entering the lane are compared frame
+by frame with DeepSort detecting every frame: the mean absolute difference and the share of frames
+with the same count. When DeepSort cannot run here (it needs torch for its embedder) the first tracker
+that runs, detecting every frame, is the reference instead and the DeepSort rows are skipped.
+--synthetic replaces the video with cars driving down an empty lane, for hosts without the videos or the
+YOLOv4 weights.
+
+Run it from the source_code folder:
+    python -m benchmarks.trackers --frames 300
+    python -m benchmarks.trackers --synthetic --intervals 2 3
+"""
+import os
+
+# CPU only, this has to happen before torch gets imported by the DeepSort embedder
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import argparse
+import time
+import cv2
+import numpy as np
+from helper_func import ObjectTracking
+from trackers import TRACKER_BACKENDS, make_tracker
+from arguments import camera0, weights_path, cfg_path, dnn_backend
+
+
+def detect_frames(video_path, count, weights, cfg):
+    """
+    Returns the frames of the video and their detections
+    """
+    from object_detection import get_detector
+
+    detector = get_detector(weights_path=weights, cfg_path=cfg, backend=dnn_backend)
+    ob = ObjectTracking(detector=detector, draw=False)
+    cap = cv2.VideoCapture(video_path)
+    frames, detections = [], []
+    while len(frames) < count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        detections.append(ob.plot_box(frame, detector.classes)[0])
+        frames.append(frame)
+    cap.release()
+    return frames, detections
+
+
+def synthetic_frames(count, cars=40, rng=None):
+    """
+    Returns empty frames and the boxes of cars entering an 640x640 lane from the top at random times and speeds,
+    with a few missed detections
+    """
+    rng = rng or np.random.default_rng(0)
+    starts = np.sort(rng.integers(0, count, cars))
+    columns = rng.integers(0, 10, cars) * 60 + 10
+    speeds = rng.uniform(3, 8, cars)
+    frame = np.zeros((640, 640, 3), dtype=np.uint8)
+    detections = []
+    for index in range(count):
+        boxes = []
+        for start, column, speed in zip(starts, columns, speeds):
+            top = (index - start) * speed
+            if index >= start and top < 640 and rng.random() > 0.05:
+                boxes.append(([int(column), int(top), 40, 30], 0.9, "car"))
+        detections.append(boxes)
+    return [frame] * count, detections
+
+
+def track(backend, interval, frames, detections):
+    """
+    Returns the seconds track_detect took on every frame and the vehicles counted on it
+    """
+    ob = ObjectTracking(detector=object(), draw=False)
+    tracker = make_tracker(backend)
+    seconds, counts = [], []
+    for index, (frame, frame_detections) in enumerate(zip(frames, detections)):
+        start = time.perf_counter()
+        _, vehicles_south, _ = ob.track_detect(detections=frame_detections, img=frame, tracker=tracker,
+                                               predict=index % interval != 0)
+        seconds.append(time.perf_counter() - start)
+        counts.append(len(vehicles_south))
+    return np.array(seconds), np.array(counts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tracking cost and count agreement of the tracker backends")
+    parser.add_argument("--frames", default=300, type=int)
+    parser.add_argument("--video", default=camera0, type=str)
+    parser.add_argument("--weights", default=weights_path, type=str)
+    parser.add_argument("--cfg", default=cfg_path, type=str)
+    parser.add_argument("--synthetic", action="store_true", help="Cars on an empty lane instead of the video")
+    parser.add_argument("--intervals", default=[2], nargs="+", type=int, help="Detection intervals besides 1")
+    parser.add_argument("--backends", default=list(TRACKER_BACKENDS), nargs="+", choices=TRACKER_BACKENDS)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        frames, detections = synthetic_frames(args.frames)
+        source = "synthetic lane"
+    else:
+        frames, detections = detect_frames(args.video, args.frames, args.weights, args.cfg)
+        source = os.path.basename(args.video)
+    boxes = sum(len(frame_detections) for frame_detections in detections)
+    print(f"{source}: {len(frames)} frames, {boxes} boxes")
+
+    # DeepSort on every frame first, it is the reference when it runs
+    setups = [(backend, 1) for backend in ("deepsort", "bytetrack") if backend in args.backends]
+    setups += [(backend, interval) for backend in args.backends for interval in args.intervals if interval != 1]
+    print(f"{'tracker':<12}{'every':>6}{'mean ms':>9}{'p95 ms':>9}{'count diff':>12}{'same count':>12}")
+    reference = None
+    for backend, interval in setups:
+        try:
+            seconds, counts = track(backend, interval, frames, detections)
+        except Exception as error:
+            print(f"{backend:<12}{interval:>6}  skipped, {type(error).__name__}: {error}")
+            continue
+        if reference is None:
+            reference = counts
+            print(f"(reference: {backend} detecting every frame)")
+        difference = np.abs(counts - reference)
+        print(f"{backend:<12}{interval:>6}{seconds.mean() * 1000:>9.2f}{np.percentile(seconds, 95) * 1000:>9.2f}"
+              f"{difference.mean():>12.3f}{(difference == 0).mean():>12.1%}")
@@ -0,0 +1,96 @@
+"""
+Compares the precomputed ZoneIndex with the per zone PolygonZone.trigger loop
+VideoProcessor.process_frame used to count the vehicles of every lane.
+
+Both are run on the same random detections, once with the four ZONE_IN_POLYGONS of
+aerial.py and once with a grid of many small zones, and the time per frame and the
+mean difference of the zone counts are printed. Older supervision releases clip every box
+to the extent of each polygon before taking its anchor, so a box hanging over the edge of
+a zone can be pulled into it. The index clips to the frame only, which is why a few
+counts differ.
+
+Run it from the source_code folder:
+    python -m benchmarks.zone_index --detections 100 --grid 8
+"""
+import argparse
+import time
+import numpy as np
+import supervision as sv
+from aerial import ZONE_IN_POLYGONS, initiate_polygon_zones
+from zones import ZoneIndex
+
+RESOLUTION_WH = (1920, 1080)
+
+
+def grid_polygons(cells, resolution_wh):
+    """
+    Returns cells x cells rectangular zones covering the frame
+    """
+    width, height = resolution_wh
+    xs = np.linspace(0, width, cells + 1).astype(int)
+    ys = np.linspace(0, height, cells + 1).astype(int)
+    return [
+        np.array([[xs[i], ys[j]], [xs[i + 1] - 1, ys[j]], [xs[i + 1] - 1, ys[j + 1] - 1], [xs[i], ys[j + 1] - 1]])
+        for j in range(cells) for i in range(cells)
+    ]
+
+
+def random_detections(count, resolution_wh, rng):
+    width, height = resolution_wh
+    xy = rng.uniform([0, 0], [width, height], size=(count, 2))
+    wh = rng.uniform(20, 120, size=(count, 2))
+    return sv.Detections(xyxy=np.hstack([xy - wh / 2, xy + wh / 2]), tracker_id=np.arange(count))
+
+
+def trigger_loop(zones, detections):
+    """
+    The loop process_frame used before the zone index
+    """
+    detections_in_zones = []
+    counts = []
+    for zone in zones:
+        detections_in_zone = detections[zone.trigger(detections=detections)]
+        detections_in_zones.append(detections_in_zone)
+        counts.append(len(detections_in_zone))
+    return counts, sv.Detections.merge(detections_in_zones)
+
+
+def zone_index_lookup(index, detections):
+    assignment = index.assign(detections)
+    return assignment.counts.tolist(), detections[assignment.in_zone]
+
+
+def benchmark(polygons, frames, rng, detections_per_frame):
+    zones = initiate_polygon_zones(polygons, RESOLUTION_WH, [sv.Position.CENTER])
+    index = ZoneIndex(polygons, RESOLUTION_WH, sv.Position.CENTER)
+    all_detections = [random_detections(detections_per_frame, RESOLUTION_WH, rng) for _ in range(frames)]
+
+    start = time.perf_counter()
+    loop_counts = [trigger_loop(zones, detections)[0] for detections in all_detections]
+    loop_time = (time.perf_counter() - start) / frames
+
+    start = time.perf_counter()
+    index_counts = [zone_index_lookup(index, detections)[0] for detections in all_detections]
+    index_time = (time.perf_counter() - start) / frames
+
+    count_difference = np.mean(np.abs(np.array(loop_counts) - np.array(index_counts)))
+    return loop_time, index_time, count_difference
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Zone index vs per zone PolygonZone.trigger")
+    parser.add_argument("--frames", default=500, help="Number of random frames", type=int)
+    parser.add_argument("--detections", default=100, help="Detections per frame", type=int)
+    parser.add_argument("--grid", default=8, help="The many zones case uses a grid x grid layout", type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    cases = {
+        "4 lane zones": ZONE_IN_POLYGONS,
+        f"{args.grid * args.grid} grid zones": grid_polygons(args.grid, RESOLUTION_WH),
+    }
+    print(f"{'case':<18}{'trigger loop (ms)':>19}{'zone index (ms)':>17}{'speedup':>9}{'count diff':>12}")
+    for name, polygons in cases.items():
+        loop_time, index_time, count_difference = benchmark(polygons, args.frames, rng, args.detections)
+        print(f"{name:<18}{loop_time * 1000:>19.3f}{index_time * 1000:>17.3f}{loop_time / index_time:>8.1f}x"
+              f"{count_difference:>12.3f}")
@@ -0,0 +1,164 @@
+import numpy as np
+import supervision as sv
+
+
+class DetectionCadence:
+    """
+    This class decides on which frames the detector runs.
+    The detector runs every 'interval' frames and the tracker predicts the frames in between.
+    A detection is forced early when the tracker loses confidence, that is when few of the
+    detections matched an existing track or the number of detections jumped since the last one.
+    With a target frame time the interval is adjusted at runtime from the measured latency
+    of detection and prediction frames, so the average frame fits in the target
+    """
+    def __init__(self, interval=1, max_interval=10, target_frame_time=None, min_match_ratio=0.6,
+                 max_count_change=0.5, smoothing=0.1):
+        """
+        Args:
+            interval: Run the detector every interval frames, 1 detects on every frame
+            max_interval: Upper bound for the interval when it is adjusted at runtime
+            target_frame_time: Average seconds per frame to aim for, None keeps the interval fixed
+            min_match_ratio: Force the next detection when fewer of the detections than this matched a track
+            max_count_change: Force the next detection when the detection count changed by more than this fraction
+            smoothing: Weight of the newest sample in the latency moving averages
+        """
+        self.interval = max(1, int(interval))
+        self.min_interval = 1
+        self.max_interval = max(self.interval, int(max_interval))
+        self.target_frame_time = target_frame_time
+        self.min_match_ratio = min_match_ratio
+        self.max_count_change = max_count_change
+        self.smoothing = smoothing
+
+        self.frames_since_detection = None  # None until the first detection
+        self.forced = False
+        self.last_count = None
+        self.detect_latency = None
+        self.predict_latency = None
+
+        self.detections = 0
+        self.predictions = 0
+        self.forced_detections = 0
+
+    def should_detect(self):
+        """
+        Returns True if the detector should run on the current frame, call once per frame
+        """
+        if self.frames_since_detection is None or self.forced or self.frames_since_detection + 1 >= self.interval:
+            if self.forced:
+                self.forced_detections += 1
+            self.forced = False
+            self.frames_since_detection = 0
+            self.detections += 1
+            return True
+        self.frames_since_detection += 1
+        self.predictions += 1
+        return False
+
+    def force(self):
+        """
+        Makes the next frame a detection frame
+        """
+        self.forced = True
+
+    def _average(self, current, sample):
+        return sample if current is None else (1 - self.smoothing) * current + self.smoothing * sample
+
+    def record_detection(self, latency, detected, matched):
+        """
+        Records a detection frame
+        Args:
+            latency: Seconds spent on the frame, detection and tracking included
+            detected: Number of detections
+            matched: Number of detections that were matched to an existing track
+        """
+        self.detect_latency = self._average(self.detect_latency, latency)
+        if detected and matched / detected < self.min_match_ratio:
+            self.force()
+        if self.last_count is not None and abs(detected - self.last_count) > self.max_count_change * max(self.last_count, 1):
+            self.force()
+        self.last_count = detected
+        self._adjust()
+
+    def record_prediction(self, latency):
+        """
+        Records a frame where only the tracker ran
+        """
+        self.predict_latency = self._average(self.predict_latency, latency)
+        self._adjust()
+
+    def _adjust(self):
+        if self.target_frame_time is None or self.detect_latency is None:
+            return
+        predict_latency = self.predict_latency or 0.0
+        if self.detect_latency <= self.target_frame_time:
+            interval = self.min_interval
+        elif predict_latency >= self.target_frame_time:
+            interval = self.max_interval
+        else:
+            # smallest N with (detect + (N - 1) * predict) / N <= target
+            interval = int(np.ceil((self.detect_latency - predict_latency) / (self.target_frame_time - predict_latency)))
+        self.interval = int(np.clip(interval, self.min_interval, self.max_interval))
+
+    def stats(self):
+        total = self.detections + self.predictions
+        return {
+            "interval": self.interval,
+            "detections": self.detections,
+            "predictions": self.predictions,
+            "forced_detections": self.forced_detections,
+            "detect_ratio": self.detections / total if total else 0.0,
+            "detect_latency": self.detect_latency or 0.0,
+            "predict_latency": self.predict_latency or 0.0,
+        }
+
+
+class MotionPredictor:
+    """
+    This class carries tracked detections over the frames where the detector does not run.
+    sv.ByteTrack has no predict only step, so every track is moved along the velocity of its
+    box centre measured between the last two frames it was detected on
+    """
+    def __init__(self, max_age=30):
+        """
+        Args:
+            max_age: Tracks not detected for this many frames are dropped
+        """
+        self.max_age = max_age
+        self.tracks = {}  # tracker_id -> (frame_index, xyxy, velocity)
+        self.last_detections = sv.Detections.empty()
+        self.last_frame = 0
+
+    def update(self, detections, frame_index):
+        """
+        Records the tracked detections of a detection frame
+        """
+        for tracker_id, xyxy in zip(detections.tracker_id, detections.xyxy):
+            previous = self.tracks.get(tracker_id)
+            velocity = np.zeros(4)
+            if previous is not None and frame_index > previous[0]:
+                velocity = (xyxy - previous[1]) / (frame_index - previous[0])
+            self.tracks[tracker_id] = (frame_index, xyxy.copy(), velocity)
+        self.tracks = {
+            tracker_id: track for tracker_id, track in self.tracks.items()
+            if frame_index - track[0] <= self.max_age
+        }
+        self.last_detections = detections
+        self.last_frame = frame_index
+
+    def predict(self, frame_index):
+        """
+        Returns the detections of the last detection frame moved to frame_index
+        """
+        detections = self.last_detections
+        if len(detections) == 0:
+            return detections
+        steps = frame_index - self.last_frame
+        velocities = np.array([self.tracks[tracker_id][2] for tracker_id in detections.tracker_id])
+        predicted = sv.Detections(
+            xyxy=detections.xyxy + velocities * steps,
+            confidence=detections.confidence,
+            class_id=detections.class_id,
+            tracker_id=detections.tracker_id,
+        )
+        return predicted
@@ -0,0 +1,217 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import NamedTuple
+import cv2
+import numpy as np
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# How a reader behaves when the processor falls behind
+#   "latest": only the newest frame is kept, older ones are dropped
+#   "queue": up to buffer_size frames are kept, the oldest is dropped when it is full
+CAPTURE_POLICIES = ("latest", "queue")
+
+
+class CapturedFrame(NamedTuple):
+    """
+    A frame as delivered by a CameraReader
+    """
+    lane: str
+    frame: np.ndarray
+    index: int  # position of the frame in the source, starting at 0
+    timestamp: float  # time.monotonic() when the frame was read from the camera
+
+
+class CameraReader(threading.Thread):
+    """
+    This class reads one camera on its own thread and keeps its freshest frames in a small ring buffer,
+    so a slow camera never stalls the others and the processor never works on stale frames
+    """
+    def __init__(self, lane, source, policy="latest", buffer_size=4, realtime=None):
+        """
+        Args:
+            lane: Name of the lane the camera is looking at
+            source: Anything cv2.VideoCapture accepts (device index, file or stream url)
+            policy: One of CAPTURE_POLICIES
+            buffer_size: Number of frames kept by the "queue" policy
+            realtime: Read video files at their own frame rate like a live camera would.
+                Defaults to True for files and is ignored for live sources
+        """
+        super().__init__(name=f"capture-{lane}", daemon=True)
+        if policy not in CAPTURE_POLICIES:
+            raise ValueError(f"Unknown capture policy '{policy}', expected one of {CAPTURE_POLICIES}")
+        self.lane = lane
+        self.source = source
+        self.policy = policy
+        self.buffer = deque(maxlen=1 if policy == "latest" else max(1, buffer_size))
+        self.is_file = isinstance(source, str) and os.path.isfile(source)
+        self.realtime = self.is_file if realtime is None else realtime and self.is_file
+
+        self.condition = threading.Condition()
+        self.opened = threading.Event()
+        self.finished = False
+        self.stopped = False
+        self.error = None
+
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.frames_delivered = 0
+        self.last_age = 0.0
+        self.max_age = 0.0
+        self.total_age = 0.0
+        self.last_latency = 0.0
+        self.total_latency = 0.0
+        self.frames_done = 0
+
+        self.read_counter = metrics.counter("capture_frames_read", lane=lane)
+        self.dropped_counter = metrics.counter("capture_frames_dropped", lane=lane)
+        self.buffered_gauge = metrics.gauge("capture_buffered_frames", lane=lane)
+        self.age_seconds = metrics.histogram("capture_frame_age_seconds", lane=lane)
+        self.latency_seconds = metrics.histogram("capture_frame_latency_seconds", lane=lane)
+
+    def run(self):
+        cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            self.error = f"Could not open {self.source}"
+            self._finish()
+            self.opened.set()
+            return
+        self.opened.set()
+
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30
+        start = time.monotonic()
+        index = 0
+        try:
+            while not self.stopped:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                timestamp = time.monotonic()
+                self._push(CapturedFrame(self.lane, frame, index, timestamp))
+                index += 1
+                if self.realtime:
+                    delay = start + index / fps - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+        finally:
+            cap.release()
+            self._finish()
+
+    def _push(self, captured):
+        with self.condition:
+            if len(self.buffer) == self.buffer.maxlen:
+                # the deque drops the oldest frame on append, it is stale anyway
+                self.frames_dropped += 1
+                self.dropped_counter.inc()
+            self.buffer.append(captured)
+            self.frames_read += 1
+            self.read_counter.inc()
+            self.buffered_gauge.set(len(self.buffer))
+            self.condition.notify_all()
+
+    def _finish(self):
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def read(self, timeout=None):
+        """
+        Returns the next CapturedFrame, waiting for one if the buffer is empty.
+        Returns None once the source has ended (or could not be opened) and the buffer is drained,
+        or if timeout seconds pass without a frame
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.buffer or self.finished, timeout=timeout):
+                return None
+            if not self.buffer:
+                return None
+            captured = self.buffer.popleft()
+            self.frames_delivered += 1
+            self.last_age = time.monotonic() - captured.timestamp
+            self.total_age += self.last_age
+            self.max_age = max(self.max_age, self.last_age)
+            self.age_seconds.observe(self.last_age)
+            self.buffered_gauge.set(len(self.buffer))
+            return captured
+
+    def mark_done(self, captured):
+        """
+        Records the end to end latency of a frame once the processor is done with it
+        """
+        self.last_latency = time.monotonic() - captured.timestamp
+        self.total_latency += self.last_latency
+        self.frames_done += 1
+        self.latency_seconds.observe(self.last_latency)
+
+    def stop(self):
+        self.stopped = True
+
+    def stats(self):
+        """
+        Returns the frame counters and the frame age/latency of this camera in seconds
+        """
+        return {
+            "read": self.frames_read,
+            "dropped": self.frames_dropped,
+            "delivered": self.frames_delivered,
+            "buffered": len(self.buffer),
+            "last_age": self.last_age,
+            "mean_age": self.total_age / self.frames_delivered if self.frames_delivered else 0.0,
+            "max_age": self.max_age,
+            "last_latency": self.last_latency,
+            "mean_latency": self.total_latency / self.frames_done if self.frames_done else 0.0,
+        }
+
+
+class CameraGroup:
+    """
+    This class runs one CameraReader per lane and hands out one fresh frame per lane at a time
+    """
+    def __init__(self, sources, policy="latest", buffer_size=4, realtime=None):
+        """
+        Args:
+            sources: A dictionary mapping each lane to its camera source
+            policy: One of CAPTURE_POLICIES, used for every camera
+            buffer_size: Number of frames kept per camera by the "queue" policy
+            realtime: See CameraReader
+        """
+        self.readers = {
+            lane: CameraReader(lane, source, policy=policy, buffer_size=buffer_size, realtime=realtime)
+            for lane, source in sources.items()
+        }
+
+    def start(self):
+        for reader in self.readers.values():
+            reader.start()
+        return self
+
+    def read(self, timeout=None):
+        """
+        Returns a dictionary mapping each lane to its next CapturedFrame,
+        or None if any of the cameras has no more frames
+        """
+        frames = {}
+        for lane, reader in self.readers.items():
+            captured = reader.read(timeout=timeout)
+            if captured is None:
+                if reader.error:
+                    logger.error(reader.error)
+                return None
+            frames[lane] = captured
+        return frames
+
+    def mark_done(self, captured):
+        self.readers[captured.lane].mark_done(captured)
+
+    def stats(self):
+        return {lane: reader.stats() for lane, reader in self.readers.items()}
+
+    def release(self):
+        for reader in self.readers.values():
+            reader.stop()
+        for reader in self.readers.values():
+            reader.join(timeout=1)
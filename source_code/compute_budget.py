@@ -0,0 +1,125 @@
+import time
+import metrics
+
+
+class ComputeBudget:
+    """
+    This class decides which lanes go through the detector on every capture cycle, from the signal state.
+    Only the counts of the red lanes the timing process has not served yet in the cycle decide its next phase,
+    so they run at the full frame rate once that decision is close. The green lane and the lanes already served
+    in the cycle run at a reduced rate, their counts only matter again in the next cycle.
+    Every lane gets a weight, the fraction of its frames it is detected on, and with a frames per second budget
+    all weights are scaled down together until the lanes fit in it
+    """
+    def __init__(self, lanes, fps_budget=None, green_weight=0.25, served_weight=0.25, waiting_weight=0.5,
+                 lookahead=10.0, smoothing=0.1, clock=time.time):
+        """
+        Args:
+            lanes: Every lane of the intersection
+            fps_budget: Most frames per second run through the detector over all lanes, None does not limit them
+            green_weight: Fraction of its frames the green lane is processed on
+            served_weight: Fraction of its frames a red lane already served in the cycle is processed on
+            waiting_weight: Fraction of its frames a red lane waiting to be served is processed on while the
+                next decision is more than lookahead seconds away, every frame once it is closer
+            lookahead: Seconds before the next decision from which the waiting lanes run at full rate
+            smoothing: Weight of the newest sample in the moving average of the capture rate
+            clock: Wall clock, the decision time comes from the timing process in time.time()
+        """
+        self.lanes = tuple(lanes)
+        self.fps_budget = fps_budget
+        self.green_weight = green_weight
+        self.served_weight = served_weight
+        self.waiting_weight = waiting_weight
+        self.lookahead = lookahead
+        self.smoothing = smoothing
+        self.clock = clock
+
+        # a lane is processed once it has a whole frame of credit, everyone starts with one so the
+        # first cycle gives the timing process counts of every lane
+        self.credit = dict.fromkeys(self.lanes, 1.0)
+        self.cycle_rate = None  # capture cycles per second
+        self.last_cycle = None
+        self.scale = 1.0
+        self.processed = dict.fromkeys(self.lanes, 0)
+        self.skipped = dict.fromkeys(self.lanes, 0)
+
+        self.rate_gauges = {lane: metrics.gauge("lane_detection_rate", lane=lane) for lane in self.lanes}
+        self.weight_gauges = {lane: metrics.gauge("lane_detection_weight", lane=lane) for lane in self.lanes}
+        self.scale_gauge = metrics.gauge("compute_budget_scale")
+        self.skipped_counters = {lane: metrics.counter("lane_frames_skipped", lane=lane, reason="budget")
+                                 for lane in self.lanes}
+
+    def weights(self, signal, now):
+        """
+        Returns the weight of every lane for a signal state
+        Args:
+            signal: {"green": lane or None, "until": time of the next decision or None, "served": set of lanes},
+                see shared_state.IntersectionState.phase
+            now: Current time on the clock
+        """
+        green = signal.get("green")
+        if green is None:
+            # nothing decided yet, the first decision needs every lane
+            return dict.fromkeys(self.lanes, 1.0)
+        until = signal.get("until")
+        due = until is None or until - now <= self.lookahead
+        served = set(signal.get("served") or ())
+        if not set(self.lanes) - served - {green}:
+            # every other lane was served, the next decision starts a new cycle and looks at all of them
+            served = set()
+        weights = {}
+        for lane in self.lanes:
+            if lane == green:
+                weights[lane] = self.green_weight
+            elif lane in served:
+                weights[lane] = self.served_weight
+            else:
+                weights[lane] = 1.0 if due else self.waiting_weight
+        return weights
+
+    def select(self, lanes, signal):
+        """
+        Returns the lanes to process this capture cycle, call once per cycle
+        Args:
+            lanes: The lanes with a new frame
+            signal: The signal state, see weights
+        """
+        now = self.clock()
+        if self.last_cycle is not None and now > self.last_cycle:
+            rate = 1.0 / (now - self.last_cycle)
+            self.cycle_rate = rate if self.cycle_rate is None else \
+                (1 - self.smoothing) * self.cycle_rate + self.smoothing * rate
+        self.last_cycle = now
+
+        weights = self.weights(signal, now)
+        self.scale = 1.0
+        if self.fps_budget is not None and self.cycle_rate:
+            demand = sum(weights[lane] for lane in lanes) * self.cycle_rate
+            if demand > self.fps_budget:
+                self.scale = self.fps_budget / demand
+        self.scale_gauge.set(self.scale)
+
+        selected = []
+        for lane in lanes:
+            weight = weights[lane] * self.scale
+            # never more than one frame of credit, a lane does not catch up on the frames it skipped
+            self.credit[lane] = min(self.credit[lane] + weight, 1.0)
+            if self.credit[lane] >= 1.0 - 1e-9:
+                self.credit[lane] -= 1.0
+                self.processed[lane] += 1
+                selected.append(lane)
+            else:
+                self.skipped[lane] += 1
+                self.skipped_counters[lane].inc()
+            self.weight_gauges[lane].set(weights[lane])
+            if self.cycle_rate:
+                self.rate_gauges[lane].set(weight * self.cycle_rate)
+        return selected
+
+    def stats(self):
+        return {
+            "cycle_rate": self.cycle_rate,
+            "scale": self.scale,
+            "processed": dict(self.processed),
+            "skipped": dict(self.skipped),
+        }
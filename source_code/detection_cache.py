@@ -0,0 +1,334 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import numpy as np
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# One .npy file per column, read back memory mapped
+COLUMNS = {
+    "frames": np.int64,  # every frame index that has been detected, also the ones without detections
+    "frame_index": np.int64,  # frame of every detection, sorted
+    "boxes": np.float32,  # (n, 4) boxes in the format the detector returns them
+    "scores": np.float32,
+    "class_ids": np.int32,
+}
+
+# Process wide caches, see get_cache()
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def file_digest(path, digests_path=None):
+    """
+    Returns a hash of the content of a file.
+    Hashing a long video or the YOLOv4 weights takes a while, so when digests_path is given
+    the result is remembered there against the size and modification time of the file
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = f"{stat.st_size}:{stat.st_mtime_ns}"
+    digests = {}
+    if digests_path is not None and os.path.exists(digests_path):
+        try:
+            with open(digests_path) as file:
+                digests = json.load(file)
+        except (OSError, ValueError):
+            digests = {}
+        if digests.get(path, {}).get("stamp") == stamp:
+            return digests[path]["digest"]
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+
+    if digests_path is not None:
+        digests[path] = {"stamp": stamp, "digest": digest}
+        tmp_path = f"{digests_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(digests, file)
+        os.replace(tmp_path, digests_path)
+    return digest
+
+
+def cache_key(video_path, weights_paths, confidence_threshold, iou_threshold, extra=None, digests_path=None):
+    """
+    Returns the key of the detections of a video: a hash of the video content, of every weights/config
+    file of the model, of both thresholds and of anything else in extra that changes the detections
+    """
+    parts = {
+        "video": file_digest(video_path, digests_path),
+        "weights": [file_digest(path, digests_path) for path in weights_paths],
+        "confidence_threshold": float(confidence_threshold),
+        "iou_threshold": float(iou_threshold),
+        "extra": extra or {},
+    }
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+def _entry_size(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+
+def evict(cache_dir, max_bytes, keep=()):
+    """
+    Deletes the least recently used entries of cache_dir until it holds at most max_bytes.
+    Entries whose key is in keep are never deleted
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir():
+            meta_path = os.path.join(entry.path, "meta.json")
+            used = os.stat(meta_path).st_mtime if os.path.exists(meta_path) else 0.0
+            entries.append((used, entry.name, entry.path, _entry_size(entry.path)))
+    total = sum(size for _, _, _, size in entries)
+    evicted = []
+    for used, name, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name in keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        evicted.append(name)
+    return evicted
+
+
+class DetectionCache:
+    """
+    This class keeps the raw detector output of every frame of one video on disk, so running the
+    same video through the same model again does not pay for inference a second time.
+    An entry is a directory of one .npy file per column (see COLUMNS) that is memory mapped on open,
+    looking a frame up is two binary searches. New frames are kept in memory and merged into the
+    files by flush()
+    """
+    def __init__(self, cache_dir, key, meta=None, max_bytes=None, flush_every=500):
+        """
+        Args:
+            cache_dir: Folder holding all the entries
+            key: Name of this entry, see cache_key()
+            meta: Anything worth keeping next to the entry for a human looking at it
+            max_bytes: Size the whole cache_dir is evicted down to when this entry is flushed
+            flush_every: Flush on its own once this many frames are pending
+        """
+        self.cache_dir = cache_dir
+        self.key = key
+        self.directory = os.path.join(cache_dir, key)
+        self.meta = dict(meta or {})
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.pending = {}  # frame_index -> (class_ids, scores, boxes) not written yet
+        self.hits = 0
+        self.misses = 0
+        self.hit_counter = metrics.counter("detection_cache_hits", entry=key[:8])
+        self.miss_counter = metrics.counter("detection_cache_misses", entry=key[:8])
+        self._load()
+
+    def __getstate__(self):
+        # memory maps and locks do not pickle, the other process maps the files itself
+        self.flush()
+        return {"cache_dir": self.cache_dir, "key": self.key, "meta": self.meta, "max_bytes": self.max_bytes,
+                "flush_every": self.flush_every}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _load(self):
+        self.columns = {name: np.empty((0, 4) if name == "boxes" else (0,), dtype=dtype)
+                        for name, dtype in COLUMNS.items()}
+        meta_path = os.path.join(self.directory, "meta.json")
+        if not os.path.exists(meta_path):
+            return
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+            columns = {name: np.load(os.path.join(self.directory, f"{name}.npy"), mmap_mode="r") for name in COLUMNS}
+        except (OSError, ValueError):
+            return
+        # the columns are replaced one after the other, a reader can catch them half way
+        rows = len(columns["frame_index"])
+        if len(columns["frames"]) != meta.get("frames") or any(len(columns[name]) != rows for name in
+                                                                 ("boxes", "scores", "class_ids")):
+            return
+        self.columns = columns
+        # the modification time of meta.json is what eviction goes by
+        os.utime(meta_path)
+
+    def __len__(self):
+        return len(self.columns["frames"]) + len(self.pending)
+
+    def __contains__(self, frame_index):
+        with self.lock:
+            if frame_index in self.pending:
+                return True
+        frames = self.columns["frames"]
+        position = np.searchsorted(frames, frame_index)
+        return position < len(frames) and frames[position] == frame_index
+
+    def get(self, frame_index):
+        """
+        Returns the (class_ids, scores, boxes) stored for frame_index, or None if it was never detected
+        """
+        with self.lock:
+            if frame_index in self.pending:
+                self.hits += 1
+                self.hit_counter.inc()
+                return self.pending[frame_index]
+        frames = self.columns["frames"]
+        position = np.searchsorted(frames, frame_index)
+        if position == len(frames) or frames[position] != frame_index:
+            self.misses += 1
+            self.miss_counter.inc()
+            return None
+        rows = self.columns["frame_index"]
+        start, end = np.searchsorted(rows, [frame_index, frame_index + 1])
+        self.hits += 1
+        self.hit_counter.inc()
+        return (np.asarray(self.columns["class_ids"][start:end]), np.asarray(self.columns["scores"][start:end]),
+                np.asarray(self.columns["boxes"][start:end]))
+
+    def put(self, frame_index, class_ids, scores, boxes):
+        """
+        Stores the detector output of frame_index, written to disk by the next flush()
+        """
+        class_ids = np.asarray(class_ids, dtype=COLUMNS["class_ids"]).reshape(-1)
+        scores = np.asarray(scores, dtype=COLUMNS["scores"]).reshape(-1)
+        boxes = np.asarray(boxes, dtype=COLUMNS["boxes"]).reshape(-1, 4)
+        with self.lock:
+            self.pending[int(frame_index)] = (class_ids, scores, boxes)
+            full = len(self.pending) >= self.flush_every
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Merges the pending frames into the files of the entry, then evicts old entries if the
+        cache grew past max_bytes
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        # another process may have written the same entry in the meantime, merge with what is on disk now
+        self._load()
+        old = self.columns
+        known = set(old["frames"].tolist())
+        new_frames = np.array(sorted(frame for frame in pending if frame not in known), dtype=COLUMNS["frames"])
+        new = {name: [] for name in ("frame_index", "boxes", "scores", "class_ids")}
+        for frame in new_frames.tolist():
+            class_ids, scores, boxes = pending[frame]
+            new["frame_index"].append(np.full(len(class_ids), frame, dtype=COLUMNS["frame_index"]))
+            new["class_ids"].append(class_ids)
+            new["scores"].append(scores)
+            new["boxes"].append(boxes)
+        frames = np.concatenate([old["frames"], new_frames])
+        frame_index = np.concatenate([old["frame_index"]] + new["frame_index"])
+        order = np.argsort(frame_index, kind="stable")
+        columns = {
+            "frames": np.sort(frames),
+            "frame_index": frame_index[order],
+            "boxes": np.concatenate([old["boxes"]] + new["boxes"])[order],
+            "scores": np.concatenate([old["scores"]] + new["scores"])[order],
+            "class_ids": np.concatenate([old["class_ids"]] + new["class_ids"])[order],
+        }
+
+        # let go of the memory maps before replacing the files under them, windows refuses otherwise
+        self.columns = columns
+        del old
+        os.makedirs(self.directory, exist_ok=True)
+        for name, values in columns.items():
+            tmp_path = os.path.join(self.directory, f"{name}.{os.getpid()}.tmp.npy")
+            np.save(tmp_path, values)
+            os.replace(tmp_path, os.path.join(self.directory, f"{name}.npy"))
+        meta = dict(self.meta, frames=len(columns["frames"]), detections=len(columns["frame_index"]),
+                    updated=time.time())
+        tmp_path = os.path.join(self.directory, f"meta.{os.getpid()}.tmp.json")
+        with open(tmp_path, "w") as file:
+            json.dump(meta, file, indent=1)
+        os.replace(tmp_path, os.path.join(self.directory, "meta.json"))
+        self._load()
+        if self.max_bytes is not None:
+            evict(self.cache_dir, self.max_bytes, keep={self.key})
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "frames": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def get_cache(cache_dir, video_path, weights_paths, confidence_threshold, iou_threshold, extra=None,
+              max_bytes=None):
+    """
+    Returns the DetectionCache of a video, shared by everything in this process that asks for the same key.
+    Returns None when cache_dir is None or the source is not a file (a live camera is never the same twice)
+    Args:
+        cache_dir: Folder holding all the entries, None disables caching
+        video_path: The video the detections come from
+        weights_paths: Every file the model is loaded from
+        confidence_threshold: Confidence threshold of the detector
+        iou_threshold: NMS threshold of the detector
+        extra: Anything else that changes the detections, e.g. the input size
+        max_bytes: Size cache_dir is evicted down to, None never evicts
+    """
+    if cache_dir is None or not isinstance(video_path, str) or not os.path.isfile(video_path):
+        return None
+    os.makedirs(cache_dir, exist_ok=True)
+    key = cache_key(video_path, weights_paths, confidence_threshold, iou_threshold, extra,
+                    digests_path=os.path.join(cache_dir, "digests.json"))
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            meta = {"video": os.path.abspath(video_path), "weights": [os.path.abspath(path) for path in weights_paths],
+                    "confidence_threshold": confidence_threshold, "iou_threshold": iou_threshold, "extra": extra or {}}
+            cache = DetectionCache(cache_dir, key, meta=meta, max_bytes=max_bytes)
+            logger.info("Detection cache for %s: %d frames in %s", video_path, len(cache), cache.directory)
+            _caches[key] = cache
+        return cache
+
+
+def get_lane_caches(cache_dir, sources, detector, weights_paths, max_bytes=None, classes=None):
+    """
+    Returns a dictionary mapping every lane whose source is a video file to the DetectionCache
+    of that video for a detector, lanes fed by live cameras are left out
+    Args:
+        classes: The classes the detector is asked for, only those are in the cached detections
+    """
+    extra = {"image_size": detector.image_size, "runtime": detector.runtime}
+    if classes is not None:
+        extra["classes"] = sorted(int(class_id) for class_id in classes)
+    caches = {}
+    for lane, source in sources.items():
+        cache = get_cache(cache_dir, source, weights_paths, detector.confThreshold, detector.nmsThreshold,
+                          extra=extra, max_bytes=max_bytes)
+        if cache is not None:
+            caches[lane] = cache
+    return caches
+
+
+def flush_caches():
+    """
+    Writes the pending frames of every cache of this process to disk.
+    Call it at the end of a multiprocessing.Process, they exit without running atexit
+    """
+    with _caches_lock:
+        caches = list(_caches.values())
+    for cache in caches:
+        cache.flush()
+
+
+atexit.register(flush_caches)
@@ -0,0 +1,420 @@
+import abc
+import json
+import logging
+import os
+import threading
+import time
+import cv2
+import numpy as np
+import metrics
+from object_detection import get_detector
+from arguments import (weights_path, cfg_path, dnn_backend, camera0, detector_backend, detector_model_path,
+                       detector_threads, detector_input_size, inference_server_address, inference_server_authkey)
+
+logger = logging.getLogger(__name__)
+
+# torch runs an ultralytics .pt model as it is, opencv runs the YOLOv4 darknet files or the ONNX export
+# of an ultralytics model through OpenCV DNN, onnx runs that export on ONNX Runtime and onnx_int8
+# an INT8 copy of it quantized on frames of the video
+DETECTOR_BACKENDS = ("torch", "opencv", "onnx", "onnx_int8")
+
+_detectors = {}
+_detectors_lock = threading.Lock()
+
+
+def letterbox(frame, size, color=114):
+    """
+    Resizes the frame to fit a size x size square without changing its aspect ratio and pads the rest,
+    the way ultralytics prepares its input
+    Returns:
+        A tuple (image, scale, (pad_x, pad_y))
+    """
+    height, width = frame.shape[:2]
+    scale = min(size / height, size / width)
+    new_width, new_height = int(round(width * scale)), int(round(height * scale))
+    if (new_width, new_height) != (width, height):
+        frame = cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    pad_x, pad_y = (size - new_width) / 2, (size - new_height) / 2
+    top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+    left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+    image = cv2.copyMakeBorder(frame, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(color, color, color))
+    return image, scale, (left, top)
+
+
+def decode_ultralytics_outputs(output, scale, pad, frame_shape, conf_threshold, nms_threshold, classes=None,
+                               max_detections=300):
+    """
+    Turns the raw output of an exported ultralytics detection model for one image into detections,
+    the same way ultralytics does (best class score as confidence, per class NMS)
+    Args:
+        output: (4 + classes, anchors) array, the box center, size and the score of every class per anchor
+        scale, pad: What letterbox did to the frame
+        frame_shape: Shape of the original frame, boxes are scaled back to it
+        conf_threshold: Minimum class score to keep a box
+        nms_threshold: IoU threshold used by NMS
+        classes: Only keep the boxes whose best class is one of these
+        max_detections: Keep at most this many boxes, the best ones
+    Returns:
+        A tuple (class_ids, scores, boxes) with boxes as (x, y, w, h) in frame pixels
+    """
+    predictions = output.T
+    keep = predictions[:, 4:].max(axis=1) >= conf_threshold
+    predictions = predictions[keep]
+    class_ids = predictions[:, 4:].argmax(axis=1)
+    if classes is not None:
+        keep = np.isin(class_ids, classes)
+        predictions, class_ids = predictions[keep], class_ids[keep]
+    if len(predictions) == 0:
+        return np.empty((0,), np.int32), np.empty((0,), np.float32), np.empty((0, 4), np.float32)
+
+    scores = predictions[np.arange(len(class_ids)), 4 + class_ids]
+    frame_h, frame_w = frame_shape[:2]
+    width = predictions[:, 2] / scale
+    height = predictions[:, 3] / scale
+    left = ((predictions[:, 0] - pad[0]) / scale - width / 2).clip(0, frame_w)
+    top = ((predictions[:, 1] - pad[1]) / scale - height / 2).clip(0, frame_h)
+    width = np.minimum(width, frame_w - left)
+    height = np.minimum(height, frame_h - top)
+    # boxes entirely off the frame end up empty once clipped
+    visible = (width > 0) & (height > 0)
+    boxes = np.stack([left, top, width, height], axis=1)[visible].astype(np.float32)
+    class_ids, scores = class_ids[visible], scores[visible]
+    indices = np.asarray(cv2.dnn.NMSBoxesBatched(boxes, scores.astype(np.float32), class_ids.astype(np.int32),
+                                                 conf_threshold, nms_threshold), dtype=np.int64).reshape(-1)
+    indices = indices[np.argsort(-scores[indices], kind="stable")][:max_detections]
+    return class_ids[indices].astype(np.int32), scores[indices].astype(np.float32), boxes[indices]
+
+
+def calibration_frames(video_path, count=32):
+    """
+    Returns count frames spread over the video, to calibrate the INT8 model on
+    """
+    cap = cv2.VideoCapture(video_path)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = []
+    for index in np.linspace(0, max(total - 1, 0), count).astype(int).tolist():
+        if total > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        raise RuntimeError(f"Could not read calibration frames from {video_path}")
+    return frames
+
+
+def _up_to_date(path, source):
+    return os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(source)
+
+
+def export_onnx(model_path, input_size=640):
+    """
+    Exports an ultralytics .pt model to ONNX next to it, once, with the class names in a .names.json
+    beside it. The export has a dynamic batch and input size.
+    Returns the path of the .onnx file, an .onnx path is returned as it is
+    """
+    if model_path.endswith(".onnx"):
+        return model_path
+    onnx_path = os.path.splitext(model_path)[0] + ".onnx"
+    if not _up_to_date(onnx_path, model_path):
+        from ultralytics import YOLO
+
+        logger.info("Exporting %s to ONNX", model_path)
+        model = YOLO(model_path)
+        exported = model.export(format="onnx", imgsz=input_size, dynamic=True)
+        if os.path.abspath(exported) != os.path.abspath(onnx_path):
+            os.replace(exported, onnx_path)
+        with open(os.path.splitext(onnx_path)[0] + ".names.json", "w") as file:
+            json.dump([model.names[i] for i in range(len(model.names))], file)
+    return onnx_path
+
+
+def quantize_onnx(onnx_path, frames, input_size=640):
+    """
+    Writes an INT8 copy of the ONNX model next to it, calibrated on the given frames, once.
+    The convolution weights are quantized per channel and their activations per tensor (QDQ format),
+    which ONNX Runtime runs with integer kernels on x86 CPUs
+    Returns the path of the .int8.onnx file
+    """
+    stem = os.path.splitext(onnx_path)[0]
+    int8_path = stem + ".int8.onnx"
+    if _up_to_date(int8_path, onnx_path):
+        return int8_path
+    import onnxruntime
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    input_name = onnxruntime.InferenceSession(onnx_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+
+    class FrameReader(CalibrationDataReader):
+        def __init__(self):
+            self.blobs = iter([cv2.dnn.blobFromImage(letterbox(frame, input_size)[0], 1/255, swapRB=True)
+                               for frame in frames])
+
+        def get_next(self):
+            blob = next(self.blobs, None)
+            return None if blob is None else {input_name: blob}
+
+    logger.info("Quantizing %s to INT8 on %d frames", onnx_path, len(frames))
+    # only the convolutions, the head decoding boxes and scores into one output stays in float,
+    # an 8 bit range spread over both pixel coordinates and 0-1 scores would round the scores away
+    quantize_static(onnx_path, int8_path, FrameReader(), quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, op_types_to_quantize=["Conv"])
+    names_path = stem + ".names.json"
+    if os.path.isfile(names_path):
+        with open(names_path) as source, open(stem + ".int8.names.json", "w") as target:
+            target.write(source.read())
+    return int8_path
+
+
+def load_names(model_path, classes_path="dnn_model/classes.txt"):
+    """
+    Returns the class names saved next to an exported model, the COCO names when there are none
+    """
+    names_path = os.path.splitext(model_path)[0] + ".names.json"
+    if os.path.isfile(names_path):
+        with open(names_path) as file:
+            return json.load(file)
+    with open(classes_path) as file:
+        return [line.strip() for line in file]
+
+
+class Detector(abc.ABC):
+    """
+    This class holds what the detectors of every backend have in common.
+    A detector has the class names in 'classes', its input size in 'image_size', its thresholds in
+    'confThreshold' and 'nmsThreshold', and detect(frame, classes=None) and detect_batch(frames, classes=None)
+    returning (class_ids, scores, boxes) with boxes as (x, y, w, h) in frame pixels.
+    object_detection.ObjectDetection, the YOLOv4 detector, has the same interface.
+    Subclasses only implement _detect
+    """
+    runtime = None
+
+    def __init__(self, model_path, names, backend, input_size, conf_threshold, nms_threshold):
+        self.model_path = model_path
+        self.classes = list(names)
+        self.backend = backend
+        self.image_size = input_size
+        self.confThreshold = conf_threshold
+        self.nmsThreshold = nms_threshold
+        self.calls = 0
+        self.total_time = 0.0
+        self.last_latency = 0.0
+        self.load_time = 0.0
+        self.warm_up_time = 0.0
+        self.detect_seconds = metrics.histogram("detector_seconds", backend=backend, call="detect")
+        self.batch_seconds = metrics.histogram("detector_seconds", backend=backend, call="batch")
+        self.frames_detected = metrics.counter("detector_frames", backend=backend)
+
+    @abc.abstractmethod
+    def _detect(self, frames, classes):
+        """
+        Returns (class_ids, scores, boxes) of every frame, only the given classes when classes is not None
+        """
+
+    def _record(self, start, frames, histogram):
+        self.last_latency = time.perf_counter() - start
+        self.total_time += self.last_latency
+        self.calls += frames
+        histogram.observe(self.last_latency)
+        self.frames_detected.inc(frames)
+
+    def detect(self, frame, classes=None):
+        start = time.perf_counter()
+        result = self._detect([frame], classes)[0]
+        self._record(start, 1, self.detect_seconds)
+        return result
+
+    def detect_batch(self, frames, classes=None):
+        if len(frames) == 0:
+            return []
+        start = time.perf_counter()
+        results = self._detect(list(frames), classes)
+        self._record(start, len(frames), self.batch_seconds)
+        return results
+
+    def warm_up(self):
+        start = time.perf_counter()
+        self._detect([np.zeros((self.image_size, self.image_size, 3), dtype=np.uint8)], None)
+        self.warm_up_time = time.perf_counter() - start
+        logger.info("%s warm up took %.2fs", self.backend, self.warm_up_time)
+
+    @property
+    def mean_latency(self):
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def stats(self):
+        return {
+            "backend": self.backend,
+            "load_time": self.load_time,
+            "warm_up_time": self.warm_up_time,
+            "calls": self.calls,
+            "last_latency": self.last_latency,
+            "mean_latency": self.mean_latency,
+        }
+
+
+class UltralyticsDetector(Detector):
+    """
+    An ultralytics .pt model run by PyTorch
+    """
+    runtime = "torch"
+
+    def __init__(self, model_path, input_size=None, threads=None, conf_threshold=0.5, nms_threshold=0.4):
+        import torch
+        from ultralytics import YOLO
+
+        start = time.perf_counter()
+        if threads is not None:
+            torch.set_num_threads(threads)
+        self.model = YOLO(model_path)
+        names = [self.model.names[i] for i in range(len(self.model.names))]
+        super().__init__(model_path, names, "torch", input_size or 640, conf_threshold, nms_threshold)
+        self.load_time = time.perf_counter() - start
+
+    def _detect(self, frames, classes):
+        results = self.model(frames, verbose=False, conf=self.confThreshold, iou=self.nmsThreshold,
+                             imgsz=self.image_size, classes=None if classes is None else list(classes))
+        outputs = []
+        for result in results:
+            boxes = result.boxes.xywh.cpu().numpy().astype(np.float32)
+            boxes[:, :2] -= boxes[:, 2:] / 2
+            outputs.append((result.boxes.cls.cpu().numpy().astype(np.int32),
+                            result.boxes.conf.cpu().numpy().astype(np.float32), boxes))
+        return outputs
+
+
+class OnnxDetector(Detector):
+    """
+    An ultralytics model exported to ONNX, run by ONNX Runtime or by OpenCV DNN.
+    Preprocessing (letterbox) and decoding are done here with OpenCV and numpy, so neither torch
+    nor ultralytics is needed at runtime
+    """
+    def __init__(self, model_path, runtime="onnxruntime", backend="onnx", input_size=None, threads=None,
+                 conf_threshold=0.5, nms_threshold=0.4):
+        start = time.perf_counter()
+        self.runtime = runtime
+        self.max_batch = None  # None when the model takes any batch size
+        if runtime == "onnxruntime":
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if threads is not None:
+                options.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+            model_input = self.session.get_inputs()[0]
+            self.input_name = model_input.name
+            batch, _, height, _ = model_input.shape
+            if isinstance(batch, int):
+                self.max_batch = batch
+            if isinstance(height, int):
+                if input_size not in (None, height):
+                    logger.warning("%s has a fixed input size of %d, ignoring %s", model_path, height, input_size)
+                input_size = height
+        elif runtime == "opencv":
+            if threads is not None:
+                cv2.setNumThreads(threads)
+            self.net = cv2.dnn.readNetFromONNX(model_path)
+            self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+            self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        else:
+            raise ValueError(f"Unknown ONNX runtime '{runtime}', expected 'onnxruntime' or 'opencv'")
+        super().__init__(model_path, load_names(model_path), backend, input_size or 640, conf_threshold, nms_threshold)
+        self.load_time = time.perf_counter() - start
+        logger.info("Loaded %s on %s in %.2fs", model_path, runtime, self.load_time)
+
+    def _forward(self, blob):
+        if self.runtime == "onnxruntime":
+            return self.session.run(None, {self.input_name: blob})[0]
+        self.net.setInput(blob)
+        return self.net.forward()
+
+    def _detect(self, frames, classes):
+        prepared = [letterbox(frame, self.image_size) for frame in frames]
+        blob = cv2.dnn.blobFromImages([image for image, _, _ in prepared], 1/255, swapRB=True)
+        step = self.max_batch or len(frames)
+        output = np.concatenate([self._forward(blob[i:i + step]) for i in range(0, len(frames), step)])
+        return [
+            decode_ultralytics_outputs(output[i], scale, pad, frame.shape, self.confThreshold, self.nmsThreshold,
+                                       classes)
+            for i, (frame, (_, scale, pad)) in enumerate(zip(frames, prepared))
+        ]
+
+
+def load_detector(backend, model_path, cfg_path=None, dnn_target="cpu", input_size=None, threads=None,
+                  conf_threshold=0.5, nms_threshold=0.4, calibration_video=None):
+    """
+    Returns the shared detector of a model on a backend, loaded and warmed up on first use.
+    Ultralytics models are exported to ONNX (and quantized to INT8) next to the .pt file the first
+    time an onnx backend asks for them
+    Args:
+        backend: One of DETECTOR_BACKENDS
+        model_path: YOLOv4 .weights (with cfg_path, opencv only), or an ultralytics .pt or exported .onnx
+        cfg_path: YOLOv4 config
+        dnn_target: OpenCV DNN target of YOLOv4, see object_detection.BACKENDS
+        input_size: Side of the model input, None keeps the model's own
+        threads: CPU threads the backend runs on, None leaves its default
+        conf_threshold: Minimum score of a box, YOLOv4 keeps its own
+        nms_threshold: IoU threshold of NMS, YOLOv4 keeps its own
+        calibration_video: Video the INT8 model is calibrated on, needed for onnx_int8
+    """
+    if backend not in DETECTOR_BACKENDS:
+        raise ValueError(f"Unknown detector backend '{backend}', expected one of {list(DETECTOR_BACKENDS)}")
+    if model_path.endswith(".weights"):
+        if backend != "opencv":
+            raise ValueError(f"YOLOv4 darknet weights only run on the opencv backend, not on {backend}")
+        return get_detector(weights_path=model_path, cfg_path=cfg_path, backend=dnn_target, input_size=input_size,
+                            threads=threads)
+
+    key = (backend, os.path.abspath(model_path), input_size, threads, conf_threshold, nms_threshold)
+    with _detectors_lock:
+        detector = _detectors.get(key)
+        if detector is None:
+            if backend == "torch":
+                if model_path.endswith(".onnx"):
+                    raise ValueError("The torch backend needs the .pt model, not its ONNX export")
+                detector = UltralyticsDetector(model_path, input_size, threads, conf_threshold, nms_threshold)
+            else:
+                onnx_path = export_onnx(model_path, input_size or 640)
+                if backend == "onnx_int8":
+                    if calibration_video is None:
+                        raise ValueError("onnx_int8 needs a calibration video")
+                    onnx_path = quantize_onnx(onnx_path, calibration_frames(calibration_video), input_size or 640)
+                detector = OnnxDetector(onnx_path, runtime="opencv" if backend == "opencv" else "onnxruntime",
+                                        backend=backend, input_size=input_size, threads=threads,
+                                        conf_threshold=conf_threshold, nms_threshold=nms_threshold)
+            detector.warm_up()
+            _detectors[key] = detector
+        return detector
+
+
+def camera_detector_spec():
+    """
+    Returns the load_detector arguments of the 4 camera mode as set in arguments.py, and the files the
+    model is loaded from for the detection cache key
+    """
+    if detector_model_path is None:
+        spec = {"backend": detector_backend, "model_path": weights_path, "cfg_path": cfg_path,
+                "dnn_target": dnn_backend, "input_size": detector_input_size, "threads": detector_threads}
+        return spec, [weights_path, cfg_path]
+    spec = {"backend": detector_backend, "model_path": detector_model_path, "input_size": detector_input_size,
+            "threads": detector_threads, "calibration_video": camera0}
+    return spec, None
+
+
+def camera_detector():
+    """
+    Returns the detector of the 4 camera mode as set in arguments.py, and the files it was loaded from
+    for the detection cache key. With inference_server_address set the model runs on the shared
+    inference server instead of in this process
+    """
+    spec, files = camera_detector_spec()
+    if inference_server_address:
+        from inference_server import RemoteDetector
+
+        detector = RemoteDetector(inference_server_address, authkey=inference_server_authkey, **spec)
+    else:
+        detector = load_detector(**spec)
+    return detector, files or [detector.model_path]
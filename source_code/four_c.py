@@ -1,20 +1,35 @@
+import logging
 import time
 import cv2
+import metrics
+from capture import CameraGroup
+from detection_cache import flush_caches, get_lane_caches
+from cadence import DetectionCadence
+from compute_budget import ComputeBudget
 from helper_func import ObjectTracking
-from deep_sort_realtime.deepsort_tracker import DeepSort
-from arguments import camera0, camera1, camera2, camera3
+from motion_gate import MotionGate
+from object_detection import VEHICLE_CLASSES
+from signal_timing import start_metrics_writer, stop_metrics_writer, timing  # timing is imported from here too
+import startup
+from lane_workers import run_lane_workers
+from detectors import camera_detector
+from trackers import make_tracker
+from arguments import (camera0, camera1, camera2, camera3, batched_inference, capture_policy, capture_buffer_size,
+                       lane_groups, detection_interval_4c, max_detection_interval, target_frame_time, motion_gating,
+                       motion_min_area, detection_cache_dir, detection_cache_max_bytes, headless, compute_fps_budget,
+                       green_lane_weight, served_lane_weight, waiting_lane_weight, decision_lookahead,
+                       tracker_backend)
 
-cap = cv2.VideoCapture(camera0)
-cap1 = cv2.VideoCapture(camera1)
-cap2 = cv2.VideoCapture(camera2)
-cap3 = cv2.VideoCapture(camera3)
+CAMERAS = {"lane0": camera0, "lane1": camera1, "lane2": camera2, "lane3": camera3}
+
+logger = logging.getLogger(__name__)
 
 
 def frame_processing(no_of_vehicles_per_lane, green_lane):
     """
     This function processes the frames from the video feed
     It uses the ObjectTracking class to detect and track objects in the frames
-    It also uses the DeepSort class to track the detected objects between frames and assign unique IDs to them
+    It also uses a tracker (DeepSort or ByteTrack, see trackers.py) to track the detected objects between frames and assign unique IDs to them
     The function also determines the number of vehicles in each lane and stores the information in a dictionary 'no_of_vehicles_per_lane'.
     Args:
         no_of_vehicles_per_lane: A shared dictionary containing the number of vehicles in each lane
@@ -22,7 +37,40 @@ def frame_processing(no_of_vehicles_per_lane, green_lane):
     Returns:
         None
     """
-    ob = ObjectTracking()
+    writer = start_metrics_writer("vision")
+    # How often every lane goes through the detector, from the signal state and the frame budget
+    budget = ComputeBudget(CAMERAS, fps_budget=compute_fps_budget, green_weight=green_lane_weight,
+                           served_weight=served_lane_weight, waiting_weight=waiting_lane_weight,
+                           lookahead=decision_lookahead)
+    if lane_groups:
+        # Each group of lanes gets its own worker process with its own detector and trackers
+        run_lane_workers(no_of_vehicles_per_lane, green_lane, CAMERAS, lane_groups,
+                         capture_policy=capture_policy, capture_buffer_size=capture_buffer_size,
+                         batched=batched_inference, detection_interval=detection_interval_4c,
+                         max_detection_interval=max_detection_interval, target_frame_time=target_frame_time,
+                         motion_gating=motion_gating, motion_min_area=motion_min_area,
+                         cache_dir=detection_cache_dir, cache_max_bytes=detection_cache_max_bytes, budget=budget,
+                         tracker_backend=tracker_backend)
+        stop_metrics_writer(writer)
+        return
+
+    # Each camera is read on its own thread, so a slow one does not stall the other lanes.
+    # They are opened first so the cameras connect while the detector loads and warms up
+    cameras = CameraGroup(CAMERAS, policy=capture_policy, buffer_size=capture_buffer_size).start()
+
+    # The detector is loaded once here and shared by all four lanes
+    try:
+        detector, detector_files = camera_detector()
+    except Exception:
+        cameras.release()
+        raise
+    startup.mark("detector_ready")
+    # Frames of video files that were detected on an earlier run are read back from disk
+    caches = get_lane_caches(detection_cache_dir, CAMERAS, detector, detector_files,
+                             max_bytes=detection_cache_max_bytes, classes=VEHICLE_CLASSES)
+    # headless nothing is shown, so the tracks are not drawn either
+    ob = ObjectTracking(detector=detector, caches=caches, draw=not headless)
+    cycles = 0
 
     objects = [
         "person", "bicycle", "car", "motorbike", "aeroplane", "bus", "train", "truck",
@@ -38,123 +86,75 @@ def frame_processing(no_of_vehicles_per_lane, green_lane):
         "refrigerator", "book", "clock", "vase", "scissors", "teddy bear", "hair drier",
         "toothbrush"
     ]
-    tracker = DeepSort()
-    tracker1 = DeepSort()
-    tracker2 = DeepSort()
-    tracker3 = DeepSort()
+    tracker = make_tracker(tracker_backend)
+    tracker1 = make_tracker(tracker_backend)
+    tracker2 = make_tracker(tracker_backend)
+    tracker3 = make_tracker(tracker_backend)
+    # Full detection every detection_interval_4c frames per lane, the tracker predicts the frames in between
+    cadences = {lane: DetectionCadence(interval=detection_interval_4c, max_interval=max_detection_interval,
+                                       target_frame_time=target_frame_time)
+                for lane in CAMERAS}
+    # Lanes where nothing moves keep their last count instead of going through YOLOv4
+    gates = {lane: MotionGate(min_motion=motion_min_area) for lane in CAMERAS} if motion_gating else None
+
+    lane_vehicles = {lane: metrics.gauge("lane_vehicles", lane=lane) for lane in CAMERAS}
+    cycle_seconds = metrics.histogram("stage_seconds", pipeline="4c", stage="cycle")
 
     while True:
         # Each frame represent frames from each lane entering the intersection
-        ret, frame0 = cap.read()  #lane0
-        if not ret:
+        captured = cameras.read()
+        if captured is None:
             green_lane.value = "Error"
             # if there are no more frames to read from the video, break out of the loop
             # but i will recommend the system should be able to switch to a conventional traffic light system
             # rather than breaking out of the loop and causing the system to stop working
 
             break
+        startup.mark("first_frame")
 
-        ret1, frame1 = cap1.read()  #lane1
-        if not ret1:
-            green_lane.value = "Error"
-
-            break
-
-        ret2, frame2 = cap2.read()  #lane2
-        if not ret2:
-            green_lane.value = "Error"
-
-            break
-
-        ret3, frame3 = cap3.read()  #lane3
-        if not ret3:
-            green_lane.value = "Error"
-
-            break
-
-        frames = {"lane0": frame0, "lane1": frame1, "lane2": frame2, "lane3": frame3}
+        frames = {lane: captured[lane].frame for lane in captured.keys()}
         trkr = {"lane0": tracker, "lane1": tracker1, "lane2": tracker2, "lane3": tracker3}
 
-        for frame in frames.keys():
-            print(f"{green_lane}")
-            if frame == green_lane:
-                print(f"Green light is on {frame}. Skipping this frame")
-                continue
-            detections, v_frame = ob.plot_box(frame=frames[frame], list=objects)
-            detect_frame, vehicles_south, vehicles_north = ob.track_detect(detections=detections, img=v_frame,
-                                                                           tracker=trkr[frame])
-            no_of_vehicles_per_lane[frame] = len(vehicles_south)
-            print(no_of_vehicles_per_lane)
-            cv2.imshow("Frame", detect_frame)
-            key = cv2.waitKey(1)
-            if key == 27:
-                break
-    cap.release()
-    cv2.destroyAllWindows()
-
+        cycle_start = time.perf_counter()
+        signal = green_lane.phase()
+        logger.debug("Signal: %s", signal)
+        # the lanes whose counts decide the next phase get every frame, the green lane and the ones
+        # already served in the cycle fewer
+        lanes = {lane: frames[lane] for lane in budget.select(list(frames), signal)}
 
-def timing(no_of_vehicles_per_lane, green_lane):
-    """
-    This function controls the timing of the traffic light
-    It checks the number of vehicles in each lane and determines the lane with the highest number of vehicles
-    The lane with the highest number of vehicles is given the green light
-    And the time the green light is on is determined by the number of vehicles in the lane
-    Once a lane has been given the green light, it is added to the list of lanes
-    that has been greenlighted until all lanes have been served. This ensures that no lane is left out
-    in a cycle. The algorithm is designed to serve all lanes in a cycle before starting a new cycle. And it always 
-    picks the lane with the highest number of vehicles to serve first.
-    Args:
-        no_of_vehicles_per_lane: A shared dictionary containing the number of vehicles in each lane
-        green_lane: A shared variable containing the lane that has the green light
-    Returns:
-        None
-    """
-    lane_time = {}  # This dictionary store the lanes which have turned green and their corresponding time
+        outputs = ob.process_lanes(frames=lanes, trackers=trkr, list=objects, cadences=cadences,
+                                   batched=batched_inference, gates=gates,
+                                   frame_indices={lane: captured[lane].index for lane in lanes})
 
-    while True:
-        if green_lane.value == "None":
-            green_lane.value = "lane0"
-            print(f"Green light is on {green_lane}")
-            time.sleep(
-                100)  # This is just a placeholder for the actual code that will be used to control the traffic light hardware
-            continue
-        elif green_lane.value == "Error":
-            break
+        for frame, (detect_frame, vehicles_south, vehicles_north) in outputs.items():
+            no_of_vehicles_per_lane[frame] = len(vehicles_south)
+            lane_vehicles[frame].set(len(vehicles_south))
+            cameras.mark_done(captured[frame])
+            logger.debug("Vehicles per lane: %s", no_of_vehicles_per_lane)
+            if not headless:
+                cv2.imshow("Frame", detect_frame)
+                key = cv2.waitKey(1)
+                if key == 27:
+                    break
+        cycle_seconds.observe(time.perf_counter() - cycle_start)
+        if outputs:
+            startup.mark("first_counts")
+        cycles += 1
+        if cycles % 100 == 0:
+            logger.info("Detector stats: %s", detector.stats())
+            logger.info("Capture stats: %s", cameras.stats())
+            logger.info("Compute budget: %s", budget.stats())
+            logger.info("Detection cadence: %s", {lane: cadence.stats() for lane, cadence in cadences.items()})
+            if gates is not None:
+                logger.info("Motion gating: %s", {lane: gate.stats() for lane, gate in gates.items()})
+            if caches:
+                logger.info("Detection cache: %s", {lane: cache.stats() for lane, cache in caches.items()})
+    cameras.release()
+    flush_caches()
+    stop_metrics_writer(writer)
+    if not headless:
+        cv2.destroyAllWindows()
 
-        if len(lane_time.keys()) >= 4:
-            nvpl = no_of_vehicles_per_lane.copy()
-            print(f"All lanes have been served {lane_time} {nvpl}")
-            lane_time.clear()
-            max_key = max(nvpl, key=nvpl.get)
-            lane_time[max_key] = no_of_vehicles_per_lane[max_key] * 100
-            green_lane.value = max_key
-            print(f"Green light is on {green_lane}")
-            time.sleep(lane_time[
-                           max_key])  # This is just a placeholder for the actual code that will be used to control the traffic light hardware
-        elif len(no_of_vehicles_per_lane.keys()) == 0:
-            green_lane.value = "lane0"
-            print(f"Green light is on {green_lane}")
-            time.sleep(
-                100)  # This is just a placeholder for the actual code that will be used to control the traffic light hardware
-        else:
-            lane_left = {}
-            for lane in no_of_vehicles_per_lane.keys():
-                if lane not in lane_time.keys():
-                    lane_left[lane] = no_of_vehicles_per_lane[lane]
-            if len(lane_left.keys()) == 0:
-                continue
-            max_key = max(lane_left, key=lane_left.get)
-            green_lane.value = max_key
-            if lane_left[max_key] == 0:
-                lane_time[max_key] = no_of_vehicles_per_lane[max_key]
-                print(f"Green light is on {green_lane}")
-                time.sleep(
-                    100)  # This is just a placeholder for the actual code that will be used to control the traffic light hardware
-            else:
-                lane_time[max_key] = no_of_vehicles_per_lane[max_key] * 100  #seconds
-                print(f"Green light is on {green_lane}")
-                time.sleep(lane_time[
-                               max_key])  # This is just a placeholder for the place of the actual code that will be used to control the traffic light hardware
 
 # if __name__ == '__main__':
 #     """
@@ -1,94 +1,289 @@
-from object_detection import ObjectDetection
+import logging
+import time
+from typing import NamedTuple
+import numpy as np
+import metrics
+from motion_gate import crop_to_region, region_covers
+from object_detection import VEHICLE_CLASSES, deepsort_detections, get_detector
+from track_store import TrackStore
+from trackers import predict_tracks
 import cvzone
 
+logger = logging.getLogger(__name__)
+
+
+class LaneResult(NamedTuple):
+    """
+    Detections of a single lane, as returned by ObjectTracking.plot_box_batch
+    """
+    lane: str
+    detections: list
+    frame: object
+
+
+def shift_boxes(boxes, offset):
+    """
+    Moves (x, y, w, h) boxes found in a crop back to the coordinates of the full frame
+    """
+    dx, dy = offset
+    if dx == 0 and dy == 0:
+        return boxes
+    boxes = np.array(boxes, copy=True).reshape(-1, 4)
+    boxes[:, 0] += dx
+    boxes[:, 1] += dy
+    return boxes
+
+
 class ObjectTracking:
     """
-    This class is used to track objects in a frame using DeepSort
+    This class is used to track objects in a frame using DeepSort or ByteTrack, see trackers.py
     """
-    def __init__(self):
-        self.previous_positions = {}
+    def __init__(self, detector=None, caches=None, track_ttl=100, draw=True):
+        """
+        Args:
+            detector: The ObjectDetection to use, defaults to the process wide shared one from get_detector()
+            caches: A dictionary mapping lanes to the DetectionCache of their video, see detection_cache.get_cache
+            track_ttl: Forget the last position of a track after this many frames of its lane without it
+            draw: Draw the tracks into the frames, turned off when nothing shows them
+        """
+        self.draw = draw
+        self.track_ttl = track_ttl
+        self.track_stores = {}  # lane -> TrackStore holding the last position of every track
+        self.detector = detector if detector is not None else get_detector()
+        self.caches = caches or {}
+        self.matched_tracks = 0  # confirmed tracks updated by a detection in the last track_detect call
+        self.last_outputs = {}  # last output of process_lanes for every lane, reused while a lane is static
+        self.detect_seconds = metrics.histogram("stage_seconds", pipeline="4c", stage="detect")
+        self.lane_metrics = {}
 
-    def plot_box(self, frame, list):
+    def cached(self, lane, frame_index):
+        """
+        Returns the cached detector output of a frame of the lane, None if it has to be detected
+        """
+        cache = self.caches.get(lane)
+        if cache is None or frame_index is None:
+            return None
+        return cache.get(frame_index)
+
+    def is_cached(self, lane, frame_index):
+        cache = self.caches.get(lane)
+        return cache is not None and frame_index is not None and frame_index in cache
+
+    def _store(self, lane, frame_index, result, offset=None):
+        """
+        Puts the detector output of a whole frame in the cache of its lane. The output of a crop (offset is
+        its (x, y) in the frame) is only moved to frame coordinates, it misses everything outside the crop
+        and would be read back as the whole frame by a run without motion gating or by another lane
+        """
+        class_ids, scores, boxes = result
+        if offset is not None:
+            return class_ids, scores, shift_boxes(boxes, offset)
+        cache = self.caches.get(lane)
+        if cache is not None and frame_index is not None:
+            cache.put(frame_index, class_ids, scores, boxes)
+        return class_ids, scores, boxes
+
+    def plot_box(self, frame, list, lane=None, frame_index=None, offset=None):
         """
         This function is used to plot bounding boxes around detected objects in a frame
         
         Args:
             frame: The frame in which the objects are to be detected
             list: A list of objects to be detected in the frame
+            lane: The lane of the frame, its DetectionCache is used if there is one
+            frame_index: Index of the frame in its video, the key of the cache
+            offset: (x, y) of frame in the full frame when frame is a crop, None when it is the full frame
         Returns: A tuple containing the detections and the frame with bounding boxes around the detected objects"""
-        od = ObjectDetection()
-        detections = []
-        (class_ids, scores, boxes) = od.detect(frame)  # Detect objects in the frame and consumes alot of time and cpu resources
-        for box, class_id, score in zip(boxes, class_ids, scores):
-            if class_id in [1,2,3,5]:
-                (x, y, w, h) = box
-                current_class = list[class_id]
-                detections.append((([x, y, w, h]), score, current_class))
-        return detections, frame
+        result = self.cached(lane, frame_index)
+        if result is None:
+            result = self.detector.detect(frame, classes=VEHICLE_CLASSES)  # Detect objects in the frame and consumes alot of time and cpu resources
+            result = self._store(lane, frame_index, result, offset)
+        (class_ids, scores, boxes) = result
+        return self.vehicle_detections(class_ids, scores, boxes, list), frame
+
+    def plot_box_batch(self, frames, list, frame_indices=None, offsets=None):
+        """
+        Batched version of plot_box, all the frames are detected with one forward pass
+
+        Args:
+            frames: A dictionary mapping each lane to its frame
+            list: A list of objects to be detected in the frame
+            frame_indices: A dictionary mapping each lane to the index of its frame, for the cache
+            offsets: A dictionary mapping the lanes whose frame is a crop to its (x, y) in the full frame
+        Returns: A dictionary mapping each lane to its LaneResult"""
+        frame_indices = frame_indices or {}
+        offsets = offsets or {}
+        results = {}
+        for lane in frames.keys():
+            result = self.cached(lane, frame_indices.get(lane))
+            if result is not None:
+                results[lane] = result
+        lanes = [lane for lane in frames.keys() if lane not in results]
+        outputs = self.detector.detect_batch([frames[lane] for lane in lanes], classes=VEHICLE_CLASSES)
+        for lane, result in zip(lanes, outputs):
+            results[lane] = self._store(lane, frame_indices.get(lane), result, offsets.get(lane))
+        return {
+            lane: LaneResult(lane, self.vehicle_detections(*results[lane], list), frames[lane])
+            for lane in frames.keys()
+        }
+
+    def _lane_metrics(self, lane):
+        """
+        Returns the (track latency, frames per path) metrics of a lane, looked up once per lane
+        """
+        lane_metrics = self.lane_metrics.get(lane)
+        if lane_metrics is None:
+            lane_metrics = (
+                metrics.histogram("stage_seconds", pipeline="4c", stage="track", lane=lane),
+                {path: metrics.counter("lane_frames", lane=lane, path=path)
+                 for path in ("static", "predicted", "detected")},
+            )
+            self.lane_metrics[lane] = lane_metrics
+        return lane_metrics
+
+    def process_lanes(self, frames, trackers, list, cadences=None, batched=True, gates=None, frame_indices=None):
+        """
+        This function detects and tracks the vehicles of several lanes.
+        Lanes whose MotionGate sees no motion are skipped completely and keep their last output.
+        Lanes whose DetectionCadence skips this frame are not detected, their tracker
+        only predicts where the vehicles it already knows have moved to (see trackers.predict_tracks).
+        The other lanes are detected, limited to the region where the gate saw motion when
+        every vehicle the tracker still follows is inside it.
+
+        Args:
+            frames: A dictionary mapping each lane to its frame
+            trackers: A dictionary mapping each lane to its tracker, see trackers.make_tracker
+            list: A list of objects to be detected in the frame
+            cadences: A dictionary mapping each lane to its DetectionCadence, None detects every lane
+            batched: Detect the lanes with one forward pass
+            gates: A dictionary mapping each lane to its MotionGate, None runs every lane
+            frame_indices: A dictionary mapping each lane to the index of its frame, lanes with a
+                DetectionCache read the detections of frames seen before from it
+        Returns: A dictionary mapping each lane to the output of track_detect"""
+        start = time.perf_counter()
+        frame_indices = frame_indices or {}
+        outputs = {}
+        detect = {}
+        offsets = {}
+        for lane, frame in frames.items():
+            region = gates[lane].check(frame) if gates is not None else None
+            if region is None and gates is not None and lane in self.last_outputs:
+                # nothing moved, the counts of the last frame still hold
+                _, vehicles_south, vehicles_north = self.last_outputs[lane]
+                outputs[lane] = (frame, vehicles_south, vehicles_north)
+                self._lane_metrics(lane)[1]["static"].inc()
+                continue
+            if cadences is None or cadences[lane].should_detect():
+                # only crop while every live track is inside the region, stopped vehicles are not in it
+                if region is not None and not self.is_cached(lane, frame_indices.get(lane)) and \
+                        region_covers(region, self.track_store(lane).live_positions()):
+                    detect[lane], offset = crop_to_region(frame, region)
+                    if detect[lane] is not frame:
+                        offsets[lane] = offset
+                else:
+                    detect[lane] = frame
+
+        if batched and detect:
+            # One forward pass for all the lanes, split back per lane before tracking
+            results = self.plot_box_batch(frames=detect, list=list, frame_indices=frame_indices, offsets=offsets)
+        else:
+            results = {
+                lane: LaneResult(lane, *self.plot_box(frame=detect[lane], list=list, lane=lane,
+                                                      frame_index=frame_indices.get(lane),
+                                                      offset=offsets.get(lane)))
+                for lane in detect
+            }
+        detect_time = (time.perf_counter() - start) / max(len(detect), 1)
+        if detect:
+            self.detect_seconds.observe(time.perf_counter() - start)
+
+        for lane, frame in frames.items():
+            if lane in outputs:
+                continue
+            lane_start = time.perf_counter()
+            result = results.get(lane)
+            detections = result.detections if result is not None else []
+            outputs[lane] = self.track_detect(detections=detections, img=frame, tracker=trackers[lane], lane=lane,
+                                              predict=result is None)
+            self.last_outputs[lane] = outputs[lane]
+            elapsed = time.perf_counter() - lane_start
+            track_seconds, lane_frames = self._lane_metrics(lane)
+            track_seconds.observe(elapsed)
+            lane_frames["detected" if result is not None else "predicted"].inc()
+            if result is not None and gates is not None:
+                gates[lane].record_detection(detect_time + elapsed)
+            if cadences is not None:
+                if result is not None:
+                    cadences[lane].record_detection(detect_time + elapsed, len(detections), self.matched_tracks)
+                else:
+                    cadences[lane].record_prediction(elapsed)
+        return outputs
+
+    def vehicle_detections(self, class_ids, scores, boxes, list):
+        """
+        Keeps the vehicles (bicycle, car, motorbike, bus) out of the raw detections
+        and puts them in the format expected by DeepSort.
+        The detector already drops the other classes, cached frames may still have them
+        """
+        return deepsort_detections(class_ids, scores, boxes, list, VEHICLE_CLASSES)
     
-    def track_detect(self, detections, img, tracker):
+    def track_detect(self, detections, img, tracker, lane=None, predict=False):
         """
         This function is used to track detected objects in a frame
         Args:
             detections: The detected objects in the frame
             img: The frame in which the objects are to be tracked
-            tracker: The tracker object used to track the objects"""
-        tracks = tracker.update_tracks(detections, frame=img)
-        direction_s = {}
-        direction_n = {}
+            tracker: The tracker object used to track the objects, anything with DeepSort's update_tracks
+            lane: The lane of the frame, directions are kept per lane
+            predict: The detector skipped the frame, the tracks are only moved and no miss is counted"""
+        if predict:
+            tracks = predict_tracks(tracker)
+        else:
+            tracks = tracker.update_tracks(detections, frame=img)
+            self.matched_tracks = sum(1 for track in tracks if track.is_confirmed() and track.time_since_update == 0)
+        direction_s, direction_n = self.track_directions(tracks, lane)
+        if self.draw:
+            self.draw_tracks(img, tracks)
+        return img, direction_s, direction_n
+
+    def track_directions(self, tracks, lane=None):
+        """
+        Returns the (entering, leaving) dictionaries of the confirmed tracks of a lane,
+        worked out for all of them in one step by the TrackStore of the lane
+        """
+        confirmed = [track for track in tracks if track.is_confirmed()]
+        if logger.isEnabledFor(logging.DEBUG):
+            for track in confirmed:
+                logger.debug("mean(%s): %s. original_ltwh: %s", track.track_id, track.mean, track.original_ltwh)
+        store = self.track_store(lane)
+        if not confirmed:
+            store.update([], [])
+            return {}, {}
+        north, south = store.update([track.track_id for track in confirmed], [track.mean for track in confirmed],
+                                    [track.is_deleted() for track in confirmed])
+        return {track_id: "South" for track_id in south}, {track_id: "North" for track_id in north}
 
+    def draw_tracks(self, img, tracks):
+        """
+        Draws the box and ID of every confirmed track on the frame
+        """
         for track in tracks:
             if not track.is_confirmed():
                 continue
-            track_id = track.track_id
-        
-            print(f"mean({track_id}): {getattr(track, 'mean')}. original_ltwh: {getattr(track, 'original_ltwh')}")
-            ltrb = track.to_ltrb()
-            north, south = self.get_direction(track=track)
-            direction_s.update(south)
-            direction_n.update(north)
-
-            
-            bbox = ltrb
-            x1, y1, x2, y2 = bbox
+            x1, y1, x2, y2 = track.to_ltrb()
             x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
             w, h = x2-x1, y2-y1
 
-            cvzone.putTextRect(img, f'ID: {track_id}', (x1, y1), scale=1, thickness=1, colorR=(0,0,255))
+            cvzone.putTextRect(img, f'ID: {track.track_id}', (x1, y1), scale=1, thickness=1, colorR=(0,0,255))
             cvzone.cornerRect(img, (x1, y1, w, h), l=9, rt=1, colorR=(255,0,255))
-        return img, direction_s, direction_n
+        return img
     
-    def get_direction(self, track):
+    def track_store(self, lane=None):
         """
-        Determines the direction of a given track based on its current position and previous positions.
-
-        Args:
-            track: The track object containing information about the track.
-
-        Returns:
-            A tuple containing two dictionaries: `direction_north` and `direction_south`.
-            `direction_north` contains the track IDs and their corresponding direction as "South" (entering the intersection).
-            `direction_south` contains the track IDs and their corresponding direction as "North" (leaving the intersection).
-        """
-        direction_north = {}
-        direction_south = {}
-        current_position = track.mean[:]
-
-        state = track.is_deleted()
-        track_id = track.track_id
-
-        if track_id in self.previous_positions:
-            # Calculate the direction vector
-            if state:
-                del self.previous_positions[track_id]
-            else:
-                if current_position[1] < self.previous_positions[track_id][1] and current_position[5] > current_position[4]:
-                    direction_north[track_id] = "North" # Leaving the intersection
-                elif current_position[1] > self.previous_positions[track_id][1] and current_position[5] > current_position[4]:
-                    direction_south[track_id] = "South" # Entering the intersection
-                self.previous_positions[track_id] = current_position
-        elif not state and track_id not in self.previous_positions:
-            self.previous_positions[track_id] = current_position
-        # use velocity and position to determine direction
-            
-        return direction_north, direction_south
\ No newline at end of file
+        Returns the TrackStore of a lane, every lane has its own tracker so its own track ids
+        """
+        store = self.track_stores.get(lane)
+        if store is None:
+            store = TrackStore(ttl=self.track_ttl)
+            self.track_stores[lane] = store
+        return store
@@ -0,0 +1,576 @@
+import itertools
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+import numpy as np
+import metrics
+from detectors import load_detector
+
+logger = logging.getLogger(__name__)
+
+# where the shared secret is read from when arguments.py does not set one
+AUTHKEY_ENV = "TRAFFIC_INFERENCE_AUTHKEY"
+
+# the part of a load_detector spec a client sends, the rest (size, thresholds, threads...) is the server's
+CLIENT_SPEC = ("backend", "model_path", "cfg_path")
+
+
+def resolve_authkey(authkey=None):
+    """
+    Returns the shared secret of the server and its clients as bytes, authkey or else the
+    TRAFFIC_INFERENCE_AUTHKEY environment variable. Every message is pickled, whoever knows the key can
+    make the server run code, so there is no default key and a missing one is an error
+    """
+    authkey = authkey or os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise ValueError(f"The inference server needs a shared secret, set {AUTHKEY_ENV} or "
+                         "inference_server_authkey in arguments.py")
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def model_files(spec):
+    """
+    Returns (backend, model file, cfg file) of a spec (the keyword arguments of detectors.load_detector),
+    what the server looks its models up by
+    """
+    cfg_path = spec.get("cfg_path")
+    return spec["backend"], os.path.realpath(spec["model_path"]), cfg_path and os.path.realpath(cfg_path)
+
+
+def parse_address(address):
+    """
+    Returns the multiprocessing.connection address of "host:port" (TCP on the loopback) or of
+    a path (a unix socket)
+    """
+    if isinstance(address, tuple):
+        return address
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit() and "/" not in address:
+        return host, int(port)
+    return address
+
+
+def inherited_resource_tracker():
+    """
+    Returns True when this process uses the resource tracker of the python process that started it
+    (a multiprocessing child), False when it has, or will start, its own. Only right before this
+    process created or attached any shared memory itself
+    """
+    return getattr(resource_tracker._resource_tracker, "_fd", None) is not None
+
+
+def attach_shared_memory(name, own_tracker=True):
+    """
+    Attaches to a shared memory block created by a client.
+    Before Python 3.13 attaching registers the block with the resource tracker, which unlinks it when
+    its processes exit even though the client still owns it. With a tracker of its own the server takes
+    the block off it again. A server started from the client's process shares the client's tracker,
+    the block is already on it and unregistering would drop the client's entry
+    Args:
+        own_tracker: False when the server shares the resource tracker of its clients, see inherited_resource_tracker
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    if own_tracker:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class Request:
+    """
+    One detect call of a client waiting to go through the model
+    """
+    __slots__ = ("client", "request_id", "frames", "classes", "arrived")
+
+    def __init__(self, client, request_id, frames, classes):
+        self.client = client
+        self.request_id = request_id
+        self.frames = frames
+        self.classes = classes
+        self.arrived = time.monotonic()
+
+
+class ModelBatcher(threading.Thread):
+    """
+    This class runs one model of the server. The requests of every client using the model are queued here
+    and run through it together: a batch is sent off once it holds max_batch frames, once its oldest
+    request has waited max_delay seconds or once every client of the model has a request in it,
+    whichever comes first
+    """
+    def __init__(self, name, detector, max_batch=8, max_delay=0.01):
+        super().__init__(name=f"batcher-{name}", daemon=True)
+        self.detector = detector
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.clients = 0  # a client has at most one request waiting, a batch with all of them cannot grow
+        self.batches = 0
+        self.frames = 0
+        self.batch_size = metrics.histogram("inference_batch_frames", model=name)
+        self.queue_seconds = metrics.histogram("inference_queue_seconds", model=name)
+        self.batch_seconds = metrics.histogram("inference_batch_seconds", model=name)
+        self.requests_counter = metrics.counter("inference_requests", model=name)
+
+    def submit(self, request):
+        self.requests_counter.inc()
+        self.requests.put(request)
+
+    def stop(self):
+        self.requests.put(None)
+
+    def attach(self):
+        with self.lock:
+            self.clients += 1
+
+    def detach(self):
+        with self.lock:
+            self.clients -= 1
+
+    def next_batch(self):
+        """
+        Waits for a request and gathers the ones that come in until the batch is full or due.
+        Returns None once the batcher is stopped
+        """
+        request = self.requests.get()
+        if request is None:
+            return None
+        batch = [request]
+        frames = len(request.frames)
+        deadline = request.arrived + self.max_delay
+        while frames < self.max_batch and len(batch) < self.clients:
+            remaining = deadline - time.monotonic()
+            try:
+                request = self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # finish this batch first
+                self.requests.put(None)
+                break
+            batch.append(request)
+            frames += len(request.frames)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            start = time.monotonic()
+            for request in batch:
+                self.queue_seconds.observe(start - request.arrived)
+            # requests asking for different classes cannot share a call, in practice all ask for the same
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.classes, []).append(request)
+            for classes, requests in groups.items():
+                frames = [frame for request in requests for frame in request.frames]
+                try:
+                    results = self.detector.detect_batch(frames, classes=None if classes is None else list(classes))
+                except Exception as error:
+                    logger.exception("Inference on a batch of %d frames failed", len(frames))
+                    for request in requests:
+                        request.client.reply(("error", request.request_id, f"{type(error).__name__}: {error}"))
+                    continue
+                self.batch_size.observe(len(frames))
+                self.batches += 1
+                self.frames += len(frames)
+                position = 0
+                for request in requests:
+                    count = len(request.frames)
+                    request.frames = None  # the views into the client's shared memory go before it is told
+                    request.client.reply(("result", request.request_id, results[position:position + count]))
+                    position += count
+            self.batch_seconds.observe(time.monotonic() - start)
+
+    def stats(self):
+        return {"batches": self.batches, "frames": self.frames,
+                "mean_batch": self.frames / self.batches if self.batches else 0.0}
+
+
+class ClientConnection(threading.Thread):
+    """
+    This class serves one client of the server on its own thread: it loads (or looks up) the model the client
+    asks for, turns its detect messages into Requests on the batcher of that model and sends the results back
+    """
+    def __init__(self, server, connection, number):
+        super().__init__(name=f"inference-client-{number}", daemon=True)
+        self.server = server
+        self.connection = connection
+        self.send_lock = threading.Lock()
+        self.buffers = {}
+
+    def reply(self, message):
+        with self.send_lock:
+            try:
+                self.connection.send(message)
+            except (OSError, EOFError):
+                # the client went away, its thread cleans up
+                pass
+
+    def frames(self, name, layout):
+        """
+        Returns views of the frames the client wrote to its shared memory block
+        """
+        shm = self.buffers.get(name)
+        if shm is None:
+            # a client only grows its block, the old one is not written to anymore
+            self.release()
+            shm = self.buffers[name] = attach_shared_memory(name, self.server.own_tracker)
+        return [np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+                for offset, shape, dtype in layout]
+
+    def release(self):
+        for shm in self.buffers.values():
+            try:
+                shm.close()
+            except BufferError:
+                # a batch still holds a view of it, it is closed with the process
+                pass
+        self.buffers.clear()
+
+    def run(self):
+        batcher = None
+        try:
+            while True:
+                try:
+                    message = self.connection.recv()
+                except (EOFError, OSError):
+                    break
+                kind = message[0]
+                if kind == "detect":
+                    _, request_id, name, layout, classes = message
+                    if batcher is None:
+                        self.reply(("error", request_id, "No model loaded, send a load message first"))
+                        continue
+                    try:
+                        frames = self.frames(name, layout)
+                    except FileNotFoundError:
+                        # the client gave up on the request and dropped its block already
+                        self.reply(("error", request_id, f"Shared memory {name} is gone"))
+                        continue
+                    batcher.submit(Request(self, request_id, frames, classes))
+                elif kind == "load":
+                    try:
+                        loaded = self.server.batcher(message[1])
+                    except PermissionError as error:
+                        logger.warning("Refused to load a model for a client: %s", error)
+                        self.reply(("error", None, f"{type(error).__name__}: {error}"))
+                        continue
+                    except Exception as error:
+                        logger.exception("Could not load %s", message[1])
+                        self.reply(("error", None, f"{type(error).__name__}: {error}"))
+                        continue
+                    if batcher is not None:
+                        batcher.detach()
+                    batcher = loaded
+                    batcher.attach()
+                    self.reply(("loaded", self.server.describe(batcher.detector)))
+                elif kind == "close":
+                    break
+        finally:
+            if batcher is not None:
+                batcher.detach()
+            self.release()
+            self.connection.close()
+            self.server.disconnected(self)
+
+
+class InferenceServer:
+    """
+    This class is a local inference server shared by every intersection running on the host.
+    Each model is loaded once here, however many pipelines use it, and the frames of all of them are
+    batched through it. Clients (see RemoteDetector) connect over a multiprocessing connection, the
+    frames themselves are passed in shared memory, only their layout and the detections are pickled
+    """
+    def __init__(self, address, authkey=None, max_batch=8, max_delay=0.01, models=()):
+        """
+        Args:
+            address: "host:port" or the path of a unix socket, see parse_address
+            authkey: Shared secret of the server and its clients, bytes or str, see resolve_authkey
+            max_batch: Most frames run through a model in one call
+            max_delay: Longest a request waits for others to join its batch, in seconds
+            models: The specs (keyword arguments of detectors.load_detector) of the models served, clients
+                pick one by its files (see model_files), any other model file is refused
+        """
+        self.address = parse_address(address)
+        self.authkey = resolve_authkey(authkey)
+        self.models = {model_files(spec): dict(spec) for spec in models}
+        # has to be looked up before the server attaches to any block, see attach_shared_memory
+        self.own_tracker = not inherited_resource_tracker()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batchers = {}
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.listener = None
+        self.clients_gauge = metrics.gauge("inference_clients")
+
+    def batcher(self, spec):
+        """
+        Returns the batcher of the model whose files are in spec (see model_files), the model is loaded
+        and the batcher started the first time a client asks for it.
+        Only the specs the server was started with are loaded, as they are: the input size, thresholds,
+        threads and calibration video a client may send along are ignored, so every model is in memory once
+        """
+        served = self.models.get(model_files(spec))
+        if served is None:
+            raise PermissionError(f"{spec['model_path']} is not served here, start the server with it")
+        detector = load_detector(**served)
+        with self.lock:
+            batcher = self.batchers.get(id(detector))
+            if batcher is None:
+                name = f"{served['backend']}/{os.path.basename(served['model_path'])}"
+                batcher = ModelBatcher(name, detector, self.max_batch, self.max_delay)
+                batcher.start()
+                self.batchers[id(detector)] = batcher
+                logger.info("Serving %s, batches of up to %d frames within %.0fms", name, self.max_batch,
+                            self.max_delay * 1000)
+            return batcher
+
+    @staticmethod
+    def describe(detector):
+        """
+        What a RemoteDetector needs to stand in for the detector
+        """
+        return {
+            "classes": list(detector.classes),
+            "image_size": detector.image_size,
+            "confThreshold": detector.confThreshold,
+            "nmsThreshold": detector.nmsThreshold,
+            "runtime": detector.runtime,
+            "backend": detector.backend,
+            "model_path": getattr(detector, "model_path", None),
+            "load_time": detector.load_time,
+            "warm_up_time": detector.warm_up_time,
+        }
+
+    def disconnected(self, client):
+        with self.lock:
+            self.clients.discard(client)
+            self.clients_gauge.set(len(self.clients))
+
+    def serve_forever(self):
+        """
+        Accepts clients until stop() is called
+        """
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            # left behind by a server that did not shut down cleanly
+            os.unlink(self.address)
+        listener = self.listener = Listener(self.address, authkey=self.authkey)
+        logger.info("Inference server listening on %s", self.address)
+        for number in itertools.count():
+            try:
+                connection = listener.accept()
+            except OSError:
+                if self.listener is None:
+                    break
+                logger.exception("Could not accept a client")
+                continue
+            except Exception as error:
+                # e.g. a client with the wrong authkey
+                logger.warning("Rejected a client: %s", error)
+                continue
+            client = ClientConnection(self, connection, number)
+            with self.lock:
+                self.clients.add(client)
+                self.clients_gauge.set(len(self.clients))
+            client.start()
+        for batcher in self.batchers.values():
+            batcher.stop()
+
+    def stop(self):
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.close()
+
+    def stats(self):
+        return {name: batcher.stats() for name, batcher in self.batchers.items()}
+
+
+class RemoteDetector:
+    """
+    This class stands in for a detector (see detectors.Detector) whose model runs on an InferenceServer.
+    detect and detect_batch copy the frames into a shared memory block owned by this client and wait
+    for the server to send the detections back. It takes the same arguments as detectors.load_detector,
+    but the model runs with the input size and thresholds the server was started with. A conf_threshold
+    above the server's is applied here, on the detections the server sends back
+    """
+    def __init__(self, address, backend, model_path, cfg_path=None, dnn_target="cpu", input_size=None, threads=None,
+                 conf_threshold=None, nms_threshold=None, calibration_video=None, authkey=None, timeout=30.0):
+        """
+        Args:
+            address: Address of the server, see parse_address
+            authkey: Shared secret of the server and its clients, see resolve_authkey
+            timeout: Seconds to wait for the server to load the model or to answer a request
+            The others are the arguments of detectors.load_detector, dnn_target, threads and calibration_video
+            are up to the server and not used here
+        """
+        start = time.perf_counter()
+        self.address = parse_address(address)
+        self.timeout = timeout
+        self.connection = Client(self.address, authkey=resolve_authkey(authkey))
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count()
+        self.shm = None
+
+        # the server may run from another folder
+        spec = {"backend": backend, "model_path": os.path.abspath(model_path),
+                "cfg_path": cfg_path and os.path.abspath(cfg_path)}
+        self.connection.send(("load", spec))
+        # the server may have to load, export or quantize the model first
+        kind, *answer = self._receive(max(timeout, 600.0))
+        if kind != "loaded":
+            self.connection.close()
+            raise RuntimeError(f"The inference server could not load {model_path}: {answer[-1]}")
+        info = answer[0]
+        self.classes = info["classes"]
+        self.image_size = info["image_size"]
+        self.nmsThreshold = info["nmsThreshold"]
+        # only a stricter threshold can be applied after the fact
+        self.confThreshold = max(info["confThreshold"], conf_threshold or 0.0)
+        self.filter_scores = self.confThreshold > info["confThreshold"]
+        if input_size not in (None, self.image_size) or nms_threshold not in (None, self.nmsThreshold) \
+                or (conf_threshold or self.confThreshold) < self.confThreshold:
+            logger.warning("The inference server runs %s at size %d, conf %.2f and NMS %.2f, not as asked",
+                           model_path, self.image_size, info["confThreshold"], self.nmsThreshold)
+        self.runtime = info["runtime"]
+        self.backend = info["backend"]
+        # the cache key has to match the one of the same model loaded locally
+        self.model_path = info["model_path"] or spec["model_path"]
+        self.server_load_time = info["load_time"]
+        self.load_time = time.perf_counter() - start
+        self.warm_up_time = 0.0
+
+        self.calls = 0
+        self.total_time = 0.0
+        self.last_latency = 0.0
+        self.request_seconds = metrics.histogram("remote_detector_seconds", backend=self.backend)
+        logger.info("Using %s on the inference server at %s", self.model_path, self.address)
+
+    def _receive(self, timeout):
+        if not self.connection.poll(timeout):
+            raise TimeoutError(f"The inference server at {self.address} did not answer within {timeout}s")
+        return self.connection.recv()
+
+    def _write(self, frames):
+        """
+        Copies the frames into the shared memory block, growing it when they do not fit.
+        Returns their layout as (offset, shape, dtype) for the server
+        """
+        frames = [np.ascontiguousarray(frame) for frame in frames]
+        size = sum(frame.nbytes for frame in frames)
+        if self.shm is None or self.shm.size < size:
+            self._release()
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        layout = []
+        offset = 0
+        for frame in frames:
+            np.ndarray(frame.shape, dtype=frame.dtype, buffer=self.shm.buf, offset=offset)[...] = frame
+            layout.append((offset, frame.shape, frame.dtype.str))
+            offset += frame.nbytes
+        return layout
+
+    def detect(self, frame, classes=None):
+        return self.detect_batch([frame], classes)[0]
+
+    def detect_batch(self, frames, classes=None):
+        if len(frames) == 0:
+            return []
+        start = time.perf_counter()
+        with self.lock:
+            layout = self._write(frames)
+            request_id = next(self.request_ids)
+            self.connection.send(("detect", request_id, self.shm.name, layout,
+                                  None if classes is None else tuple(classes)))
+            try:
+                while True:
+                    kind, answered_id, result = self._receive(self.timeout)
+                    # answers to requests that timed out earlier are dropped
+                    if answered_id == request_id:
+                        break
+            except TimeoutError:
+                # the server may still be reading these frames, the next request gets a new block.
+                # A server that has it mapped keeps it until it is done, one that has not gets an error
+                self._release()
+                raise
+        if kind != "result" or answered_id != request_id:
+            raise RuntimeError(f"The inference server failed to detect: {result}")
+        if self.filter_scores:
+            result = [self._filter(detections) for detections in result]
+        self.last_latency = time.perf_counter() - start
+        self.total_time += self.last_latency
+        self.calls += len(frames)
+        self.request_seconds.observe(self.last_latency)
+        return result
+
+    def _filter(self, detections):
+        class_ids, scores, boxes = detections
+        keep = np.asarray(scores) >= self.confThreshold
+        return np.asarray(class_ids)[keep], np.asarray(scores)[keep], np.asarray(boxes)[keep]
+
+    def warm_up(self):
+        """
+        The server warmed the model up when it loaded it
+        """
+
+    @property
+    def mean_latency(self):
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def stats(self):
+        return {
+            "backend": self.backend,
+            "server": f"{self.address}",
+            "load_time": self.load_time,
+            "server_load_time": self.server_load_time,
+            "calls": self.calls,
+            "last_latency": self.last_latency,
+            "mean_latency": self.mean_latency,
+        }
+
+    def _release(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def close(self):
+        with self.lock:
+            try:
+                self.connection.send(("close",))
+            except OSError:
+                pass
+            self.connection.close()
+            self._release()
+
+
+def serve(address, authkey=None, max_batch=8, max_delay=0.01, preload=(), models=()):
+    """
+    Runs an InferenceServer on this process until it is interrupted
+    Args:
+        preload: Models (keyword arguments of detectors.load_detector) loaded before the first client
+            connects, so the pipelines do not wait for them on startup
+        models: Other models the clients may load, on their first request
+    """
+    server = InferenceServer(address, authkey, max_batch, max_delay, models=list(preload) + list(models))
+    for spec in preload:
+        try:
+            server.batcher(spec)
+        except Exception:
+            # a client asking for it gets the error, the other models are still served
+            logger.exception("Could not preload %s", spec["model_path"])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        logger.info("Inference server stats: %s", server.stats())
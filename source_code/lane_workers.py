@@ -0,0 +1,283 @@
+import logging
+import multiprocessing as mp
+import queue
+import time
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+import metrics
+import startup
+from arguments import log_level, metrics_dir, metrics_interval, headless
+from cadence import DetectionCadence
+from capture import CameraGroup
+from detection_cache import flush_caches, get_lane_caches
+from helper_func import ObjectTracking
+from motion_gate import MotionGate
+from object_detection import VEHICLE_CLASSES
+from detectors import camera_detector
+from trackers import make_tracker
+
+# Every lane gets this many frame slots in shared memory, so the camera side can fill
+# one slot while the worker is still busy with the other
+SLOTS_PER_LANE = 2
+
+logger = logging.getLogger(__name__)
+
+
+class SharedFrameBuffer:
+    """
+    This class holds the shared memory frame slots of one lane.
+    The parent process writes camera frames into a free slot and the lane worker reads them in place,
+    so a frame crosses the process boundary without being pickled
+    """
+    def __init__(self, shape, dtype=np.uint8, slots=SLOTS_PER_LANE, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        size = int(np.prod(self.shape)) * self.dtype.itemsize * slots
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.frames = np.ndarray((slots,) + self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def spec(self):
+        """
+        Returns what a worker needs to attach to this buffer
+        """
+        return {"name": self.shm.name, "shape": self.shape, "dtype": self.dtype.str, "slots": self.slots}
+
+    @classmethod
+    def attach(cls, spec):
+        return cls(spec["shape"], dtype=spec["dtype"], slots=spec["slots"], name=spec["name"])
+
+    def write(self, slot, frame):
+        if frame.shape != self.shape:
+            # cameras are not supposed to change resolution, but never write past the slot
+            frame = cv2.resize(frame, (self.shape[1], self.shape[0]))
+        self.frames[slot][...] = frame
+
+    def close(self):
+        del self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def lane_worker(lanes, specs, work_queue, free_slots, no_of_vehicles_per_lane, batched, cadence_settings,
+                motion_min_area=None, sources=None, cache_dir=None, cache_max_bytes=None, tracker_backend="deepsort"):
+    """
+    This function is the body of a lane worker process.
+    It owns the detector and one tracker per lane of its group, takes frames out of
+    the shared memory slots the parent tells it about and writes the lane counts straight
+    into the shared 'no_of_vehicles_per_lane' dictionary read by the timing process.
+    Args:
+        lanes: The lanes handled by this worker
+        specs: A dictionary mapping each lane to the spec of its SharedFrameBuffer
+        work_queue: Queue of (lane, slot, frame index) items for this worker, None stops it
+        free_slots: A dictionary mapping each lane to the queue its slots are given back on
+        no_of_vehicles_per_lane: A shared dictionary containing the number of vehicles in each lane
+        batched: Detect all the pending lanes of the group with one forward pass
+        cadence_settings: Keyword arguments of the DetectionCadence of every lane
+        motion_min_area: Gate every lane with a MotionGate using this threshold, None disables gating
+        sources: A dictionary mapping each lane to its camera source, used to find its detection cache
+        cache_dir: See detection_cache.get_cache, None disables the cache
+        cache_max_bytes: See detection_cache.get_cache
+        tracker_backend: Tracker of every lane, see trackers.make_tracker
+    Returns:
+        None
+    """
+    # spawned, so nothing of the parent's logging setup is inherited
+    metrics.configure_logging(log_level)
+    writer = metrics.start_metrics(f"lanes-{'-'.join(lanes)}", metrics_dir, metrics_interval)
+    lane_vehicles = {lane: metrics.gauge("lane_vehicles", lane=lane) for lane in lanes}
+    buffers = {lane: SharedFrameBuffer.attach(specs[lane]) for lane in lanes}
+    detector, detector_files = camera_detector()
+    startup.mark("detector_ready")
+    caches = get_lane_caches(cache_dir, sources or {}, detector, detector_files, max_bytes=cache_max_bytes,
+                             classes=VEHICLE_CLASSES)
+    ob = ObjectTracking(detector=detector, caches=caches, draw=not headless)
+    trackers = {lane: make_tracker(tracker_backend) for lane in lanes}
+    cadences = {lane: DetectionCadence(**cadence_settings) for lane in lanes}
+    gates = {lane: MotionGate(min_motion=motion_min_area) for lane in lanes} if motion_min_area is not None else None
+    processed = 0
+
+    pending = None  # the next frame of a lane that already had one in the last batch
+    try:
+        while True:
+            item = pending if pending is not None else work_queue.get()
+            pending = None
+            if item is None:
+                break
+            # pick up whatever else is already waiting so the group can be detected in one batch
+            items = [item]
+            while len(items) < len(lanes):
+                try:
+                    item = work_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    work_queue.put(None)
+                    break
+                if any(lane == item[0] for lane, _, _ in items):
+                    # a batch holds one frame per lane, this one starts the next batch so the
+                    # frames of the lane are still tracked in order
+                    pending = item
+                    break
+                items.append(item)
+
+            frames = {lane: buffers[lane].frames[slot] for lane, slot, _ in items}
+            outputs = ob.process_lanes(frames=frames, trackers=trackers, list=detector.classes, cadences=cadences,
+                                       batched=batched, gates=gates,
+                                       frame_indices={lane: index for lane, _, index in items})
+            processed += 1
+            if gates is not None and processed % 100 == 0:
+                logger.info("Motion gating: %s", {lane: gate.stats() for lane, gate in gates.items()})
+
+            for lane, slot, _ in items:
+                detect_frame, vehicles_south, vehicles_north = outputs[lane]
+                no_of_vehicles_per_lane[lane] = len(vehicles_south)
+                lane_vehicles[lane].set(len(vehicles_south))
+                if not headless:
+                    cv2.imshow(f"Frame {lane}", detect_frame)
+                    cv2.waitKey(1)
+                free_slots[lane].put(slot)
+            startup.mark("first_counts")
+    finally:
+        # worker processes exit without running atexit, write the cache here
+        flush_caches()
+        if writer is not None:
+            writer.stop()
+        for buffer in buffers.values():
+            buffer.close()
+        if not headless:
+            cv2.destroyAllWindows()
+
+
+def run_lane_workers(no_of_vehicles_per_lane, green_lane, sources, lane_groups, capture_policy="latest",
+                     capture_buffer_size=4, batched=True, detection_interval=1, max_detection_interval=10,
+                     target_frame_time=None, motion_gating=False, motion_min_area=0.002, cache_dir=None,
+                     cache_max_bytes=None, budget=None, tracker_backend="deepsort"):
+    """
+    This function runs the 4 camera pipeline with one worker process per group of lanes.
+    The cameras are read here and their frames are handed to the workers through shared memory,
+    when a worker is still busy with both slots of a lane the new frame of that lane is dropped.
+    Args:
+        no_of_vehicles_per_lane: A shared dictionary containing the number of vehicles in each lane
+        green_lane: A shared variable containing the lane that has the green light
+        sources: A dictionary mapping each lane to its camera source
+        lane_groups: List of lists of lanes, each inner list gets its own worker process
+        capture_policy: See capture.CameraGroup
+        capture_buffer_size: See capture.CameraGroup
+        batched: Detect the lanes of a group with one forward pass
+        detection_interval: See cadence.DetectionCadence
+        max_detection_interval: See cadence.DetectionCadence
+        target_frame_time: See cadence.DetectionCadence
+        motion_gating: Skip the detector on lanes where nothing moves, see motion_gate.MotionGate
+        motion_min_area: See motion_gate.MotionGate
+        cache_dir: Folder of the detection cache, see detection_cache.get_cache
+        cache_max_bytes: See detection_cache.get_cache
+        budget: compute_budget.ComputeBudget deciding which lanes are detected on every cycle,
+            None detects every lane but the green one
+        tracker_backend: Tracker of every lane, see trackers.make_tracker
+    Returns:
+        None
+    """
+    grouped = [lane for lanes in lane_groups for lane in lanes]
+    if sorted(grouped) != sorted(sources):
+        raise ValueError(f"lane_groups must list every lane exactly once, got {lane_groups} for {list(sources)}")
+
+    cameras = CameraGroup(sources, policy=capture_policy, buffer_size=capture_buffer_size).start()
+    captured = cameras.read()
+    if captured is None:
+        green_lane.value = "Error"
+        cameras.release()
+        return
+    startup.mark("first_frame")
+
+    # spawn instead of fork, the capture threads are already running in this process
+    context = mp.get_context("spawn")
+    buffers = {lane: SharedFrameBuffer(captured[lane].frame.shape) for lane in sources}
+    free_slots = {lane: context.Queue() for lane in sources}
+    for lane in sources:
+        for slot in range(SLOTS_PER_LANE):
+            free_slots[lane].put(slot)
+
+    cadence_settings = {"interval": detection_interval, "max_interval": max_detection_interval,
+                        "target_frame_time": target_frame_time}
+    work_queues = []
+    workers = []
+    lane_queue = {}
+    for lanes in lane_groups:
+        work_queue = context.Queue()
+        specs = {lane: buffers[lane].spec() for lane in lanes}
+        worker = context.Process(target=lane_worker, name=f"lanes-{'-'.join(lanes)}",
+                                 args=(lanes, specs, work_queue, free_slots, no_of_vehicles_per_lane, batched,
+                                       cadence_settings, motion_min_area if motion_gating else None,
+                                       {lane: sources[lane] for lane in lanes}, cache_dir, cache_max_bytes,
+                                       tracker_backend))
+        worker.start()
+        work_queues.append(work_queue)
+        workers.append(worker)
+        for lane in lanes:
+            lane_queue[lane] = work_queue
+
+    dropped = {lane: 0 for lane in sources}
+    dropped_counters = {lane: metrics.counter("lane_worker_frames_dropped", lane=lane) for lane in sources}
+    queue_depths = {lane: metrics.gauge("lane_worker_queue_depth", lane=lane) for lane in sources}
+    cycles = 0
+    try:
+        while captured is not None:
+            if not all(worker.is_alive() for worker in workers):
+                logger.error("A lane worker stopped unexpectedly")
+                green_lane.value = "Error"
+                break
+
+            if budget is not None:
+                selected = set(budget.select(list(captured), green_lane.phase()))
+            else:
+                selected = set(captured) - {green_lane.value}
+            for lane, frame in captured.items():
+                if lane not in selected:
+                    logger.debug("Skipping the frame of %s this cycle", lane)
+                    continue
+                try:
+                    slot = free_slots[lane].get_nowait()
+                except queue.Empty:
+                    # the worker is still busy with this lane, a fresher frame will come along
+                    dropped[lane] += 1
+                    dropped_counters[lane].inc()
+                    continue
+                buffers[lane].write(slot, frame.frame)
+                lane_queue[lane].put((lane, slot, frame.index))
+                # latency here is up to the hand off, the worker owns the frame from now on
+                cameras.mark_done(frame)
+
+            cycles += 1
+            if cycles % 100 == 0:
+                for lane in sources:
+                    try:
+                        queue_depths[lane].set(lane_queue[lane].qsize())
+                    except NotImplementedError:
+                        # multiprocessing queues have no qsize on macOS
+                        pass
+                logger.info("Capture stats: %s", cameras.stats())
+                logger.info("Frames dropped by busy lane workers: %s", dropped)
+                if budget is not None:
+                    logger.info("Compute budget: %s", budget.stats())
+            captured = cameras.read()
+        else:
+            green_lane.value = "Error"
+    finally:
+        for work_queue in work_queues:
+            work_queue.put(None)
+        deadline = time.monotonic() + 10
+        for worker in workers:
+            worker.join(timeout=max(0.0, deadline - time.monotonic()))
+            if worker.is_alive():
+                worker.terminate()
+        cameras.release()
+        for buffer in buffers.values():
+            buffer.close()
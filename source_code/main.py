@@ -1,8 +1,25 @@
+import time
+
+# startup is timed from here, before anything heavy is imported
+STARTED_AT = time.time()
+
 import argparse
-from multiprocessing import Manager, Process
-from arguments import source_video_path, source_weights_path, target_video_path, confidence_threshold, iou_threshold
-from aerial import VideoProcessor
-from four_c import frame_processing, timing
+import logging
+from multiprocessing import Process
+import metrics
+import startup
+from arguments import (source_video_path, source_weights_path, target_video_path, confidence_threshold, iou_threshold,
+                       pipelined, pipeline_queue_size, detection_interval_aerial, max_detection_interval,
+                       target_frame_time, motion_gating, motion_min_area, detection_cache_dir,
+                       detection_cache_max_bytes, log_level, metrics_port, metrics_dir, aerial_tiling,
+                       aerial_tile_size, aerial_tile_overlap, aerial_detector_backend, detector_threads,
+                       detector_input_size, headless, inference_server_address, inference_server_authkey,
+                       inference_max_batch, inference_max_delay)
+from shared_state import IntersectionState, LaneCounts, GreenLane
+from signal_timing import timing
+
+
+logger = logging.getLogger(__name__)
 
 
 if __name__ == "__main__":
@@ -20,43 +37,81 @@ if __name__ == "__main__":
   
 
     args = parser.parse_args()
+    metrics.configure_logging(log_level)
+    metrics.begin_run(metrics_dir)
+    if metrics_port is not None:
+        metrics.serve_metrics(metrics_port, metrics_dir)
     
-    if args.mode == "aerial":
-        processor = VideoProcessor(
-            source_weights_path=source_weights_path,
-            source_video_path=source_video_path,
-            target_video_path=target_video_path,
-            confidence_threshold=confidence_threshold,
-            iou_threshold=iou_threshold,
-        )
-        with Manager() as manager:
-            print("Using the drone version")
-            no_of_vehicles_per_lane = manager.dict()
-            green_lane = manager.Value(str, "None")
-
-            p1 = Process(target=processor.process_video, args=(no_of_vehicles_per_lane, green_lane))
-            p2 = Process(target=timing, args=(no_of_vehicles_per_lane, green_lane))
-
-            p1.start()
-            p2.start()
-
-            p1.join()
-            p2.join()
-    
-        
-        processor.process_video()
-    elif args.mode == "4C":
-        with Manager() as manager:
-            print("Using the 4 camera version")
-            no_of_vehicles_per_lane = manager.dict()
-            green_lane = manager.Value(str, "None")
+    startup.begin(STARTED_AT)
+    if args.mode in ("aerial", "4C"):
+        # Counts and the green lane live in one shared memory block instead of a Manager server
+        state = IntersectionState()
+        no_of_vehicles_per_lane = LaneCounts(state)
+        green_lane = GreenLane(state)
 
-            p1 = Process(target=frame_processing, args=(no_of_vehicles_per_lane, green_lane))
-            p2 = Process(target=timing, args=(no_of_vehicles_per_lane, green_lane))
+        # The timing process only needs the shared state, so it starts before any vision code is imported
+        p2 = Process(target=timing, args=(no_of_vehicles_per_lane, green_lane))
+        p2.start()
 
+        # Each mode only imports what it runs, the drone mode never loads the 4 camera stack and the other way round
+        try:
+            if args.mode == "aerial":
+                from aerial import VideoProcessor
+                logger.info("Using the drone version")
+                settings = dict(
+                    source_weights_path=source_weights_path,
+                    source_video_path=source_video_path,
+                    target_video_path=target_video_path,
+                    confidence_threshold=confidence_threshold,
+                    iou_threshold=iou_threshold,
+                    pipelined=pipelined,
+                    queue_size=pipeline_queue_size,
+                    detection_interval=detection_interval_aerial,
+                    max_detection_interval=max_detection_interval,
+                    target_frame_time=target_frame_time,
+                    motion_gating=motion_gating,
+                    motion_min_area=motion_min_area,
+                    cache_dir=detection_cache_dir,
+                    cache_max_bytes=detection_cache_max_bytes,
+                    tiled=aerial_tiling,
+                    tile_size=aerial_tile_size,
+                    tile_overlap=aerial_tile_overlap,
+                    detector_backend=aerial_detector_backend,
+                    detector_threads=detector_threads,
+                    detector_input_size=detector_input_size,
+                    headless=headless,
+                    inference_server=inference_server_address,
+                    inference_authkey=inference_server_authkey,
+                )
+                # the processor and its model are built in the vision process, not here
+                p1 = Process(target=VideoProcessor.run, args=(settings, no_of_vehicles_per_lane, green_lane))
+            else:
+                from four_c import frame_processing
+                logger.info("Using the 4 camera version")
+                p1 = Process(target=frame_processing, args=(no_of_vehicles_per_lane, green_lane))
+            startup.mark("imports")
             p1.start()
-            p2.start()
-
             p1.join()
+        except BaseException:
+            # the timing process runs until it is told to stop
+            green_lane.value = "Error"
+            raise
+        finally:
             p2.join()
-    
+            state.close()
+    elif args.mode == "server":
+        # One process serving the detectors to every intersection on this host, see inference_server.py
+        from inference_server import serve
+        from detectors import camera_detector_spec
+        address = inference_server_address or "127.0.0.1:9200"
+        startup.mark("imports")
+        logger.info("Running the inference server")
+        # the model of the 4 camera mode is loaded up front, the drone one when a pipeline first asks for it.
+        # No other model file is loaded, and they run as set here whatever a client asks for
+        spec, _ = camera_detector_spec()
+        aerial_spec = {"backend": aerial_detector_backend, "model_path": source_weights_path,
+                       "input_size": detector_input_size, "threads": detector_threads,
+                       "conf_threshold": confidence_threshold, "nms_threshold": iou_threshold,
+                       "calibration_video": source_video_path}
+        serve(address, inference_server_authkey, inference_max_batch, inference_max_delay, preload=[spec],
+              models=[aerial_spec])
@@ -0,0 +1,322 @@
+import errno
+import glob
+import logging
+import os
+import shutil
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+# Every metric name gets this prefix when exported
+PREFIX = "traffic_"
+QUANTILES = (0.5, 0.95, 0.99)
+# Name of the snapshot folder of this run, set by begin_run in main.py and inherited by every process it starts
+RUN_ENV = "TRAFFIC_METRICS_RUN"
+
+logger = logging.getLogger(__name__)
+
+# Process wide registry, see counter(), gauge() and histogram()
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    """
+    A value that only goes up, e.g. frames processed
+    """
+    kind = "counter"
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield f"{PREFIX}{self.name}_total", self.labels, self.value
+
+
+class Gauge:
+    """
+    A value that goes up and down, e.g. the depth of a queue
+    """
+    kind = "gauge"
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield f"{PREFIX}{self.name}", self.labels, self.value
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram:
+    """
+    Latencies of the last 'window' observations in a ring buffer, exported with their
+    p50/p95/p99 plus the count and sum of everything ever observed.
+    Observing is a store into the buffer, the quantiles are only computed when the metrics are read
+    """
+    kind = "summary"
+
+    def __init__(self, name, labels, window=1024):
+        self.name = name
+        self.labels = labels
+        self.values = np.zeros(window, dtype=np.float64)
+        self.position = 0
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.values[self.position] = value
+            self.position = (self.position + 1) % len(self.values)
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        """
+        Context manager observing how long its block took
+        """
+        return _Timer(self)
+
+    def quantiles(self):
+        with self.lock:
+            values = self.values[:min(self.count, len(self.values))].copy()
+        if len(values) == 0:
+            return {quantile: 0.0 for quantile in QUANTILES}
+        return dict(zip(QUANTILES, np.quantile(values, QUANTILES).tolist()))
+
+    def samples(self):
+        name = f"{PREFIX}{self.name}"
+        for quantile, value in self.quantiles().items():
+            yield name, self.labels + (("quantile", quantile),), value
+        yield f"{name}_sum", self.labels, self.sum
+        yield f"{name}_count", self.labels, self.count
+
+
+def _get(cls, name, labels):
+    key = (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+    metric = _metrics.get(key)
+    if metric is None:
+        with _metrics_lock:
+            metric = _metrics.get(key)
+            if metric is None:
+                metric = cls(name, key[1])
+                _metrics[key] = metric
+    if not isinstance(metric, cls):
+        raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+    return metric
+
+
+def counter(name, **labels):
+    """
+    Returns the Counter called name with these labels, created on first use.
+    Keep the returned object around on hot paths instead of looking it up on every frame
+    """
+    return _get(Counter, name, labels)
+
+
+def gauge(name, **labels):
+    return _get(Gauge, name, labels)
+
+
+def histogram(name, **labels):
+    return _get(Histogram, name, labels)
+
+
+def render(extra_labels=None):
+    """
+    Returns every metric of this process in the Prometheus text format
+    """
+    extra = tuple(sorted((extra_labels or {}).items()))
+    with _metrics_lock:
+        metrics = sorted(_metrics.values(), key=lambda metric: (metric.name, metric.labels))
+    lines = []
+    typed = set()
+    for metric in metrics:
+        if metric.name not in typed:
+            lines.append(f"# TYPE {PREFIX}{metric.name} {metric.kind}")
+            typed.add(metric.name)
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_format_labels(extra + labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def merge(texts):
+    """
+    Merges the output of render() of several processes, the samples of a metric have to stay
+    together under a single TYPE line
+    """
+    families = {}
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# TYPE "):
+                family = line.split()[2]
+                families.setdefault(family, [line])
+            elif line and family is not None:
+                families[family].append(line)
+    return "".join(line + "\n" for lines in families.values() for line in lines)
+
+
+class SnapshotWriter(threading.Thread):
+    """
+    Writes the metrics of this process to a file every 'interval' seconds, the file is
+    replaced in one go so readers never see half of it
+    """
+    def __init__(self, path, interval=5.0, process=None):
+        super().__init__(name="metrics-snapshot", daemon=True)
+        self.path = path
+        self.interval = interval
+        self.process = process
+        self.stop_event = threading.Event()
+
+    def write(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(render({"process": self.process} if self.process else None))
+        os.replace(tmp_path, self.path)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.write()
+            except OSError as error:
+                logger.warning("Could not write the metrics snapshot %s: %s", self.path, error)
+
+    def stop(self):
+        self.stop_event.set()
+        self.write()
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def begin_run(directory):
+    """
+    Gives this run its own snapshot folder, directory/run-<pid>, call it in main.py before any process starts.
+    Several intersections on one host share metrics_dir, each run only writes and serves its own folder.
+    The folders of runs that are not running anymore are removed
+    """
+    os.environ[RUN_ENV] = f"run-{os.getpid()}"
+    if directory is None:
+        return None
+    own = run_directory(directory)
+    for path in glob.glob(os.path.join(directory, "run-*")):
+        pid = os.path.basename(path)[len("run-"):]
+        if path == own or not pid.isdigit() or not _running(int(pid)):
+            shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(own, exist_ok=True)
+    return own
+
+
+def run_directory(directory):
+    """
+    Returns the snapshot folder of this run in directory, see begin_run
+    """
+    return os.path.join(directory, os.environ.get(RUN_ENV, f"run-{os.getpid()}"))
+
+
+def start_metrics(process, directory, interval=5.0):
+    """
+    Starts writing the metrics of this process to <run folder>/<process>.prom, where serve_metrics picks them up.
+    Returns the SnapshotWriter, or None when directory is None
+    """
+    if directory is None:
+        return None
+    directory = run_directory(directory)
+    os.makedirs(directory, exist_ok=True)
+    writer = SnapshotWriter(os.path.join(directory, f"{process}.prom"), interval, process)
+    writer.start()
+    return writer
+
+
+def serve_metrics(port, directory=None, host="127.0.0.1"):
+    """
+    Serves the metrics on http://host:port/metrics in the Prometheus text format, on a background thread.
+    The snapshots the other processes of this run write to directory are served along with the metrics of
+    this one. Returns the server, or None when the port is taken, e.g. by another intersection on the host
+    """
+    if directory is not None:
+        directory = run_directory(directory)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") not in ("", "/metrics"):
+                self.send_error(404)
+                return
+            parts = [render({"process": "main"})]
+            if directory is not None:
+                for path in sorted(glob.glob(os.path.join(directory, "*.prom"))):
+                    try:
+                        with open(path) as file:
+                            parts.append(file.read())
+                    except OSError:
+                        continue
+            body = merge(parts).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("metrics request: " + format, *args)
+
+    try:
+        server = ThreadingHTTPServer((host, port), Handler)
+    except OSError as error:
+        if error.errno != errno.EADDRINUSE:
+            raise
+        logger.warning("Port %d is already in use, metrics are not served. Give every intersection on the host "
+                       "its own metrics_port", port)
+        return None
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return server
+
+
+def configure_logging(level="INFO"):
+    """
+    Sets up the log format shared by all the processes, call it at the start of every process
+    that is spawned rather than forked
+    """
+    logging.basicConfig(level=getattr(logging, str(level).upper(), logging.INFO),
+                        format="%(asctime)s %(processName)s %(name)s %(levelname)s %(message)s")
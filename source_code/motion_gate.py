@@ -0,0 +1,140 @@
+import time
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """
+    This class is a cheap motion check in front of the detector.
+    Each frame is shrunk to a small grey image and compared with a running average of the
+    background, when almost nothing changed the detector can be skipped and the last counts reused.
+    When something moved it also gives the bounding box of the motion, so detection can be
+    limited to that region
+    """
+    def __init__(self, width=160, threshold=25, min_motion=0.002, learning_rate=0.05, padding=0.1,
+                 max_skipped=150):
+        """
+        Args:
+            width: Width of the image the check runs on, the height keeps the aspect ratio
+            threshold: Grey level difference for a pixel to count as moving
+            min_motion: Fraction of moving pixels below which the frame is static
+            learning_rate: How fast the background average follows the frame
+            padding: Fraction of the frame size added around the motion box
+            max_skipped: Run the detector anyway after this many static frames in a row
+        """
+        self.width = width
+        self.threshold = threshold
+        self.min_motion = min_motion
+        self.learning_rate = learning_rate
+        self.padding = padding
+        self.max_skipped = max_skipped
+        self.background = None
+        self.scale = 1.0
+        self.skipped_in_a_row = 0
+
+        self.frames = 0
+        self.skipped = 0
+        self.check_time = 0.0
+        self.detect_time = 0.0
+        self.detections = 0
+
+    def _small(self, frame):
+        height, width = frame.shape[:2]
+        self.scale = width / self.width
+        small = cv2.resize(frame, (self.width, max(1, int(height / self.scale))), interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0).astype(np.float32)
+
+    def check(self, frame):
+        """
+        Looks for motion in the frame, call once per frame
+        Args:
+            frame: The BGR frame
+        Returns:
+            None if the frame is static and the detector can be skipped, otherwise the
+            (x1, y1, x2, y2) box of the motion in frame pixels (the whole frame on the first call)
+        """
+        start = time.perf_counter()
+        self.frames += 1
+        small = self._small(frame)
+        height, width = frame.shape[:2]
+
+        if self.background is None or self.background.shape != small.shape:
+            self.background = small
+            self.check_time += time.perf_counter() - start
+            self.skipped_in_a_row = 0
+            return 0, 0, width, height
+
+        moving = cv2.absdiff(small, self.background) > self.threshold
+        cv2.accumulateWeighted(small, self.background, self.learning_rate)
+        motion = float(moving.mean())
+
+        if motion < self.min_motion and self.skipped_in_a_row < self.max_skipped:
+            self.skipped += 1
+            self.skipped_in_a_row += 1
+            self.check_time += time.perf_counter() - start
+            return None
+        self.skipped_in_a_row = 0
+
+        ys, xs = np.nonzero(moving)
+        if len(xs) == 0:
+            region = (0, 0, width, height)
+        else:
+            pad_x, pad_y = self.padding * width, self.padding * height
+            region = (
+                int(max(0, xs.min() * self.scale - pad_x)),
+                int(max(0, ys.min() * self.scale - pad_y)),
+                int(min(width, (xs.max() + 1) * self.scale + pad_x)),
+                int(min(height, (ys.max() + 1) * self.scale + pad_y)),
+            )
+        self.check_time += time.perf_counter() - start
+        return region
+
+    def record_detection(self, latency):
+        """
+        Records how long a detection took, used to estimate the time saved by skipping
+        """
+        self.detections += 1
+        self.detect_time += latency
+
+    def stats(self):
+        mean_detect = self.detect_time / self.detections if self.detections else 0.0
+        return {
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "skip_rate": self.skipped / self.frames if self.frames else 0.0,
+            "check_time": self.check_time,
+            # what the skipped frames would have cost at the measured detection latency
+            "time_saved": self.skipped * mean_detect - self.check_time,
+        }
+
+
+def crop_to_region(frame, region, min_size=0.5):
+    """
+    Returns the part of the frame inside region and its (x, y) offset.
+    Regions covering most of the frame are not worth the crop, the whole frame is returned instead
+    Args:
+        frame: The frame
+        region: (x1, y1, x2, y2) box as returned by MotionGate.check
+        min_size: Crop only when the region is smaller than this fraction of the frame area
+    """
+    height, width = frame.shape[:2]
+    x1, y1, x2, y2 = region
+    if (x2 - x1) * (y2 - y1) >= min_size * width * height:
+        return frame, (0, 0)
+    return frame[y1:y2, x1:x2], (x1, y1)
+
+
+def region_covers(region, points):
+    """
+    Returns True if every (x, y) point is inside region.
+    Vehicles waiting at a red light do not move, a crop to the region that moved would not see them,
+    so the full frame is detected while a live track is outside of it
+    Args:
+        region: (x1, y1, x2, y2) box as returned by MotionGate.check
+        points: (n, 2) array of track centres
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    x1, y1, x2, y2 = region
+    return bool(np.all((points[:, 0] >= x1) & (points[:, 0] <= x2) & (points[:, 1] >= y1) & (points[:, 1] <= y2)))
@@ -1,24 +1,175 @@
+import logging
+import os
+import threading
+import time
 import cv2
 import numpy as np
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Preferable backend/target pairs for the OpenCV DNN module.
+# "cpu" is the safe default for boxes without a CUDA build of OpenCV.
+BACKENDS = {
+    "cpu": (cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_CPU),
+    "opencl": (cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_OPENCL),
+    "cuda": (cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA),
+    "cuda_fp16": (cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA_FP16),
+}
+
+# COCO ids of the classes counted as vehicles: bicycle, car, motorbike and bus
+VEHICLE_CLASSES = (1, 2, 3, 5)
+
+_detectors = {}
+_detectors_lock = threading.Lock()
+
+
+def decode_yolo_outputs(outputs, frame_shape, conf_threshold, nms_threshold, classes=None):
+    """
+    Turns the raw YOLO output layers of one image into detections, the same way
+    cv2.dnn_DetectionModel.detect does (best class score as confidence, per class NMS).
+    Args:
+        outputs: List of (rows, 5 + classes) arrays, one per YOLO output layer
+        frame_shape: Shape of the original frame, boxes are scaled back to it
+        conf_threshold: Minimum class score to keep a box
+        nms_threshold: IoU threshold used by NMS
+        classes: Only keep the boxes whose best class is one of these, e.g. VEHICLE_CLASSES.
+            The other boxes are dropped before they are decoded or go through NMS
+    Returns:
+        A tuple (class_ids, scores, boxes) with boxes as (x, y, w, h) in frame pixels
+    """
+    predictions = np.concatenate([output.reshape(-1, output.shape[-1]) for output in outputs])
+    # darknet class scores are the objectness times the class probability, so rows whose objectness
+    # is under the threshold can go before the 80 class columns are looked at
+    predictions = predictions[predictions[:, 4] >= conf_threshold]
+    class_scores = predictions[:, 5:]
+    class_ids = class_scores.argmax(axis=1)
+    scores = class_scores[np.arange(len(class_ids)), class_ids]
+    keep = scores >= conf_threshold
+    if classes is not None:
+        keep &= np.isin(class_ids, classes)
+    if not keep.any():
+        return np.empty((0,), np.int32), np.empty((0,), np.float32), np.empty((0, 4), np.int32)
+
+    predictions, class_ids, scores = predictions[keep], class_ids[keep], scores[keep]
+    frame_h, frame_w = frame_shape[:2]
+    # Same integer arithmetic and clipping as DetectionModel, so both paths give the same boxes
+    center_x = (predictions[:, 0] * frame_w).astype(np.int32)
+    center_y = (predictions[:, 1] * frame_h).astype(np.int32)
+    width = (predictions[:, 2] * frame_w).astype(np.int32)
+    height = (predictions[:, 3] * frame_h).astype(np.int32)
+    left = np.clip(center_x - width // 2, 0, frame_w - 1)
+    top = np.clip(center_y - height // 2, 0, frame_h - 1)
+    width = np.clip(width, 1, frame_w - left)
+    height = np.clip(height, 1, frame_h - top)
+    boxes = np.stack([left, top, width, height], axis=1)
+
+    # Shift every class into its own region so one NMS call never suppresses across classes
+    offsets = (class_ids * (max(frame_w, frame_h) + 1))[:, None]
+    nms_boxes = boxes.copy()
+    nms_boxes[:, :2] += offsets
+    indices = np.asarray(cv2.dnn.NMSBoxes(nms_boxes, scores, conf_threshold, nms_threshold),
+                         dtype=np.int64).reshape(-1)
+    return class_ids[indices].astype(np.int32), scores[indices].astype(np.float32), boxes[indices]
+
+
+def deepsort_detections(class_ids, scores, boxes, names, classes=VEHICLE_CLASSES):
+    """
+    Puts detections in the format DeepSort.update_tracks takes, a list of ([x, y, w, h], score, class name).
+    The detections of other classes than the given ones are dropped, with one mask rather than per box
+    Args:
+        class_ids, scores, boxes: Output of ObjectDetection.detect
+        names: Class name of every class id
+        classes: Class ids to keep, None keeps every class
+    """
+    class_ids = np.asarray(class_ids).reshape(-1)
+    if len(class_ids) == 0:
+        return []
+    scores = np.asarray(scores).reshape(-1)
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    if classes is not None:
+        keep = np.isin(class_ids, classes)
+        class_ids, scores, boxes = class_ids[keep], scores[keep], boxes[keep]
+    return [(box, score, names[class_id])
+            for box, score, class_id in zip(boxes.tolist(), scores.tolist(), class_ids.tolist())]
+
+
+def cuda_available():
+    """
+    Returns True if this OpenCV build can see at least one CUDA device
+    """
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+
+def get_detector(weights_path="dnn_model/yolov4.weights", cfg_path="dnn_model/yolov4.cfg", backend="cpu",
+                 input_size=None, threads=None):
+    """
+    Returns the shared ObjectDetection for the given model files and backend.
+    The network is loaded and warmed up the first time it is asked for, every later call
+    in the same process gets the same instance back, so the weights are only read once.
+    Args:
+        weights_path: Path to the YOLOv4 weights
+        cfg_path: Path to the YOLOv4 config
+        backend: One of the keys of BACKENDS
+        input_size: Side of the network input, None keeps 608
+        threads: Threads OpenCV runs the network on, None leaves the OpenCV default
+    Returns:
+        An ObjectDetection instance
+    """
+    key = (os.path.abspath(weights_path), os.path.abspath(cfg_path), backend, input_size, threads)
+    with _detectors_lock:
+        detector = _detectors.get(key)
+        if detector is None:
+            detector = ObjectDetection(weights_path=weights_path, cfg_path=cfg_path, backend=backend,
+                                       input_size=input_size, threads=threads)
+            detector.warm_up()
+            _detectors[key] = detector
+        return detector
 
 
 class ObjectDetection:
     """
     This class is used to detect objects in a frame using YOLOv4
+    Use get_detector() instead of building it directly so the network is shared.
+    The other detectors in detectors.py have the same interface
     """
-    def __init__(self, weights_path="dnn_model/yolov4.weights", cfg_path="dnn_model/yolov4.cfg"):
-        print("Loading Object Detection")
-        print("Running opencv dnn with YOLOv4")
+    runtime = "opencv"
+
+    def __init__(self, weights_path="dnn_model/yolov4.weights", cfg_path="dnn_model/yolov4.cfg", backend="cpu",
+                 input_size=None, threads=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown dnn backend '{backend}', expected one of {list(BACKENDS)}")
+        if backend.startswith("cuda") and not cuda_available():
+            logger.warning("No CUDA device available, falling back to the cpu backend instead of %s", backend)
+            backend = "cpu"
+
+        logger.info("Loading Object Detection")
+        logger.info("Running opencv dnn with YOLOv4 on the %s backend", backend)
         self.nmsThreshold = 0.4
         self.confThreshold = 0.5
-        self.image_size = 608
+        self.image_size = input_size or 608
+        self.backend = backend
+        if threads is not None:
+            cv2.setNumThreads(threads)
 
+        # Latency bookkeeping so the cost of loading and of each call can be reported
+        self.calls = 0
+        self.total_time = 0.0
+        self.last_latency = 0.0
+
+        start = time.perf_counter()
         # Load Network
         net = cv2.dnn.readNet(weights_path, cfg_path)
 
-        # Enable GPU CUDA
-        net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
-        net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
+        preferable_backend, preferable_target = BACKENDS[backend]
+        net.setPreferableBackend(preferable_backend)
+        net.setPreferableTarget(preferable_target)
+        self.net = net
+        self.output_layers = net.getUnconnectedOutLayersNames()
         self.model = cv2.dnn_DetectionModel(net)
 
         self.classes = []
@@ -26,6 +177,12 @@ class ObjectDetection:
         self.colors = np.random.uniform(0, 255, size=(80, 3))
 
         self.model.setInputParams(size=(self.image_size, self.image_size), scale=1/255)
+        self.load_time = time.perf_counter() - start
+        self.warm_up_time = 0.0
+        logger.info("YOLOv4 loaded in %.2fs", self.load_time)
+        self.detect_seconds = metrics.histogram("detector_seconds", backend=backend, call="detect")
+        self.batch_seconds = metrics.histogram("detector_seconds", backend=backend, call="batch")
+        self.frames_detected = metrics.counter("detector_frames", backend=backend)
 
     def load_class_names(self, classes_path="dnn_model/classes.txt"):
         """
@@ -40,8 +197,81 @@ class ObjectDetection:
         self.colors = np.random.uniform(0, 255, size=(80, 3))
         return self.classes
 
-    def detect(self, frame):
+    def warm_up(self):
+        """
+        Runs one inference on a blank frame so the backend allocates its buffers
+        (and compiles its kernels on CUDA) before the first real frame arrives
         """
-        Detect objects in a frame"""
-        return self.model.detect(frame, nmsThreshold=self.nmsThreshold, confThreshold=self.confThreshold)
+        start = time.perf_counter()
+        self.model.detect(np.zeros((self.image_size, self.image_size, 3), dtype=np.uint8),
+                          nmsThreshold=self.nmsThreshold, confThreshold=self.confThreshold)
+        self.warm_up_time = time.perf_counter() - start
+        logger.info("YOLOv4 warm up took %.2fs", self.warm_up_time)
 
+    def detect(self, frame, classes=None):
+        """
+        Detect objects in a frame.
+        With classes the raw output layers are decoded here instead of by DetectionModel,
+        so the boxes of every other class are dropped before decoding and NMS"""
+        start = time.perf_counter()
+        if classes is None:
+            result = self.model.detect(frame, nmsThreshold=self.nmsThreshold, confThreshold=self.confThreshold)
+        else:
+            blob = cv2.dnn.blobFromImage(frame, 1/255, (self.image_size, self.image_size), swapRB=False, crop=False)
+            self.net.setInput(blob)
+            result = decode_yolo_outputs(self.net.forward(self.output_layers), frame.shape, self.confThreshold,
+                                         self.nmsThreshold, classes)
+        self.last_latency = time.perf_counter() - start
+        self.total_time += self.last_latency
+        self.calls += 1
+        self.detect_seconds.observe(self.last_latency)
+        self.frames_detected.inc()
+        return result
+
+    def detect_batch(self, frames, classes=None):
+        """
+        Detect objects in several frames with a single forward pass.
+        All the frames go into one blob, so the per call overhead of the network is paid once
+        and the BLAS threads get a bigger batch to work on.
+        Args:
+            frames: List of BGR frames, they may have different sizes
+            classes: Only return the boxes of these class ids, see decode_yolo_outputs
+        Returns:
+            A list with one (class_ids, scores, boxes) tuple per frame, in the same order as frames
+        """
+        if not frames:
+            return []
+        start = time.perf_counter()
+        blob = cv2.dnn.blobFromImages(frames, 1/255, (self.image_size, self.image_size), swapRB=False, crop=False)
+        self.net.setInput(blob)
+        outputs = self.net.forward(self.output_layers)
+        # A batch of one comes back as (rows, cols), bigger batches as (batch, rows, cols)
+        outputs = [output.reshape(len(frames), -1, output.shape[-1]) for output in outputs]
+        results = [
+            decode_yolo_outputs([output[i] for output in outputs], frame.shape, self.confThreshold, self.nmsThreshold,
+                                classes)
+            for i, frame in enumerate(frames)
+        ]
+        self.last_latency = time.perf_counter() - start
+        self.total_time += self.last_latency
+        self.calls += len(frames)
+        self.batch_seconds.observe(self.last_latency)
+        self.frames_detected.inc(len(frames))
+        return results
+
+    @property
+    def mean_latency(self):
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def stats(self):
+        """
+        Returns the load time and per call latency of this detector in seconds
+        """
+        return {
+            "backend": self.backend,
+            "load_time": self.load_time,
+            "warm_up_time": self.warm_up_time,
+            "calls": self.calls,
+            "last_latency": self.last_latency,
+            "mean_latency": self.mean_latency,
+        }
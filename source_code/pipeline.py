@@ -0,0 +1,223 @@
+import queue
+import threading
+import time
+from typing import Callable, Iterable, NamedTuple
+import metrics
+
+# Put on a queue once there is nothing more to come
+_END = object()
+
+
+class Stage(NamedTuple):
+    """
+    One step of a Pipeline, fn is called with the output of the previous stage.
+    Only give a stage more than one worker if fn keeps no state between frames
+    """
+    name: str
+    fn: Callable
+    workers: int = 1
+
+
+class StageStats:
+    """
+    Busy and idle time of one stage, idle is the time spent waiting on the queues on either side
+    """
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.idle = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, busy, idle):
+        with self.lock:
+            self.items += 1
+            self.busy += busy
+            self.idle += idle
+
+    def as_dict(self):
+        total = self.busy + self.idle
+        return {
+            "items": self.items,
+            "busy": self.busy,
+            "idle": self.idle,
+            "utilisation": self.busy / total if total else 0.0,
+            "per_item": self.busy / self.items if self.items else 0.0,
+        }
+
+
+class Pipeline:
+    """
+    This class runs the steps of a video loop as concurrent stages connected by bounded queues.
+    The source and every stage run on their own threads, the sink runs on the calling thread
+    (cv2.imshow has to stay there) and always gets the frames back in their original order.
+    A full queue blocks the stage feeding it, so a slow stage slows the ones before it down
+    instead of piling frames up in memory
+    """
+    def __init__(self, source: Iterable, stages, sink: Callable, queue_size=4, name=None):
+        """
+        Args:
+            source: Iterable producing the items, e.g. a frame generator
+            stages: List of Stage, run in order
+            sink: Called with the output of the last stage, in order, on the calling thread.
+                Returning False stops the pipeline
+            queue_size: Size of each queue between two stages
+            name: Publish the stage latencies and queue depths as metrics under this pipeline name
+        """
+        self.source = source
+        self.stages = list(stages)
+        self.sink = sink
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(self.stages) + 1)]
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.stats = {"decode": StageStats("decode")}
+        for stage in self.stages:
+            self.stats[stage.name] = StageStats(stage.name)
+        self.stats["sink"] = StageStats("sink")
+        self.stage_seconds = {}
+        self.queue_depths = []
+        if name is not None:
+            self.stage_seconds = {stage.name: metrics.histogram("stage_seconds", pipeline=name, stage=stage.name)
+                                  for stage in self.stages}
+            inputs = [stage.name for stage in self.stages] + ["sink"]
+            self.queue_depths = [metrics.gauge("pipeline_queue_depth", pipeline=name, queue=f"to_{stage}")
+                                 for stage in inputs]
+
+    def _put(self, q, item):
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self.stop_event.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _fail(self, error):
+        self.errors.append(error)
+        self.stop_event.set()
+
+    def _run_source(self):
+        stats = self.stats["decode"]
+        out = self.queues[0]
+        iterator = iter(self.source)
+        seq = 0
+        try:
+            while not self.stop_event.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                produced = time.perf_counter()
+                if not self._put(out, (seq, item)):
+                    break
+                stats.add(produced - start, time.perf_counter() - produced)
+                seq += 1
+        except Exception as error:
+            self._fail(error)
+        finally:
+            self._put(out, _END)
+
+    def _run_stage(self, stage, index, finished):
+        stats = self.stats[stage.name]
+        seconds = self.stage_seconds.get(stage.name)
+        inbox, out = self.queues[index], self.queues[index + 1]
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self._get(inbox)
+                if item is _END:
+                    # let the other workers of this stage see the end too
+                    self._put(inbox, _END)
+                    break
+                got = time.perf_counter()
+                seq, value = item
+                value = stage.fn(value)
+                done = time.perf_counter()
+                if seconds is not None:
+                    seconds.observe(done - got)
+                if not self._put(out, (seq, value)):
+                    break
+                stats.add(done - got, (got - start) + (time.perf_counter() - done))
+        except Exception as error:
+            self._fail(error)
+        finally:
+            with finished[index]["lock"]:
+                finished[index]["left"] -= 1
+                last = finished[index]["left"] == 0
+            if last:
+                self._put(out, _END)
+
+    def run(self):
+        """
+        Runs the pipeline until the source is exhausted, the sink returns False or a stage fails.
+        Returns the per stage stats, see report()
+        """
+        finished = [{"lock": threading.Lock(), "left": stage.workers} for stage in self.stages]
+        threads = [threading.Thread(target=self._run_source, name="pipeline-decode", daemon=True)]
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(target=self._run_stage, args=(stage, index, finished),
+                                                name=f"pipeline-{stage.name}-{worker}", daemon=True))
+        for thread in threads:
+            thread.start()
+
+        stats = self.stats["sink"]
+        inbox = self.queues[-1]
+        pending = {}
+        next_seq = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self._get(inbox)
+                if item is _END:
+                    break
+                seq, value = item
+                pending[seq] = value
+                for depth, q in zip(self.queue_depths, self.queues):
+                    depth.set(q.qsize())
+                waited = time.perf_counter() - start
+                # stages with several workers can finish out of order, hold items back until it is their turn
+                while next_seq in pending:
+                    begin = time.perf_counter()
+                    keep_going = self.sink(pending.pop(next_seq))
+                    stats.add(time.perf_counter() - begin, waited)
+                    waited = 0.0
+                    next_seq += 1
+                    if keep_going is False:
+                        self.stop_event.set()
+                        break
+                if self.stop_event.is_set():
+                    break
+        finally:
+            self.stop_event.set()
+            for thread in threads:
+                thread.join(timeout=5)
+        if self.errors:
+            raise self.errors[0]
+        return self.report()
+
+    def report(self):
+        """
+        Returns a dictionary mapping every stage to its busy/idle time in seconds
+        """
+        return {name: stats.as_dict() for name, stats in self.stats.items()}
+
+
+def format_report(report):
+    """
+    Formats the output of Pipeline.report() as a small table
+    """
+    lines = [f"{'stage':<12}{'items':>8}{'busy (s)':>10}{'idle (s)':>10}{'busy %':>8}{'ms/item':>9}"]
+    for name, stats in report.items():
+        lines.append(f"{name:<12}{stats['items']:>8}{stats['busy']:>10.2f}{stats['idle']:>10.2f}"
+                     f"{stats['utilisation'] * 100:>7.0f}%{stats['per_item'] * 1000:>9.2f}")
+    return "\n".join(lines)
@@ -0,0 +1,375 @@
+import json
+import logging
+import threading
+import time
+from collections.abc import Mapping
+import metrics
+import startup
+
+LANES = ("lane0", "lane1", "lane2", "lane3")
+
+logger = logging.getLogger(__name__)
+
+
+class RealClock:
+    """
+    Wall clock time, what drives the traffic light hardware
+    """
+    def __init__(self, tick=0.5):
+        """
+        Args:
+            tick: Longest stretch sleep_until sleeps before checking if it should stop
+        """
+        self.tick = tick
+
+    def now(self):
+        return time.time()
+
+    def sleep_until(self, deadline, interrupt=None):
+        """
+        Sleeps until deadline, returns early (False) when interrupt() becomes True
+        """
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return True
+            if interrupt is not None and interrupt():
+                return False
+            time.sleep(min(remaining, self.tick))
+
+
+class VirtualClock:
+    """
+    Simulated time, sleeping just moves the clock forward so a day of traffic replays in moments
+    """
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def sleep_until(self, deadline, interrupt=None):
+        if interrupt is not None and interrupt():
+            return False
+        self.time = max(self.time, deadline)
+        return True
+
+
+class Phase:
+    """
+    One green phase: which lane, from when, for how long and how many vehicles were waiting on it
+    """
+    __slots__ = ("lane", "start", "duration", "vehicles", "new_cycle", "serves")
+
+    def __init__(self, lane, start, duration, vehicles, new_cycle, serves=True):
+        self.lane = lane
+        self.start = start
+        self.duration = duration
+        self.vehicles = vehicles
+        self.new_cycle = new_cycle
+        self.serves = serves  # False for the placeholder phases run before there are counts
+
+
+class TrafficLightScheduler:
+    """
+    This class is the event driven version of the timing loop in four_c.
+    The policy is the same: every lane is served once per cycle, the busiest lane that has not been
+    served yet goes first and the green time grows with the number of vehicles in the lane.
+    Instead of polling, the scheduler decides the next phase, sleeps on its clock until the phase ends
+    and decides again, so it runs on a RealClock for the hardware and on a VirtualClock to replay
+    recorded count traces offline. Cycle lengths, wait times and throughput are collected on the way
+    """
+    def __init__(self, no_of_vehicles_per_lane, green_lane, clock=None, lanes=LANES, green_time_per_vehicle=100,
+                 default_green_time=100, verbose=True, publish_metrics=True):
+        """
+        Args:
+            no_of_vehicles_per_lane: Mapping of lane to number of vehicles, e.g. the shared LaneCounts
+            green_lane: Object whose .value holds the green lane, e.g. the shared GreenLane
+            clock: RealClock (default) or VirtualClock
+            lanes: All the lanes of the intersection
+            green_time_per_vehicle: Seconds of green for every vehicle in the lane
+            default_green_time: Seconds of green for a lane without vehicles or without counts
+            verbose: Log every phase at info level, debug otherwise
+            publish_metrics: Export every decision as metrics, off for simulations
+        """
+        self.counts = no_of_vehicles_per_lane
+        self.green_lane = green_lane
+        self.clock = clock if clock is not None else RealClock()
+        self.lanes = tuple(lanes)
+        self.green_time_per_vehicle = green_time_per_vehicle
+        self.default_green_time = default_green_time
+        self.verbose = verbose
+
+        self.served = {}  # lanes served in the current cycle and their green time
+        self.phases = []
+        self.cycle_starts = []
+        self.red_since = {}  # when each lane last turned red
+        self.waits = {lane: [] for lane in self.lanes}
+        self.started_at = None
+        self.first_decision = None  # when the first phase picked from real counts started
+        self.log_level = logging.INFO if verbose else logging.DEBUG
+        self.metrics = None
+        if publish_metrics:
+            self.metrics = {
+                "green_lane": metrics.gauge("signal_green_lane"),
+                "cycle": metrics.gauge("signal_last_cycle_seconds"),
+                "phases": {lane: metrics.counter("signal_phases", lane=lane) for lane in self.lanes},
+                "green": {lane: metrics.histogram("signal_green_seconds", lane=lane) for lane in self.lanes},
+                "wait": {lane: metrics.histogram("signal_wait_seconds", lane=lane) for lane in self.lanes},
+            }
+
+    def stopped(self):
+        return self.green_lane.value == "Error"
+
+    def next_phase(self, now):
+        """
+        Picks the next green lane and its green time from the current counts
+        """
+        counts = self.counts.copy()
+        new_cycle = False
+        if len(self.served) >= len(self.lanes):
+            logger.log(self.log_level, "All lanes have been served %s %s", self.served, counts)
+            self.served.clear()
+            new_cycle = True
+        if len(counts) == 0:
+            return Phase(self.lanes[0], now, self.default_green_time, 0, new_cycle, serves=False)
+
+        lane_left = {lane: count for lane, count in counts.items() if lane not in self.served}
+        if len(lane_left) == 0:
+            # every lane with a count was served and the others never reported one, the old loop
+            # spun here until they did. Start the next cycle instead
+            logger.log(self.log_level, "All lanes with counts have been served %s %s", self.served, counts)
+            self.served.clear()
+            lane_left = counts
+            new_cycle = True
+        max_key = max(lane_left, key=lane_left.get)
+        vehicles = lane_left[max_key]
+        duration = vehicles * self.green_time_per_vehicle if vehicles else self.default_green_time
+        return Phase(max_key, now, duration, vehicles, new_cycle)
+
+    def _start(self, phase):
+        if phase.new_cycle or not self.cycle_starts:
+            self.cycle_starts.append(phase.start)
+            if self.metrics is not None and len(self.cycle_starts) > 1:
+                self.metrics["cycle"].set(self.cycle_starts[-1] - self.cycle_starts[-2])
+        if phase.serves:
+            self.served[phase.lane] = phase.duration
+            if self.first_decision is None:
+                self.first_decision = phase.start
+                if self.metrics is not None:
+                    startup.mark("first_decision")
+        previous = self.phases[-1] if self.phases else None
+        if previous is not None and previous.lane != phase.lane:
+            self.red_since[previous.lane] = phase.start
+        if previous is None or previous.lane != phase.lane:
+            since = self.red_since.get(phase.lane, self.started_at)
+            self.waits.setdefault(phase.lane, []).append(phase.start - since)
+            if self.metrics is not None and phase.lane in self.metrics["wait"]:
+                self.metrics["wait"][phase.lane].observe(phase.start - since)
+        self.phases.append(phase)
+        if hasattr(self.green_lane, "set_phase"):
+            # a placeholder ends as soon as counts come in, so the next decision is due right away
+            until = phase.start + phase.duration if phase.serves else phase.start
+            self.green_lane.set_phase(phase.lane, until, tuple(self.served))
+        else:
+            self.green_lane.value = phase.lane
+        if self.metrics is not None and phase.lane in self.metrics["phases"]:
+            self.metrics["green_lane"].set(self.lanes.index(phase.lane))
+            self.metrics["phases"][phase.lane].inc()
+            self.metrics["green"][phase.lane].observe(phase.duration)
+        logger.log(self.log_level, "Green light is on %s for %ss", self.green_lane, phase.duration)
+
+    def step(self):
+        """
+        Starts the next phase and sleeps until it ends. Returns False once the scheduler has to stop
+        """
+        if self.stopped():
+            return False
+        now = self.clock.now()
+        if self.started_at is None:
+            self.started_at = now
+            for lane in self.lanes:
+                self.red_since.setdefault(lane, now)
+        if not self.phases and self.green_lane.value == "None":
+            # nothing has been decided yet, open lane0 while the counts come in
+            phase = Phase(self.lanes[0], now, self.default_green_time, 0, True, serves=False)
+        else:
+            phase = self.next_phase(now)
+        self._start(phase)
+        interrupt = self.stopped
+        if not phase.serves:
+            # a placeholder ends as soon as the first counts come in, otherwise the first real decision
+            # after startup would wait out a whole default green time
+            interrupt = lambda: self.stopped() or len(self.counts) > 0
+        return self.clock.sleep_until(phase.start + phase.duration, interrupt=interrupt) or not self.stopped()
+
+    def run(self, until=None):
+        """
+        Runs phases until green_lane is set to "Error" or the clock passes until
+        """
+        while until is None or self.clock.now() < until:
+            if not self.step():
+                break
+        return self.report()
+
+    def report(self):
+        """
+        Returns cycle lengths, per lane wait times and throughput of the phases run so far
+        """
+        now = self.clock.now()
+        elapsed = now - self.started_at if self.started_at is not None else 0.0
+        cycles = [end - start for start, end in zip(self.cycle_starts, self.cycle_starts[1:])]
+        vehicles = sum(phase.vehicles for phase in self.phases)
+        lanes = {}
+        for lane in self.lanes:
+            waits = self.waits.get(lane, [])
+            green = sum(phase.duration for phase in self.phases if phase.lane == lane)
+            lanes[lane] = {
+                "phases": len(waits),
+                "mean_wait": sum(waits) / len(waits) if waits else 0.0,
+                "max_wait": max(waits) if waits else 0.0,
+                "green_time": green,
+                "vehicles": sum(phase.vehicles for phase in self.phases if phase.lane == lane),
+            }
+        return {
+            "elapsed": elapsed,
+            "first_decision": self.first_decision - self.started_at if self.first_decision is not None else None,
+            "phases": len(self.phases),
+            "cycles": len(cycles),
+            "mean_cycle": sum(cycles) / len(cycles) if cycles else 0.0,
+            "max_cycle": max(cycles) if cycles else 0.0,
+            # vehicles waiting on a lane when it turned green, assumed to have cleared during the phase
+            "vehicles": vehicles,
+            "throughput_per_hour": vehicles / elapsed * 3600 if elapsed else 0.0,
+            "lanes": lanes,
+        }
+
+
+class GreenValue:
+    """
+    Stand in for the shared green lane when the scheduler runs on its own
+    """
+    def __init__(self, value="None"):
+        self.value = value
+        self.until = None
+        self.served = set()
+
+    def set_phase(self, lane, until, served):
+        self.value = lane
+        self.until = until
+        self.served = set(served)
+
+    def phase(self):
+        green = None if self.value in ("None", "Error") else self.value
+        return {"green": green, "until": self.until, "served": set(self.served)}
+
+    def __repr__(self):
+        return repr(self.value)
+
+
+class TraceCounts(Mapping):
+    """
+    Replays a recorded count trace, the counts are the last ones recorded at or before clock.now()
+    """
+    def __init__(self, trace, clock):
+        """
+        Args:
+            trace: List of (seconds since the start of the recording, {lane: count}) sorted by time
+            clock: The clock of the scheduler
+        """
+        self.times = [t for t, _ in trace]
+        self.values = [counts for _, counts in trace]
+        self.clock = clock
+        self.start = clock.now()
+        self.position = 0
+
+    def current(self):
+        elapsed = self.clock.now() - self.start
+        # the clock only moves forward, so walk on from the last position instead of searching
+        while self.position + 1 < len(self.times) and self.times[self.position + 1] <= elapsed:
+            self.position += 1
+        if not self.times or self.times[self.position] > elapsed:
+            return {}
+        return self.values[self.position]
+
+    def __getitem__(self, lane):
+        return self.current()[lane]
+
+    def __iter__(self):
+        return iter(self.current())
+
+    def __len__(self):
+        return len(self.current())
+
+    def copy(self):
+        return dict(self.current())
+
+
+class TraceRecorder:
+    """
+    This class records the shared lane counts to a JSON lines file on a background thread,
+    one line {"t": seconds since the start, "counts": {...}} whenever the counts change.
+    The file can be replayed with load_trace and simulate
+    """
+    def __init__(self, no_of_vehicles_per_lane, path, interval=1.0):
+        self.counts = no_of_vehicles_per_lane
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="trace-recorder", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        start = time.time()
+        last = None
+        with open(self.path, "w") as file:
+            while not self.stop_event.is_set():
+                counts = self.counts.copy()
+                if counts != last:
+                    file.write(json.dumps({"t": round(time.time() - start, 3), "counts": counts}) + "\n")
+                    file.flush()
+                    last = counts
+                self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
+def load_trace(path):
+    """
+    Reads a trace written by TraceRecorder, returns a list of (seconds, {lane: count})
+    """
+    trace = []
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                entry = json.loads(line)
+                trace.append((float(entry["t"]), {lane: int(count) for lane, count in entry["counts"].items()}))
+    trace.sort(key=lambda entry: entry[0])
+    return trace
+
+
+def simulate(trace, duration=None, lanes=LANES, green_time_per_vehicle=100, default_green_time=100):
+    """
+    Replays a count trace through the scheduler on a virtual clock
+    Args:
+        trace: List of (seconds, {lane: count}), see load_trace
+        duration: Seconds of traffic to simulate, defaults to the length of the trace
+        lanes: All the lanes of the intersection
+        green_time_per_vehicle: Seconds of green for every vehicle in the lane
+        default_green_time: Seconds of green for a lane without vehicles
+    Returns:
+        The scheduler report, see TrafficLightScheduler.report
+    """
+    clock = VirtualClock()
+    counts = TraceCounts(trace, clock)
+    if duration is None:
+        duration = trace[-1][0] if trace else 0.0
+    scheduler = TrafficLightScheduler(counts, GreenValue(), clock=clock, lanes=lanes,
+                                      green_time_per_vehicle=green_time_per_vehicle,
+                                      default_green_time=default_green_time, verbose=False, publish_metrics=False)
+    return scheduler.run(until=clock.now() + duration)
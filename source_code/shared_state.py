@@ -0,0 +1,288 @@
+import multiprocessing as mp
+import time
+from collections.abc import MutableMapping
+from multiprocessing import shared_memory
+import numpy as np
+
+LANES = ("lane0", "lane1", "lane2", "lane3")
+
+# Values of the green field that are not a lane index
+GREEN_NONE = -1
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+
+def state_dtype(lanes):
+    """
+    Fixed layout of the shared block, every field is 8 bytes wide so it stays aligned
+    """
+    return np.dtype([
+        ("seq", np.uint64),  # odd while a writer is in the middle of an update
+        ("green", np.int64),  # index into lanes, or GREEN_NONE
+        ("green_since", np.float64),  # time.time() of the last green change
+        ("green_until", np.float64),  # time.time() the timing process plans its next decision for, 0 if unknown
+        ("status", np.int64),  # STATUS_OK or STATUS_ERROR
+        ("counts", np.int64, (len(lanes),)),
+        ("present", np.int64, (len(lanes),)),  # 1 once the lane has been given a count
+        ("updated_at", np.float64, (len(lanes),)),  # time.time() of the last count of the lane
+        ("served", np.int64, (len(lanes),)),  # 1 once the lane has been green in the current cycle
+    ])
+
+
+class IntersectionState:
+    """
+    This class holds the state shared between the vision and the timing processes in one
+    fixed layout shared memory block: per lane counts and timestamps, the current green lane and a status flag.
+    Writers take a lock and bump a sequence number around every update, readers never lock,
+    they retry when they see the sequence change under them (a seqlock), so reading the
+    state costs a few memory reads instead of a round trip to a Manager server
+    """
+    def __init__(self, lanes=LANES, name=None, lock=None):
+        self.lanes = tuple(lanes)
+        self.lane_index = {lane: i for i, lane in enumerate(self.lanes)}
+        self.dtype = state_dtype(self.lanes)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.dtype.itemsize)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        # a spawn context lock can be handed to both forked and spawned processes
+        self.lock = lock if lock is not None else mp.get_context("spawn").Lock()
+        self.block = np.ndarray((1,), dtype=self.dtype, buffer=self.shm.buf)
+        if self.owner:
+            self.block[0] = np.zeros((), dtype=self.dtype)
+            self.block["green"] = GREEN_NONE
+        # plain views of every field, looking fields up by name on each access is slow
+        self.seq = self.block["seq"]
+        self.green_field = self.block["green"]
+        self.green_since = self.block["green_since"]
+        self.green_until = self.block["green_until"]
+        self.status = self.block["status"]
+        self.count_values = self.block["counts"][0]
+        self.present = self.block["present"][0]
+        self.updated_at = self.block["updated_at"][0]
+        self.served = self.block["served"][0]
+
+    def __getstate__(self):
+        return {"lanes": self.lanes, "name": self.shm.name, "lock": self.lock}
+
+    def __setstate__(self, state):
+        self.__init__(lanes=state["lanes"], name=state["name"], lock=state["lock"])
+
+    def _begin_write(self):
+        self.lock.acquire()
+        self.seq[0] += 1
+
+    def _end_write(self):
+        self.seq[0] += 1
+        self.lock.release()
+
+    def _read(self, fn):
+        """
+        Calls fn until it ran without a writer touching the block at the same time and returns its result
+        """
+        while True:
+            seq = int(self.seq[0])
+            if seq & 1:
+                time.sleep(0)
+                continue
+            result = fn()
+            if int(self.seq[0]) == seq:
+                return result
+
+    def read(self):
+        """
+        Returns a consistent copy of the whole block as a numpy record
+        """
+        return self._read(lambda: self.block[0].copy())
+
+    def set_counts(self, counts):
+        """
+        Writes the counts of one or more lanes in a single update
+        Args:
+            counts: A dictionary mapping lane names to their number of vehicles
+        """
+        indices = [self.lane_index[lane] for lane in counts.keys()]
+        now = time.time()
+        self._begin_write()
+        try:
+            for i, count in zip(indices, counts.values()):
+                self.count_values[i] = count
+                self.present[i] = 1
+                self.updated_at[i] = now
+        finally:
+            self._end_write()
+
+    def clear_count(self, lane):
+        i = self.lane_index[lane]
+        self._begin_write()
+        try:
+            self.count_values[i] = 0
+            self.present[i] = 0
+        finally:
+            self._end_write()
+
+    def counts(self):
+        """
+        Returns a dictionary with the count of every lane that has been given one
+        """
+        counts, present = self._read(lambda: (self.count_values.tolist(), self.present.tolist()))
+        return {lane: count for lane, count, flag in zip(self.lanes, counts, present) if flag}
+
+    def set_green(self, value):
+        """
+        Sets the green lane the same way the old Manager().Value did, "None" and "Error" included
+        """
+        green = None if value in ("Error", "None") else self.lane_index[value]
+        self._begin_write()
+        try:
+            if value == "Error":
+                self.status[0] = STATUS_ERROR
+            elif value == "None":
+                self.green_field[0] = GREEN_NONE
+                self.green_since[0] = time.time()
+            else:
+                self.green_field[0] = green
+                self.green_since[0] = time.time()
+        finally:
+            self._end_write()
+
+    def set_phase(self, lane, until, served):
+        """
+        Sets the green lane along with when the next decision is due and the lanes served so far in the cycle,
+        in one update so the vision side never sees a green lane with the plan of the previous phase
+        Args:
+            lane: The green lane
+            until: time.time() of the next decision
+            served: The lanes that have been green in the current cycle
+        """
+        green = self.lane_index[lane]
+        served = {self.lane_index[lane] for lane in served}
+        self._begin_write()
+        try:
+            if self.green_field[0] != green:
+                self.green_since[0] = time.time()
+            self.green_field[0] = green
+            self.green_until[0] = until
+            for i in range(len(self.lanes)):
+                self.served[i] = 1 if i in served else 0
+        finally:
+            self._end_write()
+
+    def phase(self):
+        """
+        Returns the signal state the vision side plans its work with: the green lane (None before the first
+        phase), the time.time() of the next decision (None if unknown) and the lanes served in the current cycle
+        """
+        green, until, served = self._read(
+            lambda: (int(self.green_field[0]), float(self.green_until[0]), self.served.tolist()))
+        return {
+            "green": None if green == GREEN_NONE else self.lanes[green],
+            "until": until or None,
+            "served": {lane for lane, flag in zip(self.lanes, served) if flag},
+        }
+
+    def green(self):
+        status, green = self._read(lambda: (int(self.status[0]), int(self.green_field[0])))
+        if status == STATUS_ERROR:
+            return "Error"
+        if green == GREEN_NONE:
+            return "None"
+        return self.lanes[green]
+
+    def set_status(self, status):
+        self._begin_write()
+        try:
+            self.status[0] = status
+        finally:
+            self._end_write()
+
+    def snapshot(self):
+        """
+        Returns everything in the block as plain python values, handy for logging
+        """
+        snapshot = self.read()
+        return {
+            "green": None if snapshot["green"] == GREEN_NONE else self.lanes[snapshot["green"]],
+            "green_since": float(snapshot["green_since"]),
+            "green_until": float(snapshot["green_until"]),
+            "served": [lane for i, lane in enumerate(self.lanes) if snapshot["served"][i]],
+            "status": int(snapshot["status"]),
+            "counts": {lane: int(snapshot["counts"][i]) for i, lane in enumerate(self.lanes)},
+            "updated_at": {lane: float(snapshot["updated_at"][i]) for i, lane in enumerate(self.lanes)},
+        }
+
+    def close(self):
+        del self.block, self.seq, self.green_field, self.green_since, self.green_until, self.status
+        del self.count_values, self.present, self.updated_at, self.served
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class LaneCounts(MutableMapping):
+    """
+    Dictionary like view of the lane counts of an IntersectionState,
+    a drop in replacement for the Manager().dict() used for 'no_of_vehicles_per_lane'
+    """
+    def __init__(self, state):
+        self.state = state
+
+    def __getitem__(self, lane):
+        counts = self.state.counts()
+        if lane not in counts:
+            raise KeyError(lane)
+        return counts[lane]
+
+    def __setitem__(self, lane, count):
+        self.state.set_counts({lane: count})
+
+    def __delitem__(self, lane):
+        if lane not in self.state.counts():
+            raise KeyError(lane)
+        self.state.clear_count(lane)
+
+    def __iter__(self):
+        return iter(self.state.counts())
+
+    def __len__(self):
+        return len(self.state.counts())
+
+    def update(self, other=(), **kwargs):
+        # one write for all the lanes instead of one per lane
+        counts = dict(other, **kwargs)
+        if counts:
+            self.state.set_counts(counts)
+
+    def copy(self):
+        return self.state.counts()
+
+    def __repr__(self):
+        return repr(self.state.counts())
+
+
+class GreenLane:
+    """
+    Replacement for the Manager().Value used for 'green_lane', backed by an IntersectionState
+    """
+    def __init__(self, state):
+        self.state = state
+
+    @property
+    def value(self):
+        return self.state.green()
+
+    @value.setter
+    def value(self, value):
+        self.state.set_green(value)
+
+    def set_phase(self, lane, until, served):
+        self.state.set_phase(lane, until, served)
+
+    def phase(self):
+        return self.state.phase()
+
+    def __repr__(self):
+        return f"GreenLane({self.value!r})"
@@ -0,0 +1,54 @@
+import logging
+import metrics
+from scheduler import RealClock, TrafficLightScheduler, TraceRecorder
+from arguments import (green_time_per_vehicle, default_green_time, count_trace_path, count_trace_interval, metrics_dir,
+                       metrics_interval)
+
+logger = logging.getLogger(__name__)
+
+
+def start_metrics_writer(process):
+    """
+    Starts the metrics snapshot of this process, see metrics.start_metrics
+    """
+    return metrics.start_metrics(process, metrics_dir, metrics_interval)
+
+
+def stop_metrics_writer(writer):
+    if writer is not None:
+        writer.stop()
+
+
+def timing(no_of_vehicles_per_lane, green_lane):
+    """
+    This function controls the timing of the traffic light
+    It checks the number of vehicles in each lane and determines the lane with the highest number of vehicles
+    The lane with the highest number of vehicles is given the green light
+    And the time the green light is on is determined by the number of vehicles in the lane
+    Once a lane has been given the green light, it is added to the list of lanes
+    that has been greenlighted until all lanes have been served. This ensures that no lane is left out
+    in a cycle. The algorithm is designed to serve all lanes in a cycle before starting a new cycle. And it always
+    picks the lane with the highest number of vehicles to serve first.
+    The policy itself lives in scheduler.TrafficLightScheduler, this runs it on the wall clock
+    and optionally records the counts so the run can be replayed with scheduler.simulate.
+    It lives apart from four_c so both modes run it without importing the vision code
+    Args:
+        no_of_vehicles_per_lane: A shared dictionary containing the number of vehicles in each lane
+        green_lane: A shared variable containing the lane that has the green light
+    Returns:
+        None
+    """
+    writer = start_metrics_writer("timing")
+    recorder = None
+    if count_trace_path:
+        recorder = TraceRecorder(no_of_vehicles_per_lane, count_trace_path, count_trace_interval).start()
+    scheduler = TrafficLightScheduler(no_of_vehicles_per_lane, green_lane, clock=RealClock(),
+                                      green_time_per_vehicle=green_time_per_vehicle,
+                                      default_green_time=default_green_time)
+    try:
+        report = scheduler.run()
+    finally:
+        if recorder is not None:
+            recorder.stop()
+        stop_metrics_writer(writer)
+    logger.info("Timing stats: %s", report)
@@ -0,0 +1,46 @@
+import logging
+import os
+import time
+import metrics
+
+# main.py puts the time it started here, the processes it starts inherit it with the environment
+STARTED_AT_ENV = "TRAFFIC_STARTED_AT"
+
+logger = logging.getLogger(__name__)
+
+_marks = {}
+
+
+def begin(started_at=None):
+    """
+    Records the start of the run, every mark() of this process and of the processes started
+    from it counts from here
+    Args:
+        started_at: time.time() of the start, now by default
+    """
+    os.environ[STARTED_AT_ENV] = repr(time.time() if started_at is None else started_at)
+
+
+def started_at():
+    value = os.environ.get(STARTED_AT_ENV)
+    return float(value) if value else None
+
+
+def mark(stage):
+    """
+    Logs how long after the start of the run a startup stage was reached and exports it as the
+    startup_seconds gauge. Only the first mark of a stage in a process counts, nothing happens
+    when the run was not started through begin() (e.g. in the benchmarks)
+    Returns:
+        The seconds since the start, or None
+    """
+    if stage in _marks:
+        return _marks[stage]
+    start = started_at()
+    if start is None:
+        return None
+    seconds = time.time() - start
+    _marks[stage] = seconds
+    metrics.gauge("startup_seconds", stage=stage).set(seconds)
+    logger.info("Startup: %s after %.2fs", stage, seconds)
+    return seconds
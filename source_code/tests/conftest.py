@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules live flat in source_code and import each other by name, like when they run from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,95 @@
+import math
+import pytest
+from compute_budget import ComputeBudget
+
+LANES = ("lane0", "lane1", "lane2", "lane3")
+FPS = 15.0
+
+
+class Clock:
+    """
+    Capture cycles at a steady FPS, every call is the next cycle
+    """
+    def __init__(self):
+        self.cycles = 0
+
+    def __call__(self):
+        self.cycles += 1
+        return 1000.0 + self.cycles / FPS
+
+
+def run(budget, signal, cycles):
+    """
+    Returns the cycles every lane was selected on
+    """
+    chosen = {lane: [] for lane in LANES}
+    for cycle in range(cycles):
+        for lane in budget.select(list(LANES), signal):
+            chosen[lane].append(cycle)
+    return chosen
+
+
+def longest_gap(cycles):
+    return max(later - earlier for earlier, later in zip(cycles, cycles[1:]))
+
+
+# lane1 is green, lane0 was served, lane2 and lane3 wait and the next decision is close
+DUE = {"green": "lane1", "until": 1000.0, "served": {"lane0"}}
+
+
+def test_every_lane_on_the_first_cycle():
+    budget = ComputeBudget(LANES, fps_budget=1.0, clock=Clock())
+    # the first decision needs counts of every lane, whatever the budget
+    assert budget.select(list(LANES), DUE) == list(LANES)
+
+
+def test_green_lane_is_chosen_at_its_rate():
+    budget = ComputeBudget(LANES, green_weight=0.25, clock=Clock())
+    chosen = run(budget, DUE, 41)
+    # the credit every lane starts with is spent on the first cycle, then the green lane comes every 4th
+    assert chosen["lane1"] == list(range(0, 41, 4))
+    assert chosen["lane2"] == chosen["lane3"] == list(range(41))
+
+
+def test_full_weight_green_lane_every_cycle():
+    budget = ComputeBudget(LANES, green_weight=1.0, clock=Clock())
+    assert run(budget, DUE, 20)["lane1"] == list(range(20))
+
+
+def test_budget_above_demand_selects_every_lane():
+    # nothing decided yet, every lane runs at full rate and the budget fits all of them
+    budget = ComputeBudget(LANES, fps_budget=len(LANES) * FPS, clock=Clock())
+    chosen = run(budget, {"green": None}, 30)
+    assert all(cycles == list(range(30)) for cycles in chosen.values())
+    assert budget.scale == pytest.approx(1.0)
+
+
+def test_starved_lanes_are_served_within_the_bound():
+    budget = ComputeBudget(LANES, fps_budget=6.0, green_weight=0.25, served_weight=0.25, clock=Clock())
+    cycles = 600
+    chosen = run(budget, DUE, cycles)
+    weights = budget.weights(DUE, 1000.0)
+    scale = 6.0 / (sum(weights.values()) * FPS)
+    assert budget.scale == pytest.approx(scale, rel=1e-3)
+    for lane in LANES:
+        # a lane earns weight * scale of a frame of credit per cycle and is chosen once it has a whole one
+        bound = math.ceil(1 / (weights[lane] * scale)) + 1
+        assert longest_gap(chosen[lane][1:]) <= bound, lane
+        assert len(chosen[lane]) >= cycles // bound
+    # the budget is never exceeded, a lane gets no credit past one frame so its rate rounds down to one
+    # frame every ceil(1 / rate) cycles
+    detected = sum(len(lane_cycles) for lane_cycles in chosen.values())
+    expected = sum(FPS / math.ceil(1 / (weight * scale)) for weight in weights.values())
+    assert detected / (cycles / FPS) == pytest.approx(expected, rel=0.02)
+    assert expected <= 6.0
+    assert budget.stats()["processed"] == {lane: len(chosen[lane]) for lane in LANES}
+
+
+def test_waiting_lanes_run_at_full_rate_only_near_the_decision():
+    budget = ComputeBudget(LANES, waiting_weight=0.5, lookahead=10.0, clock=Clock())
+    far = {"green": "lane1", "until": 1000.0 + 60.0, "served": {"lane0"}}
+    assert budget.weights(far, 1000.0) == {"lane0": 0.25, "lane1": 0.25, "lane2": 0.5, "lane3": 0.5}
+    assert budget.weights(far, 1000.0 + 55.0)["lane2"] == 1.0
+    # once every other lane was served the next cycle looks at all of them again
+    last = {"green": "lane3", "until": None, "served": {"lane0", "lane1", "lane2"}}
+    assert budget.weights(last, 1000.0) == {"lane0": 1.0, "lane1": 1.0, "lane2": 1.0, "lane3": 0.25}
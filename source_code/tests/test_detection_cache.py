@@ -0,0 +1,156 @@
+import os
+import numpy as np
+import pytest
+import detection_cache
+from detection_cache import DetectionCache, cache_key, evict, get_cache, get_lane_caches
+
+
+@pytest.fixture
+def files(tmp_path):
+    video = tmp_path / "video.mov"
+    video.write_bytes(b"frames" * 100)
+    weights = tmp_path / "model.weights"
+    weights.write_bytes(b"weights" * 100)
+    cfg = tmp_path / "model.cfg"
+    cfg.write_text("[net]\n")
+    return str(video), [str(weights), str(cfg)]
+
+
+@pytest.fixture(autouse=True)
+def no_shared_caches(monkeypatch):
+    # get_cache hands out one cache per key and process, every test starts without any
+    monkeypatch.setattr(detection_cache, "_caches", {})
+
+
+def detections(count, seed):
+    rng = np.random.default_rng(seed)
+    return (rng.integers(0, 8, count).astype(np.int32), rng.random(count).astype(np.float32),
+            (rng.random((count, 4)) * 600).astype(np.float32))
+
+
+def assert_same(stored, expected):
+    assert stored is not None
+    for column, values in zip(stored, expected):
+        np.testing.assert_array_equal(column, values)
+
+
+def test_round_trip_on_disk(tmp_path):
+    cache = DetectionCache(str(tmp_path), "entry")
+    frames = {0: detections(3, 0), 5: detections(0, 1), 2: detections(7, 2)}
+    for frame_index, result in frames.items():
+        cache.put(frame_index, *result)
+    # pending frames are served before they are written
+    assert_same(cache.get(2), frames[2])
+    cache.flush()
+
+    reopened = DetectionCache(str(tmp_path), "entry")
+    assert len(reopened) == 3
+    for frame_index, result in frames.items():
+        assert frame_index in reopened
+        assert_same(reopened.get(frame_index), result)
+    # a frame detected without any vehicle is a hit, a frame never detected a miss
+    assert len(reopened.get(5)[0]) == 0
+    assert 1 not in reopened and reopened.get(1) is None
+    assert reopened.stats()["hits"] == 4 and reopened.stats()["misses"] == 1
+
+
+def test_flush_merges_with_what_is_on_disk(tmp_path):
+    first, second = DetectionCache(str(tmp_path), "entry"), DetectionCache(str(tmp_path), "entry")
+    first.put(1, *detections(2, 1))
+    first.flush()
+    second.put(0, *detections(4, 0))
+    second.put(1, *detections(9, 9))  # already on disk, the first write stays
+    second.flush()
+    reopened = DetectionCache(str(tmp_path), "entry")
+    assert_same(reopened.get(0), detections(4, 0))
+    assert_same(reopened.get(1), detections(2, 1))
+
+
+def test_key_is_stable(files):
+    video, weights = files
+    assert cache_key(video, weights, 0.5, 0.4) == cache_key(video, weights, 0.5, 0.4)
+
+
+@pytest.mark.parametrize("change", ["model", "cfg", "video", "confidence", "iou", "classes", "image_size"])
+def test_key_changes_with_what_changes_the_detections(files, tmp_path, change):
+    video, weights = files
+    extra = {"image_size": 608, "classes": [1, 2, 3, 5]}
+    before = cache_key(video, weights, 0.5, 0.4, extra, digests_path=str(tmp_path / "digests.json"))
+    confidence, iou = 0.5, 0.4
+    if change == "model":
+        with open(weights[0], "ab") as file:
+            file.write(b"retrained")
+    elif change == "cfg":
+        with open(weights[1], "w") as file:
+            file.write("[net]\nwidth=416\n")
+    elif change == "video":
+        with open(video, "ab") as file:
+            file.write(b"more")
+    elif change == "confidence":
+        confidence = 0.6
+    elif change == "iou":
+        iou = 0.5
+    elif change == "classes":
+        extra = dict(extra, classes=[1, 2, 3, 5, 7])
+    else:
+        extra = dict(extra, image_size=416)
+    after = cache_key(video, weights, confidence, iou, extra, digests_path=str(tmp_path / "digests.json"))
+    assert after != before
+
+
+def test_remembered_digest_is_not_reused_for_a_changed_file(files, tmp_path):
+    video, weights = files
+    digests_path = str(tmp_path / "digests.json")
+    before = detection_cache.file_digest(weights[0], digests_path)
+    with open(weights[0], "wb") as file:
+        file.write(b"other weights of another size")
+    assert detection_cache.file_digest(weights[0], digests_path) != before
+
+
+def test_lane_caches_are_keyed_by_the_detected_classes(files, tmp_path):
+    video, weights = files
+
+    class Detector:
+        confThreshold, nmsThreshold, image_size, runtime = 0.5, 0.4, 608, None
+
+    cache_dir = str(tmp_path / "cache")
+    vehicles = get_lane_caches(cache_dir, {"lane0": video, "lane1": 0}, Detector(), weights, classes=(1, 2, 3, 5))
+    everything = get_lane_caches(cache_dir, {"lane0": video}, Detector(), weights)
+    # the webcam of lane1 is never cached
+    assert list(vehicles) == ["lane0"]
+    assert vehicles["lane0"].key != everything["lane0"].key
+
+
+def test_no_cache_for_live_sources(tmp_path):
+    assert get_cache(str(tmp_path), 0, [], 0.5, 0.4) is None
+    assert get_cache(str(tmp_path), "rtsp://camera/stream", [], 0.5, 0.4) is None
+    assert get_cache(None, __file__, [], 0.5, 0.4) is None
+
+
+def make_entry(cache_dir, key, frames, used):
+    cache = DetectionCache(cache_dir, key)
+    for frame_index in range(frames):
+        cache.put(frame_index, *detections(20, frame_index))
+    cache.flush()
+    os.utime(os.path.join(cache_dir, key, "meta.json"), (used, used))
+    return detection_cache._entry_size(os.path.join(cache_dir, key))
+
+
+def test_evict_drops_least_recently_used_first(tmp_path):
+    cache_dir = str(tmp_path)
+    sizes = {key: make_entry(cache_dir, key, 10, used) for key, used in (("old", 100), ("mid", 200), ("new", 300))}
+    assert evict(cache_dir, sum(sizes.values())) == []
+    assert evict(cache_dir, sizes["mid"] + sizes["new"]) == ["old"]
+    # the entry in keep stays even when it is the oldest
+    assert evict(cache_dir, sizes["new"], keep={"mid"}) == ["new"]
+    assert sorted(os.listdir(cache_dir)) == ["mid"]
+
+
+def test_flush_evicts_other_entries_down_to_max_bytes(tmp_path):
+    cache_dir = str(tmp_path)
+    old = make_entry(cache_dir, "old", 10, 100)
+    cache = DetectionCache(cache_dir, "current", max_bytes=old + 1)
+    cache.put(0, *detections(20, 0))
+    cache.flush()
+    assert os.listdir(cache_dir) == ["current"]
+    assert_same(DetectionCache(cache_dir, "current").get(0), detections(20, 0))
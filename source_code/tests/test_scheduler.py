@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from scheduler import LANES, GreenValue, TraceCounts, TrafficLightScheduler, VirtualClock, simulate
+from benchmarks.timing_simulation import synthetic_trace
+
+
+def make_scheduler(counts, clock, **kwargs):
+    return TrafficLightScheduler(counts, GreenValue(), clock=clock, verbose=False, publish_metrics=False, **kwargs)
+
+
+def run_phases(scheduler, count):
+    """
+    Runs the placeholder phase every scheduler starts with and count more, returns those
+    """
+    for _ in range(count + 1):
+        assert scheduler.step()
+    placeholder = scheduler.phases[0]
+    assert (placeholder.lane, placeholder.serves) == ("lane0", False)
+    return scheduler.phases[1:]
+
+
+def test_busiest_unserved_lane_goes_first():
+    clock = VirtualClock()
+    scheduler = make_scheduler({"lane0": 3, "lane1": 5, "lane2": 1, "lane3": 2}, clock, green_time_per_vehicle=2)
+    phases = run_phases(scheduler, 8)
+    assert [phase.lane for phase in phases] == ["lane1", "lane0", "lane3", "lane2"] * 2
+    assert [phase.duration for phase in phases[:4]] == [10, 6, 4, 2]
+    # the placeholder ends as soon as it sees the counts
+    assert [phase.start for phase in phases[:5]] == [0, 10, 16, 20, 22]
+    assert clock.now() == 44
+    assert scheduler.cycle_starts == [0, 22]
+    assert scheduler.green_lane.phase() == {"green": "lane2", "until": 44, "served": set(LANES)}
+
+
+def test_green_time_bounds():
+    clock = VirtualClock()
+    scheduler = make_scheduler({"lane0": 0, "lane1": 40, "lane2": 1}, clock, green_time_per_vehicle=2,
+                               default_green_time=7)
+    phases = run_phases(scheduler, 6)
+    # an empty lane still gets the default green, the others 2s per waiting vehicle
+    assert {phase.lane: phase.duration for phase in phases} == {"lane1": 80, "lane2": 2, "lane0": 7}
+    # lane3 never reported a count, the cycle starts over without it
+    assert [phase.lane for phase in phases] == ["lane1", "lane2", "lane0"] * 2
+
+
+def test_placeholder_phase_before_the_first_counts():
+    clock = VirtualClock()
+    counts = TraceCounts([(50.0, {"lane2": 4})], clock)
+    scheduler = make_scheduler(counts, clock, green_time_per_vehicle=2, default_green_time=100)
+    scheduler.step()
+    first = scheduler.phases[0]
+    assert (first.lane, first.serves) == ("lane0", False)
+    scheduler.step()
+    assert scheduler.phases[1].lane == "lane2" and scheduler.phases[1].duration == 8
+    report = scheduler.report()
+    assert report["first_decision"] == 100
+    # the placeholder does not count as serving lane0
+    assert "lane0" not in scheduler.served
+
+
+def test_max_wait_of_steady_counts():
+    clock = VirtualClock()
+    scheduler = make_scheduler({"lane0": 3, "lane1": 5, "lane2": 1, "lane3": 2}, clock, green_time_per_vehicle=2)
+    report = scheduler.run(until=22 * 10)
+    assert report["mean_cycle"] == report["max_cycle"] == 22
+    # a lane waits the rest of the cycle, the last one waits from the start on its first turn
+    assert {lane: report["lanes"][lane]["max_wait"] for lane in LANES} == \
+        {"lane0": 16, "lane1": 12, "lane2": 20, "lane3": 18}
+
+
+def test_stops_on_error():
+    clock = VirtualClock()
+    scheduler = make_scheduler({"lane0": 1}, clock)
+    run_phases(scheduler, 1)
+    scheduler.green_lane.value = "Error"
+    assert not scheduler.step()
+    assert len(scheduler.phases) == 2
+
+
+@pytest.mark.parametrize("green_time, max_wait", [(2, 66.0), (5, 150.0)])
+def test_synthetic_day(green_time, max_wait):
+    trace = synthetic_trace(24 * 3600, 1.0, [0.05, 0.1, 0.02, 0.08], np.random.default_rng(0))
+    report = simulate(trace, green_time_per_vehicle=green_time, default_green_time=min(green_time * 5, 100))
+    assert report["elapsed"] >= 24 * 3600 - 1
+    waits = [lane["max_wait"] for lane in report["lanes"].values()]
+    assert max(waits) == max_wait
+    # every lane is green once per cycle, so it never waits longer than two cycles
+    assert max(waits) <= 2 * report["max_cycle"]
@@ -0,0 +1,112 @@
+import multiprocessing as mp
+import threading
+import time
+import pytest
+from shared_state import IntersectionState, LaneCounts, GreenLane
+
+
+@pytest.fixture
+def state():
+    state = IntersectionState()
+    yield state
+    state.close()
+
+
+def write_from_child(state, results):
+    """
+    Runs in a spawned process: reads what the parent wrote and answers with a count and a green lane
+    """
+    counts, green = LaneCounts(state), GreenLane(state)
+    results.put((dict(counts), green.value))
+    counts["lane2"] = 7
+    green.value = "lane3"
+    state.close()
+
+
+def test_round_trip_across_a_spawned_process(state):
+    counts, green = LaneCounts(state), GreenLane(state)
+    counts.update({"lane0": 3, "lane1": 5})
+    green.value = "lane1"
+    context = mp.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=write_from_child, args=(state, results))
+    process.start()
+    seen = results.get(timeout=30)
+    process.join(30)
+    assert process.exitcode == 0
+    assert seen == ({"lane0": 3, "lane1": 5}, "lane1")
+    assert dict(counts) == {"lane0": 3, "lane1": 5, "lane2": 7}
+    assert green.value == "lane3"
+
+
+def test_reader_waits_for_a_writer_in_progress(state):
+    LaneCounts(state)["lane0"] = 1
+    state.seq[0] += 1  # a writer is in the middle of an update
+    results = []
+    reader = threading.Thread(target=lambda: results.append(state.counts()))
+    reader.start()
+    time.sleep(0.05)
+    assert reader.is_alive() and not results
+    state.count_values[0] = 2
+    state.seq[0] += 1
+    reader.join(5)
+    assert results == [{"lane0": 2}]
+
+
+def test_reader_retries_when_the_block_changes_under_it(state):
+    calls = []
+
+    def read():
+        calls.append(int(state.seq[0]))
+        if len(calls) == 1:
+            # a whole write happened between the two sequence checks
+            state.seq[0] += 2
+        return len(calls)
+
+    assert state._read(read) == 2
+    assert calls == [0, 2]
+
+
+def test_lane_counts_is_a_mapping(state):
+    counts = LaneCounts(state)
+    assert len(counts) == 0 and list(counts) == []
+    with pytest.raises(KeyError):
+        counts["lane0"]
+    counts["lane1"] = 4
+    counts.update(lane3=2)
+    assert counts["lane1"] == 4
+    assert list(counts) == ["lane1", "lane3"]
+    assert len(counts) == 2
+    assert "lane0" not in counts and "lane3" in counts
+    assert counts.get("lane0") is None
+    del counts["lane1"]
+    assert dict(counts) == {"lane3": 2}
+    with pytest.raises(KeyError):
+        del counts["lane1"]
+    with pytest.raises(KeyError):
+        counts["lane9"] = 1
+
+
+def test_green_lane_values(state):
+    green = GreenLane(state)
+    assert green.value == "None"
+    green.value = "lane2"
+    assert green.value == "lane2"
+    green.value = "Error"
+    assert green.value == "Error"
+
+
+def test_phase_matches_set_phase(state):
+    green = GreenLane(state)
+    assert green.phase() == {"green": None, "until": None, "served": set()}
+    green.set_phase("lane1", 123.5, {"lane0", "lane1"})
+    assert green.phase() == {"green": "lane1", "until": 123.5, "served": {"lane0", "lane1"}}
+    assert green.value == "lane1"
+    since = state.snapshot()["green_since"]
+    # staying green only moves the plan, not the time the lane turned green
+    green.set_phase("lane1", 130.0, {"lane0", "lane1", "lane2"})
+    assert state.snapshot()["green_since"] == since
+    green.set_phase("lane3", 140.0, set())
+    phase = green.phase()
+    assert phase == {"green": "lane3", "until": 140.0, "served": set()}
+    assert state.snapshot()["green_since"] >= since
@@ -0,0 +1,134 @@
+from typing import List, Tuple
+import cv2
+import numpy as np
+import supervision as sv
+
+
+def tile_starts(length, tile_size, step):
+    """
+    Returns the start of every tile along one side of the frame, the last tile is moved back
+    so it ends on the edge of the frame instead of hanging off it
+    """
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size + 1, step))
+    if starts[-1] + tile_size < length:
+        starts.append(length - tile_size)
+    return starts
+
+
+class TileGrid:
+    """
+    This class slices frames into overlapping square tiles for sliced inference.
+    Small vehicles are a few pixels wide once a 1920x1080 frame is shrunk to the model input,
+    running the model on tiles at their own resolution keeps them big enough to be found.
+    Only the tiles that cover part of the polygons (plus a margin) are kept, the rest of the
+    frame is never looked at since nothing outside the zones is counted
+    """
+    def __init__(
+        self,
+        frame_resolution_wh: Tuple[int, int],
+        tile_size: int = 640,
+        overlap: float = 0.2,
+        polygons: List[np.ndarray] = None,
+        margin: int = 32,
+    ) -> None:
+        """
+        Args:
+            frame_resolution_wh: (width, height) of the frames
+            tile_size: Side of a tile in pixels, also the input size the model runs at
+            overlap: Fraction of a tile shared with its neighbour, a vehicle cut by the edge of one
+                tile is whole in the next one as long as it is smaller than the overlap
+            polygons: Only keep the tiles that intersect these polygons, None keeps every tile
+            margin: Pixels the polygons are grown by, so vehicles sitting on their edge are whole in a tile
+        """
+        if not 0 <= overlap < 1:
+            raise ValueError(f"overlap has to be in [0, 1), got {overlap}")
+        self.frame_resolution_wh = frame_resolution_wh
+        self.tile_size = tile_size
+        self.overlap = overlap
+        width, height = frame_resolution_wh
+        step = max(1, int(tile_size * (1 - overlap)))
+        tiles = np.array([(x, y, min(x + tile_size, width), min(y + tile_size, height))
+                          for y in tile_starts(height, tile_size, step)
+                          for x in tile_starts(width, tile_size, step)], dtype=np.int64)
+        if polygons is not None:
+            mask = np.zeros((height, width), dtype=np.uint8)
+            cv2.fillPoly(mask, [np.asarray(polygon, dtype=np.int32) for polygon in polygons], 1)
+            if margin > 0:
+                mask = cv2.dilate(mask, np.ones((2 * margin + 1, 2 * margin + 1), dtype=np.uint8))
+            keep = [mask[y1:y2, x1:x2].any() for x1, y1, x2, y2 in tiles]
+            tiles = tiles[np.array(keep, dtype=bool)]
+        self.tiles = tiles
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def tiles_in(self, region=None) -> np.ndarray:
+        """
+        Returns the tiles that overlap region, every tile when region is None
+        Args:
+            region: (x1, y1, x2, y2) box, e.g. the region MotionGate.check saw moving
+        """
+        if region is None:
+            return self.tiles
+        x1, y1, x2, y2 = region
+        tiles = self.tiles
+        overlaps = (tiles[:, 0] < x2) & (tiles[:, 2] > x1) & (tiles[:, 1] < y2) & (tiles[:, 3] > y1)
+        return tiles[overlaps]
+
+    @staticmethod
+    def slice(frame: np.ndarray, tiles: np.ndarray) -> List[np.ndarray]:
+        """
+        Returns the crop of every tile, the crops are views into the frame and are not copied
+        """
+        return [frame[y1:y2, x1:x2] for x1, y1, x2, y2 in tiles.tolist()]
+
+
+def non_max_suppression(xyxy: np.ndarray, scores: np.ndarray, threshold: float = 0.5) -> np.ndarray:
+    """
+    Greedy NMS on intersection over the smaller box rather than over the union.
+    A vehicle cut by the edge of one tile gives a small box lying inside its full box from the
+    next tile, their IoU is low but the small one is almost all overlap, so it is dropped
+    Args:
+        xyxy: (n, 4) boxes
+        scores: (n,) confidence of every box
+        threshold: Boxes overlapping a better one by more than this are dropped
+    Returns:
+        The indices of the boxes kept, best first
+    """
+    order = np.argsort(-scores)
+    xyxy = xyxy[order]
+    areas = (xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1])
+    keep = []
+    remaining = np.arange(len(order))
+    while len(remaining):
+        best, rest = remaining[0], remaining[1:]
+        keep.append(best)
+        width = np.minimum(xyxy[best, 2], xyxy[rest, 2]) - np.maximum(xyxy[best, 0], xyxy[rest, 0])
+        height = np.minimum(xyxy[best, 3], xyxy[rest, 3]) - np.maximum(xyxy[best, 1], xyxy[rest, 1])
+        intersection = width.clip(0) * height.clip(0)
+        smaller = np.minimum(areas[best], areas[rest])
+        overlap = intersection / np.maximum(smaller, 1e-9)
+        remaining = rest[overlap <= threshold]
+    return order[np.array(keep, dtype=np.int64)]
+
+
+def merge_tiles(detections: List[sv.Detections], tiles: np.ndarray, threshold: float = 0.5) -> sv.Detections:
+    """
+    Moves the detections of every tile back to frame coordinates and merges the vehicles
+    found in more than one tile with non_max_suppression
+    Args:
+        detections: The detections of every tile, in tile coordinates
+        tiles: (n, 4) the tiles they were found in
+        threshold: Overlap above which two detections are the same vehicle
+    """
+    shifted = []
+    for tile_detections, (x1, y1, _, _) in zip(detections, tiles.tolist()):
+        if len(tile_detections):
+            tile_detections.xyxy = tile_detections.xyxy + np.array([x1, y1, x1, y1], dtype=np.float32)
+            shifted.append(tile_detections)
+    if not shifted:
+        return sv.Detections.empty()
+    merged = sv.Detections.merge(shifted)
+    return merged[non_max_suppression(merged.xyxy, merged.confidence, threshold)]
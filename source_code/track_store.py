@@ -0,0 +1,79 @@
+import numpy as np
+
+# Rows of the DeepSort Kalman mean: x, y, aspect ratio, height and their velocities
+Y = 1
+VX = 4
+VY = 5
+
+
+class TrackStore:
+    """
+    This class keeps the last position of every track of one tracker.
+    Tracks that were deleted or not seen for 'ttl' updates are forgotten, so the memory stays flat
+    no matter how long the camera runs.
+    A lane has a few dozen tracks at most, for those a plain dictionary and a loop are faster than numpy
+    (which costs a few microseconds per call whatever the size), see benchmarks/track_store.py
+    """
+    def __init__(self, ttl=100, evict_every=16):
+        """
+        Args:
+            ttl: Forget a track after this many updates without it
+            evict_every: Look for tracks past their ttl every this many updates
+        """
+        self.ttl = ttl
+        self.evict_every = evict_every
+        self.recent = {}  # track_id -> (x, y, last update)
+        self.tick = 0
+
+    def __len__(self):
+        return len(self.recent)
+
+    def update(self, track_ids, means, deleted=None):
+        """
+        Stores the current mean of every track and returns the ones heading north and south.
+        A track moving up the frame is leaving the intersection (North), one moving down is
+        entering it (South), in both cases only while its vertical speed is above its horizontal one.
+        A track seen for the first time has no direction yet
+        Args:
+            track_ids: Id of every track
+            means: Kalman mean of every track
+            deleted: Optional bool per track, deleted tracks are forgotten
+        Returns:
+            A tuple (north, south) of the track ids leaving and entering the intersection
+        """
+        self.tick += 1
+        tick = self.tick
+        recent = self.recent
+        north, south = [], []
+        for i, track_id in enumerate(track_ids):
+            if deleted is not None and deleted[i]:
+                recent.pop(track_id, None)
+                continue
+            mean = means[i]
+            y = float(mean[Y])
+            previous = recent.get(track_id)
+            if previous is not None and mean[VY] > mean[VX]:
+                if y < previous[1]:
+                    north.append(track_id)
+                elif y > previous[1]:
+                    south.append(track_id)
+            recent[track_id] = (float(mean[0]), y, tick)
+        if tick % self.evict_every == 0:
+            self.evict()
+        return north, south
+
+    def live_positions(self):
+        """
+        Returns the (x, y) centre of the tracks given to the last update
+        """
+        return np.array([(x, y) for x, y, last_seen in self.recent.values() if last_seen == self.tick],
+                        dtype=np.float64).reshape(-1, 2)
+
+    def evict(self):
+        """
+        Forgets the tracks not updated in the last ttl updates
+        """
+        stale = [track_id for track_id, (_, _, last_seen) in self.recent.items() if self.tick - last_seen > self.ttl]
+        for track_id in stale:
+            del self.recent[track_id]
+        return len(stale)
@@ -0,0 +1,140 @@
+import numpy as np
+
+# deepsort matches on motion and on an appearance embedding of every detection crop (a CNN per box),
+# bytetrack only on motion, IoU of the Kalman prediction with the boxes like the sv.ByteTrack of aerial.py
+TRACKER_BACKENDS = ("deepsort", "bytetrack")
+
+
+class MotionTrack:
+    """
+    This class is one track of a MotionTracker, with the part of the DeepSort track the counting uses
+    """
+    __slots__ = ("track_id", "mean", "time_since_update", "original_ltwh", "ltrb")
+
+    def __init__(self, track_id, mean, time_since_update, original_ltwh, ltrb):
+        self.track_id = track_id
+        self.mean = mean  # Kalman mean in the DeepSort layout: x, y, aspect ratio, height and their velocities
+        self.time_since_update = time_since_update
+        self.original_ltwh = original_ltwh
+        self.ltrb = ltrb
+
+    def is_confirmed(self):
+        return True
+
+    def is_deleted(self):
+        return False
+
+    def to_ltrb(self):
+        return self.ltrb
+
+
+class MotionTracker:
+    """
+    This class tracks the vehicles of one lane on their motion only, with supervision's ByteTrack.
+    It takes and returns what DeepSort.update_tracks does, so ObjectTracking uses either.
+    Frames the detector skipped (see cadence.DetectionCadence) go through predict_tracks instead, the
+    tracks are only moved along their velocity then. ByteTrack itself would drop the tracks it saw
+    once on such a frame and a new vehicle would never be confirmed with the detector every 2 frames.
+    Tracks that lost their vehicle are still returned for max_age frames, like DeepSort does
+    """
+    def __init__(self, max_age=30, activation_threshold=0.25, matching_threshold=0.8):
+        """
+        Args:
+            max_age: Frames a track is kept without a detection
+            activation_threshold: Detections below this score only extend existing tracks
+            matching_threshold: Most IoU distance (1 - IoU, weighted by the score) of a match
+        """
+        import supervision as sv
+        from supervision.tracker.byte_tracker.core import STrack
+
+        self.byte_track = sv.ByteTrack(track_activation_threshold=activation_threshold, lost_track_buffer=max_age,
+                                       minimum_matching_threshold=matching_threshold)
+        self.predict = STrack.multi_predict
+        self.max_age = max_age
+        self.frame = 0
+        self.last_update = {}  # track id -> frame it was last matched on
+        self.classes = {}  # class name -> number, ByteTrack wants them as numbers
+
+    def update_tracks(self, raw_detections, frame=None):
+        """
+        Returns the tracks after a frame
+        Args:
+            raw_detections: A list of ([x, y, w, h], score, class name), see object_detection.deepsort_detections
+            frame: Not used, the tracks only follow the boxes
+        """
+        self.frame += 1
+        byte_track = self.byte_track
+        tensors = np.empty((len(raw_detections), 6), dtype=np.float32)
+        for row, (ltwh, score, name) in enumerate(raw_detections):
+            left, top, width, height = ltwh
+            tensors[row] = (left, top, left + width, top + height, score,
+                            self.classes.setdefault(name, len(self.classes)))
+        byte_track.update_with_tensors(tensors)
+        for track in byte_track.tracked_tracks:
+            if track.frame_id == byte_track.frame_id:
+                self.last_update[track.track_id] = self.frame
+        # ByteTrack keeps every removed track forever, they are only needed to take them out of the lost ones
+        removed = {track.track_id for track in byte_track.removed_tracks}
+        if removed:
+            byte_track.lost_tracks = [track for track in byte_track.lost_tracks if track.track_id not in removed]
+            byte_track.removed_tracks = []
+            for track_id in removed:
+                self.last_update.pop(track_id, None)
+        return self.tracks()
+
+    def predict_tracks(self):
+        """
+        Returns the tracks moved to a frame the detector skipped, nothing is matched or dropped
+        """
+        self.frame += 1
+        byte_track = self.byte_track
+        self.predict([track for track in byte_track.tracked_tracks if track.is_activated] + byte_track.lost_tracks)
+        return self.tracks()
+
+    def tracks(self):
+        """
+        Returns the confirmed tracks, the lost ones too until they are max_age frames old
+        """
+        tracks = []
+        for track in self.byte_track.tracked_tracks + self.byte_track.lost_tracks:
+            if not track.is_activated:
+                continue
+            age = self.frame - self.last_update.get(track.track_id, self.frame)
+            if age > self.max_age:
+                continue
+            tracks.append(MotionTrack(track.track_id, track.mean, age, track.tlwh, track.tlbr))
+        return tracks
+
+
+def make_tracker(backend, max_age=30):
+    """
+    Returns a new tracker for one lane, every lane needs its own
+    Args:
+        backend: One of TRACKER_BACKENDS
+        max_age: Frames a track is kept without a detection
+    """
+    if backend not in TRACKER_BACKENDS:
+        raise ValueError(f"Unknown tracker backend '{backend}', expected one of {list(TRACKER_BACKENDS)}")
+    if backend == "bytetrack":
+        return MotionTracker(max_age=max_age)
+    from deep_sort_realtime.deepsort_tracker import DeepSort
+    return DeepSort(max_age=max_age)
+
+
+def predict_tracks(tracker):
+    """
+    Returns the tracks of a tracker moved to a frame the detector skipped.
+    DeepSort.update_tracks([]) would also count a miss for every track and delete the tentative ones,
+    so a new vehicle (confirmed after n_init hits in a row) would never be confirmed with the detector
+    every 2 frames. Only the Kalman prediction of its tracks runs here. Tracker.predict is not used either,
+    it counts the frame in time_since_update and DeepSort only IoU matches tracks with time_since_update <= 1,
+    so DeepSort's max_age counts detection frames
+    Args:
+        tracker: A tracker from make_tracker
+    """
+    if isinstance(tracker, MotionTracker):
+        return tracker.predict_tracks()
+    kalman = tracker.tracker.kf
+    for track in tracker.tracker.tracks:
+        track.mean, track.covariance = kalman.predict(track.mean, track.covariance)
+    return tracker.tracker.tracks
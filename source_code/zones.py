@@ -0,0 +1,140 @@
+from typing import List, NamedTuple, Tuple
+import cv2
+import numpy as np
+import supervision as sv
+
+
+class ZoneAssignment(NamedTuple):
+    """
+    Result of ZoneIndex.assign
+    """
+    zone_ids: np.ndarray  # zone of every detection, -1 when it is in none of them
+    counts: np.ndarray  # number of detections in each zone
+    in_zone: np.ndarray  # indices of the detections that are in any zone
+
+
+class ZoneIndex:
+    """
+    This class assigns detections to fixed polygon zones with a single lookup.
+    The polygons are rasterised once into a label image at video resolution (0 for no zone,
+    i + 1 for zone i), so finding the zone of every detection is one fancy index into that image
+    and the counts are one bincount, no matter how many zones there are.
+    Zones are expected not to overlap, where they do the pixel belongs to the zone listed last
+    """
+    def __init__(
+        self,
+        polygons: List[np.ndarray],
+        frame_resolution_wh: Tuple[int, int],
+        triggering_anchor: sv.Position = sv.Position.CENTER,
+    ) -> None:
+        self.polygons = [np.asarray(polygon, dtype=np.int32) for polygon in polygons]
+        self.frame_resolution_wh = frame_resolution_wh
+        self.triggering_anchor = triggering_anchor
+        width, height = frame_resolution_wh
+        dtype = np.uint8 if len(self.polygons) < np.iinfo(np.uint8).max else np.uint16
+        if len(self.polygons) >= np.iinfo(np.uint16).max:
+            raise ValueError(f"Too many zones for one index: {len(self.polygons)}")
+        # one extra row and column so anchors sitting on the right/bottom edge still index the raster
+        self.raster = np.zeros((height + 1, width + 1), dtype=dtype)
+        for i, polygon in enumerate(self.polygons):
+            cv2.fillPoly(self.raster, [polygon], color=i + 1)
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def zone_of_points(self, points: np.ndarray) -> np.ndarray:
+        """
+        Returns the zone of every (x, y) point, -1 for the points outside every zone
+        """
+        if len(points) == 0:
+            return np.empty((0,), dtype=np.int64)
+        height, width = self.raster.shape
+        x = np.ceil(points[:, 0]).astype(np.int64)
+        y = np.ceil(points[:, 1]).astype(np.int64)
+        inside = (x >= 0) & (y >= 0) & (x < width) & (y < height)
+        zone_ids = np.full(len(points), -1, dtype=np.int64)
+        zone_ids[inside] = self.raster[y[inside], x[inside]].astype(np.int64) - 1
+        return zone_ids
+
+    def assign(self, detections: sv.Detections) -> ZoneAssignment:
+        """
+        Finds the zone of every detection from its triggering anchor
+        Args:
+            detections: The detections of the frame
+        Returns:
+            A ZoneAssignment with the zone of every detection, the count of every zone
+            and the indices of the detections that are in a zone
+        """
+        if len(detections) == 0:
+            zone_ids = np.empty((0,), dtype=np.int64)
+        else:
+            # clip to the frame first, like PolygonZone.trigger does, so boxes hanging
+            # off the edge of the frame keep their anchor inside it
+            width, height = self.frame_resolution_wh
+            xyxy = detections.xyxy.copy()
+            xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, width)
+            xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, height)
+            anchors = sv.Detections(xyxy=xyxy).get_anchors_coordinates(self.triggering_anchor)
+            zone_ids = self.zone_of_points(anchors)
+        in_zone = np.flatnonzero(zone_ids >= 0)
+        counts = np.bincount(zone_ids[in_zone], minlength=len(self.polygons))
+        return ZoneAssignment(zone_ids, counts, in_zone)
+
+
+class ZoneOverlay:
+    """
+    This class draws the outlines of fixed polygon zones onto frames.
+    The outlines are rasterised once at video resolution, drawing them is then a single write
+    (or blend) of the few pixels they cover straight into the frame, instead of redrawing every
+    polygon on a copy of every frame. The pixels come out the same as cv2.polylines drawing
+    the polygons one after the other
+    """
+    def __init__(
+        self,
+        polygons: List[np.ndarray],
+        colors: List[Tuple[int, int, int]],
+        frame_resolution_wh: Tuple[int, int],
+        thickness: int = 2,
+        alpha: float = 1.0,
+    ) -> None:
+        """
+        Args:
+            polygons: The zones to draw
+            colors: BGR color of every polygon
+            frame_resolution_wh: (width, height) of the frames
+            thickness: Width of the outlines
+            alpha: Opacity of the outlines, below 1 they are blended with the frame
+        """
+        width, height = frame_resolution_wh
+        canvas = np.zeros((height, width, 3), dtype=np.uint8)
+        mask = np.zeros((height, width), dtype=np.uint8)
+        for polygon, color in zip(polygons, colors):
+            polygon = np.asarray(polygon, dtype=np.int32)
+            cv2.polylines(canvas, [polygon], isClosed=True, color=color, thickness=thickness)
+            cv2.polylines(mask, [polygon], isClosed=True, color=255, thickness=thickness)
+        self.frame_resolution_wh = frame_resolution_wh
+        self.alpha = alpha
+        # byte offsets of every covered pixel channel in a contiguous frame, indexing the flat frame
+        # with them is several times faster than indexing rows and columns
+        rows, columns = np.nonzero(mask)
+        pixels = rows.astype(np.intp) * width + columns
+        self.indices = (pixels[:, None] * 3 + np.arange(3)).reshape(-1)
+        self.values = canvas[rows, columns].reshape(-1)
+        if alpha < 1:
+            self.values = self.values.astype(np.float32) * alpha
+
+    def draw(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Draws the outlines into frame, in place, and returns it
+        """
+        height, width = frame.shape[:2]
+        if (width, height) != tuple(self.frame_resolution_wh):
+            raise ValueError(f"Overlay is for {self.frame_resolution_wh} frames, got {(width, height)}")
+        if not frame.flags.c_contiguous:
+            raise ValueError("The overlay can only be drawn into a contiguous frame")
+        flat = frame.reshape(-1)
+        if self.alpha >= 1:
+            flat[self.indices] = self.values
+        else:
+            flat[self.indices] = (flat[self.indices] * (1 - self.alpha) + self.values).astype(np.uint8)
+        return frame